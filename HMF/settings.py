@@ -178,15 +178,29 @@ STATICFILES_FINDERS = (
     "django.contrib.staticfiles.finders.DefaultStorageFinder",
 )
 
+# Give collected files hashed names (so that they may be cached forever), and write
+# precompressed copies of them.
+STATICFILES_STORAGE = "HMFcalc.staticfiles.CompressedManifestStaticFilesStorage"
+
 # ===============================================================================
 # TEMPLATES ETC.
 # ===============================================================================
 
+_TEMPLATE_LOADERS = [
+    "django.template.loaders.filesystem.Loader",
+    "django.template.loaders.app_directories.Loader",
+]
+
+# Templates are compiled once per process in production (so edits need a restart).
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
         "DIRS": [os.path.join(ROOT_DIR, "templates")],
-        "APP_DIRS": True,
+        "OPTIONS": {
+            "loaders": _TEMPLATE_LOADERS
+            if DEBUG
+            else [("django.template.loaders.cached.Loader", _TEMPLATE_LOADERS)]
+        },
     }
 ]
 
@@ -211,8 +225,12 @@ TEMPLATES = [
 # ===============================================================================
 
 MIDDLEWARE = (
+    "HMFcalc.middleware.HealthMiddleware",
+    "HMFcalc.middleware.StaticFilesMiddleware",
+    "HMFcalc.middleware.CompressionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
+    "HMFcalc.middleware.MemoryMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     #    'django.contrib.auth.middleware.AuthenticationMiddleware',
     #    'django.contrib.messages.middleware.MessageMiddleware',
@@ -220,12 +238,155 @@ MIDDLEWARE = (
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+# Responses smaller than this (bytes) aren't worth compressing.
+HMFCALC_COMPRESS_MIN_BYTES = 1024
+
 ROOT_URLCONF = "HMF.urls"
 SESSION_SERIALIZER = "django.contrib.sessions.serializers.PickleSerializer"
 # Python dotted path to the WSGI application used by Django's runserver.
 WSGI_APPLICATION = "HMF.wsgi.application"
 SESSION_SAVE_EVERY_REQUEST = True
 
+# ===============================================================================
+# CACHING
+# ===============================================================================
+# The default cache is shared by all worker processes. It holds computed models
+# (keyed by a hash of their parameters) and the locks used to make sure identical
+# models are only computed once at a time. In production, a memcached backend is
+# preferable, since its ``add`` is atomic.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.path.join(ROOT_DIR, "cache"),
+    }
+}
+
+# How long (seconds) computed models are kept in the shared cache.
+HMFCALC_RESULT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# How long (seconds) whole responses of static pages (home, help etc.) are cached.
+# They're cached per deploy (deploys touch wsgi.py), so are invalidated by a deploy.
+HMFCALC_PAGE_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+HMFCALC_DEPLOY_ID = str(int(os.path.getmtime(os.path.join(ROOT_DIR, "HMF", "wsgi.py"))))
+
+# How long (seconds) a request waits for an identical in-flight computation before
+# computing the model itself, and how often it checks on other processes.
+HMFCALC_SINGLEFLIGHT_TIMEOUT = 120
+HMFCALC_SINGLEFLIGHT_POLL = 0.1
+
+# How long (seconds) a computation that was stopped for exceeding a limit is
+# remembered, so that identical requests fail straight away rather than re-running it.
+HMFCALC_FAILED_CACHE_TIMEOUT = 600
+
+# Where computed model arrays are stored, to be memory-mapped by every worker.
+HMFCALC_ARRAY_STORE = os.path.join(ROOT_DIR, "arrays")
+
+# Where trained emulators (see the train_emulator command) are kept, and the
+# transfer model they're trained with.
+HMFCALC_EMULATOR_DIR = os.path.join(ROOT_DIR, "emulators")
+HMFCALC_EMULATOR_TRANSFER = "CAMB"
+# The largest estimated fractional error of an emulated result. Where the emulator
+# is less accurate than this, the exact calculation is done instead.
+HMFCALC_EMULATOR_MAX_ERROR = 0.02
+
+# ===============================================================================
+# COMPUTE WORKERS
+# ===============================================================================
+# Number of child processes (per web worker) that models are computed in, so that
+# runaway computations may be killed. 0 computes them in the web worker itself.
+HMFCALC_COMPUTE_WORKERS = 0 if DEBUG else 2
+
+# Computations taking longer than this (seconds), or growing a child's memory by
+# more than this (bytes), are killed, and reported to the user.
+HMFCALC_COMPUTE_TIMEOUT = 60
+HMFCALC_COMPUTE_MAX_RSS = 1024 ** 3
+
+# Number of computations after which a child is replaced (to release fragmented
+# memory).
+HMFCALC_COMPUTE_MAX_JOBS = 50
+
+# ===============================================================================
+# UNCERTAINTY BANDS
+# ===============================================================================
+# Draws of a model's parameters are computed in batches of this many, each a job in
+# the compute workers (so each is limited as any other computation is).
+HMFCALC_UNCERTAINTY_BATCH_SIZE = 50
+
+# Number of batches of a request that may be computed at once, the most draws that
+# may be asked for, and the time (seconds) after which no more batches are started.
+HMFCALC_UNCERTAINTY_WORKERS = max(HMFCALC_COMPUTE_WORKERS, 1)
+HMFCALC_UNCERTAINTY_MAX_SAMPLES = 1000
+HMFCALC_UNCERTAINTY_TIMEOUT = 300
+
+# ===============================================================================
+# WORKER STARTUP
+# ===============================================================================
+# Whether to import (and set up) everything that's slow to, when wsgi.py is loaded,
+# rather than on first use. Servers that load the application before forking their
+# workers (eg. gunicorn --preload) then share it between the workers.
+HMFCALC_PRELOAD = not DEBUG
+
+# ===============================================================================
+# MEMORY DIAGNOSTICS
+# ===============================================================================
+# Whether to measure the memory used by sessions, models and plots (which is
+# costly), and show it at /hmfcalc/memory/.
+HMFCALC_MEMORY_DEBUG = DEBUG
+
+# Sessions, and peak memory of computations, larger than this (bytes) are logged.
+HMFCALC_MEMORY_LOG_BYTES = 20 * 1024 ** 2
+
+# ===============================================================================
+# EXPORTS
+# ===============================================================================
+# Number of processes (per web worker) that format and compress exported files.
+HMFCALC_EXPORT_WORKERS = min(4, os.cpu_count() or 1)
+
+# ===============================================================================
+# LIVE PREVIEWS
+# ===============================================================================
+# Resolution of the coarse preview, and cheap transfer models that stand in for
+# expensive ones in it.
+HMFCALC_PREVIEW_DLOG10M = 0.1
+HMFCALC_PREVIEW_DLNK = 0.2
+HMFCALC_PREVIEW_TRANSFER = {"CAMB": "EH_BAO"}
+
+# Number of threads (per process) refining previews in the background.
+HMFCALC_PREVIEW_WORKERS = 2
+
+# ===============================================================================
+# PRE-RENDERING
+# ===============================================================================
+# How many of the most viewed plots of a session's models to render in the
+# background whenever they change (0 to turn this off), and in how many threads (per
+# process).
+HMFCALC_PRERENDER_PLOTS = 4
+HMFCALC_PRERENDER_WORKERS = 1
+
+# The plots assumed to be the most viewed, in order, until views have been counted.
+HMFCALC_PRERENDER_PRIOR = ("dndm.svg", "fsigma.svg", "ngtm.svg", "power.svg")
+
+# ===============================================================================
+# SESSION QUOTAS
+# ===============================================================================
+# Maximum number of models, and the total size (bytes) of the arrays they hold in a
+# session (those of models in HMFCALC_ARRAY_STORE aren't counted).
+# Beyond these, the least recently viewed models are spilled to HMFCALC_SPILL_DIR.
+HMFCALC_SESSION_MAX_MODELS = 10
+HMFCALC_SESSION_MAX_BYTES = 50 * 1024 ** 2
+HMFCALC_SPILL_DIR = os.path.join(ROOT_DIR, "spill")
+
+# ===============================================================================
+# HEALTH CHECKS
+# ===============================================================================
+# Health probes are answered at this URL, without touching sessions or hmf.
+HMFCALC_HEALTH_URL = "/healthz"
+
+# The file that the celery heartbeat task touches, and how old (seconds) it can be
+# before we report the site as degraded.
+HMFCALC_HEARTBEAT_FILE = os.path.join(ROOT_DIR, "heartbeat")
+HMFCALC_HEARTBEAT_MAX_AGE = 180
+
 # ===============================================================================
 # EMAIL SETUP
 # ===============================================================================
@@ -29,4 +29,12 @@ from django.core.wsgi import get_wsgi_application  # noqa
 
 application = get_wsgi_application()
 
+# Do everything that's slow to do now, before the server (possibly) forks workers.
+from django.conf import settings  # noqa
+
+if settings.HMFCALC_PRELOAD:
+    from HMFcalc.preload import preload  # noqa
+
+    preload()
+
 # Apply WSGI middleware here.
@@ -0,0 +1,357 @@
+"""
+An on-disk, content-addressed store for the arrays of computed models.
+
+Each array is written once, named by a hash of its contents, and every worker process
+opens it as a read-only ``numpy.memmap``. The OS page cache is thus shared between
+all processes, rather than each holding its own unpickled copy of every model.
+
+Each model has a small JSON manifest (keyed by its parameter hash) listing the
+hashes of its arrays. Sessions hold a :class:`StoredModel`, which is tiny to pickle
+and reads its arrays from the store on access. The full framework of a model is
+kept in the shared cache too (so that it needn't be re-made to edit the model), but
+without the arrays that are in the store: those are put back from it when it's got.
+
+Nothing in the store is deleted while it's in use: reading a manifest marks it (and
+writing an array that's already there marks the array) as used, and
+:func:`clean_store` removes whatever hasn't been used for a while.
+"""
+import copy
+import functools
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from hmf._internals._cache import hidden_loc
+
+from . import sandbox, singleflight
+
+logger = logging.getLogger(__name__)
+
+FRAMEWORK_PREFIX = "hmfcalc-framework:"
+
+
+def _root():
+    return getattr(
+        settings, "HMFCALC_ARRAY_STORE", os.path.join(settings.ROOT_DIR, "arrays")
+    )
+
+
+def _array_path(digest):
+    return os.path.join(_root(), digest[:2], digest + ".npy")
+
+
+def _manifest_path(key):
+    return os.path.join(_root(), "manifests", key + ".json")
+
+
+def _atomic_write(path, write):
+    """Write a file via ``write(fileobj)`` such that readers never see it half-done."""
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def put_array(arr):
+    """Write an array to the store (if not already there) and return its hash."""
+    arr = np.ascontiguousarray(arr)
+
+    h = hashlib.sha1()
+    h.update(str(arr.dtype).encode())
+    h.update(str(arr.shape).encode())
+    h.update(arr.tobytes())
+    digest = h.hexdigest()
+
+    path = _array_path(digest)
+    try:
+        # Mark it as used, so that it's not cleaned up from under the new manifest.
+        os.utime(path)
+    except FileNotFoundError:
+        _atomic_write(path, lambda f: np.save(f, arr))
+
+    return digest
+
+
+@functools.lru_cache(maxsize=1024)
+def get_array(digest):
+    """Return a read-only memory-mapped view of the array with the given hash."""
+    return np.load(_array_path(digest), mmap_mode="r")
+
+
+def read_manifest(key):
+    """Return the manifest of the model with the given parameter hash, or None."""
+    path = _manifest_path(key)
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return manifest
+
+
+def write_manifest(key, obj, kwargs, quantities):
+    """
+    Store the given quantities of a computed model, and write its manifest.
+
+    Returns the manifest.
+    """
+    manifest = {
+        "cls": obj.__class__.__name__,
+        "kwargs": kwargs,
+        # Only used for display, so anything non-trivial is just stringified.
+        "parameter_values": json.loads(json.dumps(obj.parameter_values, default=str)),
+        "arrays": _put_quantities(obj, quantities),
+    }
+
+    _write_manifest(key, manifest)
+    return manifest
+
+
+def add_to_manifest(key, obj, quantities):
+    """
+    Store more quantities of a model whose manifest has already been written.
+
+    Returns the updated manifest.
+    """
+    arrays = _put_quantities(obj, quantities)
+
+    # Re-read the manifest just before writing, to lose as little as possible of what
+    # other processes have added in the meantime. Anything lost is just re-computed.
+    manifest = read_manifest(key)
+    manifest["arrays"].update(arrays)
+    _write_manifest(key, manifest)
+    return manifest
+
+
+def annotate_manifest(key, **values):
+    """
+    Add other information (eg. how accurate it is) to the manifest of a model.
+
+    Returns the updated manifest, or None if there is no manifest.
+    """
+    manifest = read_manifest(key)
+    if manifest is None:
+        return None
+    manifest.update(values)
+    _write_manifest(key, manifest)
+    return manifest
+
+
+def _put_quantities(obj, quantities):
+    arrays = {}
+    for q in quantities:
+        val = getattr(obj, q)
+        if isinstance(val, np.ndarray):
+            arrays[q] = put_array(val)
+    return arrays
+
+
+def _write_manifest(key, manifest):
+    _atomic_write(
+        _manifest_path(key),
+        lambda f: f.write(json.dumps(manifest, default=str).encode()),
+    )
+
+
+def share_framework(key, obj, manifest):
+    """
+    Put the framework of a stored model in the shared cache.
+
+    The arrays in its manifest are left out (see :func:`shared_framework`), and the
+    full copy that computing it put in the cache (see :mod:`~HMFcalc.singleflight`)
+    is let go of, once anyone waiting on it has had time to pick it up.
+    """
+    stripped = copy.copy(obj)
+    digests = {}
+    for q, digest in manifest["arrays"].items():
+        loc = hidden_loc(obj, q)
+        if type(vars(obj).get(loc)) is np.ndarray:
+            vars(stripped)[loc] = None
+            digests[loc] = digest
+
+    cache.set(
+        FRAMEWORK_PREFIX + key,
+        (stripped, digests),
+        settings.HMFCALC_RESULT_CACHE_TIMEOUT,
+    )
+    singleflight.release_result(key)
+
+
+def shared_framework(key):
+    """The framework put in the cache by :func:`share_framework`, or None."""
+    shared = cache.get(FRAMEWORK_PREFIX + key)
+    if shared is None:
+        return None
+
+    obj, digests = shared
+    try:
+        for loc, digest in digests.items():
+            # A writeable copy, in case hmf modifies it in place.
+            vars(obj)[loc] = np.array(get_array(digest))
+    except OSError:
+        # The arrays have been cleaned up.
+        return None
+    return obj
+
+
+def clean_store(max_age):
+    """
+    Remove the manifests and arrays that haven't been used for ``max_age`` seconds.
+
+    Arrays are only removed once no remaining manifest lists them. Returns the number
+    of files removed.
+    """
+    root = _root()
+    cutoff = time.time() - max_age
+
+    def old(path):
+        try:
+            return os.path.getmtime(path) < cutoff
+        except FileNotFoundError:
+            return False
+
+    removed = 0
+    manifests = os.path.join(root, "manifests")
+    used = set()
+    for name in os.listdir(manifests) if os.path.isdir(manifests) else ():
+        path = os.path.join(manifests, name)
+        if old(path):
+            os.remove(path)
+            removed += 1
+        else:
+            manifest = read_manifest(os.path.splitext(name)[0])
+            used.update((manifest or {}).get("arrays", {}).values())
+
+    for dirpath, _, filenames in os.walk(root):
+        if dirpath == manifests:
+            continue
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            digest = os.path.splitext(name)[0]
+            if digest not in used and old(path):
+                os.remove(path)
+                removed += 1
+
+    return removed
+
+
+def _computed(obj, cls, kwargs, quantities):
+    """``obj`` (or, if None, a new ``cls(**kwargs)``) with ``quantities`` computed."""
+    if obj is None:
+        obj = cls(**kwargs)
+    for q in quantities:
+        getattr(obj, q)
+    return obj
+
+
+class StoredModel:
+    """
+    A lightweight stand-in for a computed model, whose arrays live in the store.
+
+    Stored quantities (eg. ``m``, ``dndm``) are returned as read-only memory maps.
+    Those that aren't yet in the store are computed (along with only what they
+    depend on) when first accessed, and added to the store. Any other attribute is a
+    parameter value. Anything else must be got from the full framework, explicitly
+    (see :meth:`framework`).
+    """
+
+    def __init__(self, key, cls, kwargs, quantities):
+        self.key = key
+        self.cls = cls
+        self.kwargs = kwargs
+        self.quantities = tuple(quantities)
+        self._manifest = None
+        self._framework = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_manifest"] = None
+        state["_framework"] = None
+        return state
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = read_manifest(self.key)
+
+        if self._manifest is None:
+            # The store has been cleared underneath us -- just re-make it.
+            logger.info("Manifest for %s missing, re-computing", self.key)
+            self._manifest = write_manifest(
+                self.key, self.framework(), self.kwargs, ("m", "k")
+            )
+        return self._manifest
+
+    @property
+    def parameter_values(self):
+        return self.manifest["parameter_values"]
+
+    def framework(self):
+        """
+        Return the full hmf framework for this model.
+
+        If it's no longer in the shared cache, it's re-made in a child process (see
+        :mod:`~HMFcalc.sandbox`).
+        """
+        if self.__dict__.get("_framework") is None:
+            obj = shared_framework(self.key)
+            if obj is None:
+                obj = singleflight.get_result(self.key)
+            if obj is None:
+                logger.info("Framework for %s expired, re-making it", self.key)
+                obj = sandbox.run(_computed, None, self.cls, self.kwargs, ())
+            self._framework = obj
+        return self._framework
+
+    def compute(self, quantities):
+        """Compute any of the given quantities not yet in the store, and add them."""
+        missing = [q for q in quantities if q not in self.manifest["arrays"]]
+        if not missing:
+            return
+
+        # Computed in a child process, like the model itself.
+        obj = self.__dict__.get("_framework")
+        if obj is None:
+            obj = shared_framework(self.key)
+        obj = sandbox.run(_computed, obj, self.cls, self.kwargs, missing)
+        self._framework = obj
+        self._manifest = add_to_manifest(self.key, obj, missing)
+
+        # Share everything computed so far (eg. the transfer function) with others.
+        share_framework(self.key, obj, self._manifest)
+
+    def __getattr__(self, name):
+        # Don't recurse while being unpickled (ie. before our state is set).
+        if name.startswith("_") or "key" not in self.__dict__:
+            raise AttributeError(name)
+
+        manifest = self.manifest
+        if name in manifest["arrays"]:
+            return get_array(manifest["arrays"][name])
+        if name in self.quantities:
+            self.compute([name])
+            if name in self.manifest["arrays"]:
+                return get_array(self.manifest["arrays"][name])
+        if name in self.kwargs:
+            return self.kwargs[name]
+        if isinstance(manifest["parameter_values"].get(name), (int, float)):
+            return manifest["parameter_values"][name]
+
+        raise AttributeError(
+            "{} is not stored; use framework() to get it from the full model".format(
+                name
+            )
+        )
@@ -0,0 +1,112 @@
+"""
+Memoization of the upstream stages of models, shared across sessions and processes.
+
+Models that differ only downstream share their upstream stages: eg. a Tinker08 and
+a Watson model with the same cosmology, transfer model and filter share the transfer
+function, power spectrum, sigma(M) and n_eff -- only fsigma (and what follows from it)
+differs. Each stage is keyed by the parameters it actually depends on, and a model
+with all of a stage's quantities computed is kept in the shared cache under its key.
+
+A new model is then made by copying the model of the deepest stage that's already
+been computed (by anyone), and updating only the parameters that differ, so that hmf
+only re-computes the stages downstream of them.
+"""
+import hashlib
+import json
+import logging
+
+import hmf
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics, utils
+
+logger = logging.getLogger(__name__)
+
+STAGE_PREFIX = "hmfcalc-stage:"
+
+_TRANSFER = (
+    "cosmo_model",
+    "cosmo_params",
+    "transfer_model",
+    "transfer_params",
+    "lnk_min",
+    "lnk_max",
+    "dlnk",
+    "takahashi",
+    "wdm_mass",
+    "wdm_model",
+    "wdm_params",
+)
+_POWER = ("n", "sigma_8")
+_GROWTH = ("growth_model", "growth_params", "z")
+_FILTER = ("filter_model", "filter_params", "Mmin", "Mmax", "dlog10m")
+
+# Each stage: its name, the parameters it depends on, and the quantities it computes.
+# The transfer stage is the un-normalised transfer function (eg. from CAMB), which
+# doesn't depend on the normalisation (sigma_8) or spectral index of the power.
+STAGES = (
+    ("transfer", _TRANSFER, ("_unnormalised_lnT",)),
+    ("sigma", _TRANSFER + _POWER + _GROWTH + _FILTER, ("power", "sigma", "n_eff")),
+)
+
+
+def stage_key(stage, cls, kwargs):
+    """The key of a model's stage, from only the parameters that the stage uses."""
+    name, params, _ = stage
+    canon = json.dumps(
+        {
+            "cls": cls.__name__,
+            "hmf": hmf.__version__,
+            "kwargs": {p: kwargs.get(p) for p in params},
+        },
+        sort_keys=True,
+        default=utils._canonical,
+    )
+    return STAGE_PREFIX + name + ":" + hashlib.sha1(canon.encode()).hexdigest()
+
+
+def _update_kwargs(base_kwargs, kwargs):
+    """
+    Parameters with which to update a model made with ``base_kwargs``, or None.
+
+    Parameters of the base model that aren't given must be reset to their defaults,
+    so that they're not carried over. This is only possible for model parameters
+    (which default to ``{}``).
+    """
+    explicit = dict(kwargs)
+    for k in set(base_kwargs) - set(kwargs):
+        if not k.endswith("_params"):
+            return None
+        explicit[k] = {}
+    return explicit
+
+
+def build(cls, **kwargs):
+    """
+    Create a model, re-using the deepest of its stages that's already been computed.
+
+    The model's stages are then shared with others (with their quantities computed).
+    """
+    keys = [stage_key(stage, cls, kwargs) for stage in STAGES]
+
+    obj = None
+    for stage, key in reversed(list(zip(STAGES, keys))):
+        cached = cache.get(key)
+        explicit = cached and _update_kwargs(cached[0], kwargs)
+        if explicit is not None:
+            metrics.incr("component_cache_hit")
+            logger.info("Re-using the %s stage of another model", stage[0])
+            obj = utils.hmf_driver(cls=cls, previous=cached[1], **explicit)
+            break
+
+    if obj is None:
+        metrics.incr("component_cache_miss")
+        obj = cls(**kwargs)
+
+    for stage, key in zip(STAGES, keys):
+        if not cache.has_key(key):
+            utils.materialise(obj, stage[2])
+            cache.set(key, (kwargs, obj), settings.HMFCALC_RESULT_CACHE_TIMEOUT)
+
+    return obj
@@ -0,0 +1,69 @@
+"""
+Compression of responses, with gzip or (if the ``brotli`` package is installed) brotli.
+
+Only text-like content is compressed: PNGs, PDFs, zip and npz files are already
+compressed, and gain nothing from it.
+"""
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types worth compressing (prefixes).
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "image/svg+xml",
+    "image/x-icon",
+    "image/vnd.microsoft.icon",
+    "application/json",
+    "application/javascript",
+    "application/postscript",
+)
+
+
+def encodings():
+    """The encodings we can compress with, in order of preference."""
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def compressible(content_type):
+    """Whether content of the given type is worth compressing."""
+    return (content_type or "").startswith(COMPRESSIBLE_TYPES)
+
+
+def accepted_encodings(request):
+    """The encodings we can compress with that the client accepts, best first."""
+    accepted = {}
+    for part in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0
+        accepted[coding.strip().lower()] = q
+
+    return [e for e in encodings() if accepted.get(e, accepted.get("*", 0)) > 0]
+
+
+def accepted_encoding(request):
+    """The preferred encoding that the client accepts, or None."""
+    accepted = accepted_encodings(request)
+    return accepted[0] if accepted else None
+
+
+def compress(content, encoding, fast=True):
+    """
+    Compress bytes with the given encoding.
+
+    Responses compressed on the fly use ``fast`` settings. Content compressed once
+    and kept (static files, cached plots) should be compressed as well as possible.
+    """
+    if encoding == "gzip":
+        return gzip.compress(content, compresslevel=6 if fast else 9, mtime=0)
+    if encoding == "br":
+        return brotli.compress(content, quality=5 if fast else 11)
+    raise ValueError("Unknown encoding: {}".format(encoding))
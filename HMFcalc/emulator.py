@@ -0,0 +1,274 @@
+"""
+A fast, approximate emulator for sigma(M) and dn/dM.
+
+For each fitting function, ln(sigma) and ln(dn/dM) on a fixed mass grid are fit
+(offline) with a polynomial in the cosmological parameters and redshift, over a
+fixed box of parameter space. Evaluating the emulator is then a single small
+matrix product, which takes well under a millisecond.
+
+The accuracy of each emulator is estimated from a held-out set of training samples,
+and reported along with every emulated result. Emulators are trained with the
+``train_emulator`` management command, and saved as one .npz file per fitting
+function in ``HMFCALC_EMULATOR_DIR``.
+"""
+import functools
+import itertools
+import logging
+import os
+import warnings
+
+import numpy as np
+from django.conf import settings
+from hmf import MassFunction
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+# The parameters that are emulated, and the default box over which they're trained.
+# Cosmological parameters are passed to hmf in ``cosmo_params``.
+PARAMETERS = ("Om0", "Ob0", "H0", "sigma_8", "n", "z")
+COSMO_PARAMETERS = ("Om0", "Ob0", "H0")
+DEFAULT_BOX = {
+    "Om0": (0.2, 0.4),
+    "Ob0": (0.03, 0.06),
+    "H0": (60.0, 80.0),
+    "sigma_8": (0.7, 0.9),
+    "n": (0.9, 1.0),
+    "z": (0.0, 3.0),
+}
+
+
+def _exponents(ndim, order):
+    """All monomials of total degree <= order, as tuples of dimension indices."""
+    return [
+        combo
+        for deg in range(order + 1)
+        for combo in itertools.combinations_with_replacement(range(ndim), deg)
+    ]
+
+
+def _features(x, exponents):
+    """Evaluate the monomials at points ``x`` (shape ``(n, ndim)``)."""
+    return np.array([np.prod(x[:, list(combo)], axis=1) for combo in exponents]).T
+
+
+def _normalise(params, lo, hi):
+    return 2 * (params - lo) / (hi - lo) - 1
+
+
+def _hmf_kwargs(params, transfer_model=None):
+    """Arguments to :class:`hmf.MassFunction` for the given emulated parameters."""
+    kwargs = dict(
+        cosmo_params={k: params[k] for k in COSMO_PARAMETERS},
+        sigma_8=params["sigma_8"],
+        n=params["n"],
+        z=params["z"],
+    )
+    if transfer_model is not None:
+        kwargs["transfer_model"] = transfer_model
+    return kwargs
+
+
+def train(
+    hmf_models,
+    n_samples=400,
+    order=3,
+    box=DEFAULT_BOX,
+    transfer_model="CAMB",
+    log10m=np.arange(8, 16.01, 0.05),
+    holdout=0.2,
+    seed=1234,
+):
+    """
+    Train emulators for each of the given fitting functions.
+
+    The (expensive) transfer function and mass variance are shared between fitting
+    functions, so training many at once is barely slower than training one.
+
+    Returns
+    -------
+    dict
+        Emulator (a dict of arrays) for each fitting function.
+    """
+    rng = np.random.RandomState(seed)
+    lo = np.array([box[p][0] for p in PARAMETERS])
+    hi = np.array([box[p][1] for p in PARAMETERS])
+    samples = lo + (hi - lo) * rng.uniform(size=(n_samples, len(PARAMETERS)))
+
+    lnsigma = np.zeros((n_samples, len(log10m)))
+    lndndm = {h: np.zeros((n_samples, len(log10m))) for h in hmf_models}
+
+    obj = MassFunction(
+        transfer_model=transfer_model,
+        Mmin=log10m[0],
+        Mmax=log10m[-1] + (log10m[1] - log10m[0]) / 2,
+        dlog10m=log10m[1] - log10m[0],
+    )
+    for i, sample in enumerate(samples):
+        obj.update(**_hmf_kwargs(dict(zip(PARAMETERS, sample))))
+
+        lnsigma[i] = np.log(obj.sigma)
+        for h in hmf_models:
+            obj.update(hmf_model=h)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                lndndm[h][i] = np.log(obj.dndm)
+
+        if not (i + 1) % 50:
+            logger.info("Computed %s/%s training samples", i + 1, n_samples)
+
+    exponents = _exponents(len(PARAMETERS), order)
+    x = _features(_normalise(samples, lo, hi), exponents)
+    n_test = int(holdout * n_samples)
+
+    def fit(y):
+        valid = np.all(np.isfinite(y), axis=0)
+        y = np.where(valid, y, 0)
+
+        coef = np.linalg.lstsq(x[n_test:], y[n_test:], rcond=None)[0]
+
+        # Error estimate: 95th percentile of the (absolute) error in ln(y) on the
+        # held-out samples, for each mass.
+        err = np.percentile(np.abs(x[:n_test].dot(coef) - y[:n_test]), 95, axis=0)
+        return coef, err, valid
+
+    coef_sigma, err_sigma, valid_sigma = fit(lnsigma)
+
+    out = {}
+    for h in hmf_models:
+        coef, err, valid = fit(lndndm[h])
+        out[h] = {
+            "parameters": np.array(PARAMETERS),
+            "lo": lo,
+            "hi": hi,
+            "order": np.array(order),
+            "transfer_model": np.array(transfer_model),
+            "log10m": log10m,
+            "coef_lnsigma": coef_sigma,
+            "err_lnsigma": err_sigma,
+            "coef_lndndm": coef,
+            "err_lndndm": err,
+            "valid": valid & valid_sigma,
+        }
+    return out
+
+
+def _path(hmf_model):
+    return os.path.join(settings.HMFCALC_EMULATOR_DIR, hmf_model + ".npz")
+
+
+def save(hmf_model, emulator):
+    """Save a trained emulator."""
+    os.makedirs(settings.HMFCALC_EMULATOR_DIR, exist_ok=True)
+    np.savez(_path(hmf_model), **emulator)
+
+
+@functools.lru_cache(maxsize=None)
+def load(hmf_model):
+    """Load the emulator for a fitting function, or None if there isn't one."""
+    try:
+        with np.load(_path(hmf_model)) as f:
+            return {k: f[k] for k in f.files}
+    except OSError:
+        return None
+
+
+def emulate(hmf_model, params, m, transfer_model=None):
+    """
+    Emulate sigma and dn/dm at masses ``m``.
+
+    Parameters
+    ----------
+    hmf_model : str
+        The fitting function.
+    params : dict
+        Values of each of :data:`PARAMETERS`.
+    m : array
+        Masses at which to evaluate.
+    transfer_model : str, optional
+        The transfer model required. If given, and the emulator was trained with a
+        different transfer model, the emulator is not used.
+
+    Returns
+    -------
+    dict or None
+        ``sigma`` and ``dndm`` at ``m``, plus ``sigma_error`` and ``dndm_error``
+        (estimated fractional errors). None if there is no emulator for this model,
+        the parameters lie outside its training box, or its estimated error at any
+        of ``m`` exceeds ``HMFCALC_EMULATOR_MAX_ERROR``, in which case the exact
+        calculation should be used instead.
+    """
+    emu = load(hmf_model)
+    if emu is None:
+        return None
+
+    if transfer_model is not None and transfer_model != str(emu["transfer_model"]):
+        return None
+
+    p = np.array([params[name] for name in emu["parameters"]], dtype=float)
+    if np.any(p < emu["lo"]) or np.any(p > emu["hi"]):
+        return None
+
+    log10m = np.log10(m)
+    grid = emu["log10m"]
+    inside = (grid >= log10m[0] - 1e-8) & (grid <= log10m[-1] + 1e-8)
+    if (
+        log10m[0] < grid[0] - 1e-8
+        or log10m[-1] > grid[-1] + 1e-8
+        or not np.all(emu["valid"][inside])
+    ):
+        return None
+
+    x = _features(
+        _normalise(p[None, :], emu["lo"], emu["hi"]),
+        _exponents(len(p), int(emu["order"])),
+    )
+
+    out = {}
+    for name in ("lnsigma", "lndndm"):
+        y = x.dot(emu["coef_" + name])[0]
+        out[name[2:]] = np.exp(np.interp(log10m, grid, y))
+        # Fractional error, to first order.
+        out[name[2:] + "_error"] = np.interp(log10m, grid, emu["err_" + name])
+
+    if max(out["sigma_error"].max(), out["dndm_error"].max()) > (
+        settings.HMFCALC_EMULATOR_MAX_ERROR
+    ):
+        return None
+
+    return out
+
+
+def fast_hmf(hmf_model, params, Mmin, Mmax, dlog10m, transfer_model=None):
+    """
+    Emulate a model if possible, falling back to the exact calculation if not.
+
+    Returns a dict of ``m``, ``sigma``, ``dndm``, their estimated fractional errors,
+    and whether the result was ``emulated``.
+    """
+    m = 10 ** np.arange(Mmin, Mmax, dlog10m)
+    out = emulate(hmf_model, params, m, transfer_model=transfer_model)
+
+    if out is not None:
+        out.update(m=m, emulated=True)
+        return out
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        obj = utils.stored_hmf_driver(
+            hmf_model=hmf_model,
+            Mmin=Mmin,
+            Mmax=Mmax,
+            dlog10m=dlog10m,
+            quantities=("sigma", "dndm"),
+            **_hmf_kwargs(params, transfer_model)
+        )
+
+    return {
+        "m": obj.m,
+        "sigma": obj.sigma,
+        "dndm": obj.dndm,
+        "sigma_error": np.zeros(len(obj.m)),
+        "dndm_error": np.zeros(len(obj.m)),
+        "emulated": False,
+    }
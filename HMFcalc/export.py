@@ -0,0 +1,111 @@
+"""
+Zip archives of the data of models, with the work fanned out over a pool of processes.
+
+Formatting arrays as text (which numpy does row by row, in python) and deflating it
+are the slow parts of an export. Each member of an archive is thus formatted and
+compressed as a separate task, in a bounded pool of ``HMFCALC_EXPORT_WORKERS``
+processes, and the compressed members are then written into the archive (by
+:mod:`zipfile`, so eg. with UTF-8 names and ZIP64 where needed) in the order they
+were given.
+"""
+import io
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from django.conf import settings
+
+_lock = threading.Lock()
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=settings.HMFCALC_EXPORT_WORKERS)
+        return _executor
+
+
+def _discard_executor(pool):
+    """Shut down a broken pool, so that the next export starts a new one."""
+    global _executor
+    with _lock:
+        if _executor is pool:
+            _executor = None
+    pool.shutdown(wait=False)
+
+
+def table(arrays, headers=None):
+    """
+    A text table of the given arrays, as columns.
+
+    If given, ``headers`` describe each column, in comment lines at the top.
+    """
+    s = io.BytesIO()
+    for i, header in enumerate(headers or ()):
+        s.write("# [{}] {} \n".format(i + 1, header).encode())
+
+    np.savetxt(s, np.array(arrays).T)
+    return s.getvalue()
+
+
+def _member(name, arrays, headers, date_time):
+    """Format and deflate one member: returns its :class:`zipfile.ZipInfo` and data."""
+    content = table(arrays, headers)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    data = compressor.compress(content) + compressor.flush()
+
+    info = zipfile.ZipInfo(name, date_time)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o600 << 16
+    info.CRC = zlib.crc32(content)
+    info.file_size = len(content)
+    info.compress_size = len(data)
+    return info, data
+
+
+def zip_archive(members):
+    """
+    A zip archive (as bytes) of text tables.
+
+    ``members`` is a list of ``(filename, arrays, headers)``, with arguments as for
+    :func:`table`.
+    """
+    date_time = time.localtime()[:6]
+
+    if settings.HMFCALC_EXPORT_WORKERS > 1 and len(members) > 1:
+        pool = _get_executor()
+        try:
+            futures = [pool.submit(_member, *m, date_time) for m in members]
+            compressed = [f.result() for f in futures]
+        except BrokenProcessPool:
+            _discard_executor(pool)
+            raise
+    else:
+        compressed = [_member(*m, date_time) for m in members]
+
+    return _assemble(compressed)
+
+
+def _assemble(members):
+    """Write already-deflated members, as ``(info, data)``, into a zip archive."""
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w") as archive:
+        for info, data in members:
+            # zipfile can't be given compressed data, so do what it does once it has
+            # compressed a member itself: write the header and data, and record the
+            # member for the central directory (written on closing).
+            info.header_offset = out.tell()
+            out.write(info.FileHeader())
+            out.write(data)
+
+            archive.filelist.append(info)
+            archive.NameToInfo[info.filename] = info
+            archive.start_dir = out.tell()
+            archive._didModify = True
+    return out.getvalue()
@@ -148,6 +148,23 @@ class RangeSliderField(forms.CharField):
         return [float(i) for i in items]
 
 
+class DefaultsForm(forms.Form):
+    """
+    A form whose fields, when not given, take their initial values once cleaned.
+
+    Useful for forms that are filled from query strings, where any parameter may be
+    left out.
+    """
+
+    def clean(self):
+        cleaned_data = super().clean()
+
+        for name, field in self.fields.items():
+            if cleaned_data.get(name) in (None, "") and name not in self.errors:
+                cleaned_data[name] = field.initial
+        return cleaned_data
+
+
 class CompositeForm(forms.Form):
     """
     Helper class to handle form composition.
@@ -292,7 +309,7 @@ class HMFModelForm(forms.Form):
                 # don't allow dictionaries for now
                 continue
 
-            fkw = self.field_kwargs.get(key, {})
+            fkw = dict(self.field_kwargs.get(key, {}))
             thisfield = fkw.pop("type", forms.FloatField)
 
             self.fields[name] = thisfield(
@@ -12,10 +12,18 @@ from crispy_forms.bootstrap import TabHolder
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Submit, Div, HTML
 from django import forms
+from django.conf import settings
 from django.utils.safestring import mark_safe
 from hmf import growth_factor, transfer_models, fitting_functions, filters, wdm
 from hmf.halos import mass_definitions
-from .form_utils import CompositeForm, HMFModelForm, HMFFramework, RangeSliderField
+from . import uncertainty, utils
+from .form_utils import (
+    CompositeForm,
+    DefaultsForm,
+    HMFModelForm,
+    HMFFramework,
+    RangeSliderField,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -127,6 +135,20 @@ class TransferFramework(HMFFramework):
         label="lnk Step Size", initial=0.05, min_value=0.005, max_value=0.5,
     )
 
+    k_accuracy = forms.TypedChoiceField(
+        label="Wavenumber grid",
+        choices=[
+            ("", "Use the lnk range and step size above"),
+            ("0.01", "Choose automatically, to 1% accuracy"),
+            ("0.001", "Choose automatically, to 0.1% accuracy"),
+            ("0.0001", "Choose automatically, to 0.01% accuracy"),
+        ],
+        coerce=float,
+        empty_value=None,
+        required=False,
+        help_text="Automatic grids span only what the mass range and filter need",
+    )
+
     takahashi = forms.BooleanField(
         label="Use Takahashi (2012) nonlinear P(k)?", required=False
     )
@@ -313,6 +335,46 @@ class HMFInput(CompositeForm):
         )
         self.helper.form_action = ""
 
+    @classmethod
+    def default_data(cls, **models):
+        """
+        Form data, as submitted by a browser, for the default parameters of a model.
+
+        Parameters
+        ----------
+        models
+            Choices of models, eg. ``hmf_model="PS"``. Other components take their
+            default model. Parameters of models that aren't chosen are left out.
+        """
+        form = cls()
+        chosen = {
+            name: form.get_initial_for_field(field, name)
+            for name, field in form.fields.items()
+            if name.endswith("_model")
+        }
+        chosen.update(models)
+
+        data = {}
+        for name, field in form.fields.items():
+            component = getattr(field, "component", None)
+            model = getattr(field, "model", None)
+            if model is not None and chosen.get(component + "_model") != model:
+                continue
+
+            value = chosen.get(name, form.get_initial_for_field(field, name))
+            if isinstance(field, forms.BooleanField):
+                # Unchecked boxes aren't submitted at all.
+                if value:
+                    data[name] = "on"
+            elif value == "None" and not isinstance(field, forms.ChoiceField):
+                # Parameters defaulting to None have the initial value "None", which
+                # isn't a valid number: they're left blank instead.
+                continue
+            elif value is not None:
+                data[name] = value
+
+        return data
+
     def clean_label(self):
         label = self.cleaned_data["label"]
         label = label.replace("_", "-")
@@ -371,29 +433,25 @@ class PlotChoice(forms.Form):
             ("delta_k", "Dimensionless Power Spectrum"),
         ]
 
+        # Models on different mass grids are interpolated onto a common grid, so
+        # comparisons are always available.
         if len(objects) > 1:
-            show_comps = True
-            for i, o in enumerate(objects.values()):
-                if i == 0:
-                    comp_obj = o
-                else:
-                    if (
-                        o.Mmin != comp_obj.Mmin
-                        or o.Mmax != comp_obj.Mmax
-                        or len(o.m) != len(comp_obj.m)
-                    ):
-                        show_comps = False
-
-            if show_comps:
-                plot_choices += [
-                    ("comparison_dndm", "Comparison of Mass Functions"),
-                    ("comparison_fsigma", "Comparison of Fitting Functions"),
-                ]
+            plot_choices += [
+                ("comparison_dndm", "Comparison of Mass Functions"),
+                ("comparison_fsigma", "Comparison of Fitting Functions"),
+            ]
 
         self.fields["plot_choice"] = forms.ChoiceField(
             label="Plot: ", choices=plot_choices, initial="dndm", required=False
         )
 
+        if len(objects) > 1:
+            self.fields["baseline"] = forms.ChoiceField(
+                label="Compare to: ",
+                choices=[(label, label) for label in objects],
+                required=False,
+            )
+
         self.helper = FormHelper()
         self.helper.form_id = "plotchoiceform"
         self.helper.form_class = "form-horizontal"
@@ -403,13 +461,21 @@ class PlotChoice(forms.Form):
         self.helper.label_class = "col-md-3 control-label"
         self.helper.field_class = "col-md-8"
         self.helper.layout = Layout(
-            Div("plot_choice", "download_choice", css_class="col-md-6")
+            Div(
+                *[
+                    f
+                    for f in ("plot_choice", "baseline", "download_choice", "columns")
+                    if f in self.fields
+                ],
+                css_class="col-md-6"
+            )
         )
 
     download_choices = [
         ("pdf-current", "PDF of Current Plot"),
         # ("pdf-all", "PDF's of All Plots"),
         ("ASCII", "All ASCII data"),
+        ("npz", "All data (binary, .npz)"),
         ("parameters", "List of parameter values"),
         ("halogen", "HALOgen-ready input"),
     ]
@@ -421,6 +487,222 @@ class PlotChoice(forms.Form):
         required=False,
     )
 
+    columns = forms.MultipleChoiceField(
+        label="Columns",
+        choices=[(q, q) for q in utils.MASS_QUANTITIES + utils.K_QUANTITIES],
+        required=False,
+        help_text="Quantities to export (default all). Others aren't computed.",
+    )
+
+
+class RedshiftSeriesForm(DefaultsForm):
+    """
+    Redshifts at which to evaluate a model, for plots of its redshift evolution.
+    """
+
+    zmin = forms.FloatField(
+        label="Min. Redshift", initial=0, min_value=0, max_value=1100, required=False
+    )
+    zmax = forms.FloatField(
+        label="Max. Redshift", initial=5, min_value=0, max_value=1100, required=False
+    )
+    nz = forms.IntegerField(
+        label="Number of Redshifts",
+        initial=11,
+        min_value=2,
+        max_value=100,
+        required=False,
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if self.errors:
+            return cleaned_data
+
+        if cleaned_data.get("zmax") <= cleaned_data.get("zmin"):
+            raise forms.ValidationError(
+                "Max. redshift must be larger than min. redshift."
+            )
+        return cleaned_data
+
+    def redshifts(self):
+        """The redshifts requested."""
+        return np.linspace(
+            self.cleaned_data["zmin"],
+            self.cleaned_data["zmax"],
+            self.cleaned_data["nz"],
+        )
+
+
+def _floats(text):
+    """The numbers in a comma- or space-separated string."""
+    try:
+        return np.array(text.replace(",", " ").split(), dtype=float)
+    except ValueError:
+        raise forms.ValidationError("Could not read the numbers in '{}'".format(text))
+
+
+class UncertaintyForm(DefaultsForm):
+    """
+    A distribution of cosmological parameters, for uncertainty bands of a model.
+
+    The distribution is either a multivariate normal (the mean and covariance of the
+    chosen parameters), or an uploaded table of samples.
+    """
+
+    parameters = forms.MultipleChoiceField(
+        label="Parameters",
+        choices=[(p, p) for p in uncertainty.PARAMETERS],
+        widget=forms.CheckboxSelectMultiple,
+        required=False,
+        help_text="Those that the mean and covariance are of, in the order listed",
+    )
+    mean = forms.CharField(label="Mean", required=False)
+    covariance = forms.CharField(
+        label="Covariance",
+        widget=forms.Textarea(attrs={"rows": 3}),
+        required=False,
+        help_text="One row per line",
+    )
+    samples = forms.FileField(
+        label="Samples",
+        required=False,
+        help_text="Instead of the above: a table (eg. a chain) with a header row "
+        "naming its columns. Columns that aren't parameters are ignored.",
+    )
+    n_samples = forms.IntegerField(
+        label="Number of Samples",
+        initial=100,
+        min_value=2,
+        max_value=settings.HMFCALC_UNCERTAINTY_MAX_SAMPLES,
+        required=False,
+    )
+    seed = forms.IntegerField(
+        label="Random Seed", initial=0, min_value=0, required=False
+    )
+
+    def clean_samples(self):
+        thefile = self.cleaned_data.get("samples", None)
+        if thefile is None:
+            return None
+
+        try:
+            table = np.atleast_1d(np.genfromtxt(thefile, names=True))
+        except Exception:
+            raise forms.ValidationError("Uploaded samples are of the wrong format")
+
+        names = [n for n in uncertainty.PARAMETERS if n in (table.dtype.names or ())]
+        if not names:
+            raise forms.ValidationError(
+                "Uploaded samples have none of the parameters {}".format(
+                    ", ".join(uncertainty.PARAMETERS)
+                )
+            )
+
+        rows = np.column_stack([table[n] for n in names])
+        rows = rows[np.all(np.isfinite(rows), axis=1)]
+        if not len(rows):
+            raise forms.ValidationError("Uploaded samples have no complete rows")
+        return names, rows
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if self.errors or cleaned_data["samples"] is not None:
+            return cleaned_data
+
+        names = [p for p in uncertainty.PARAMETERS if p in cleaned_data["parameters"]]
+        if not names:
+            raise forms.ValidationError(
+                "Choose the parameters of the mean and covariance, or upload samples."
+            )
+
+        mean = _floats(cleaned_data["mean"] or "")
+        covariance = [
+            _floats(row) for row in (cleaned_data["covariance"] or "").splitlines()
+        ]
+        covariance = [row for row in covariance if len(row)]
+
+        if mean.shape != (len(names),):
+            raise forms.ValidationError(
+                "The mean should have {} numbers".format(len(names))
+            )
+        if [len(row) for row in covariance] != [len(names)] * len(names):
+            raise forms.ValidationError(
+                "The covariance should have {0} rows of {0} numbers".format(len(names))
+            )
+
+        covariance = np.array(covariance)
+        tolerance = -1e-10 * np.abs(covariance).max()
+        if (
+            not np.allclose(covariance, covariance.T)
+            or np.linalg.eigvalsh(covariance).min() < tolerance
+        ):
+            raise forms.ValidationError(
+                "The covariance must be symmetric and positive semi-definite"
+            )
+
+        cleaned_data["mean"] = mean
+        cleaned_data["covariance"] = covariance
+        cleaned_data["parameters"] = names
+        return cleaned_data
+
+    def draws(self):
+        """The parameters drawn, and the draws (of shape ``(n, len(parameters))``)."""
+        n, seed = self.cleaned_data["n_samples"], self.cleaned_data["seed"]
+
+        if self.cleaned_data["samples"] is not None:
+            names, rows = self.cleaned_data["samples"]
+            return names, uncertainty.resample(rows, n, seed)
+
+        return (
+            self.cleaned_data["parameters"],
+            uncertainty.draw(
+                self.cleaned_data["mean"], self.cleaned_data["covariance"], n, seed
+            ),
+        )
+
+
+class EmulatorForm(DefaultsForm):
+    """
+    Parameters for the fast (emulated) mass function, given in a query string.
+    """
+
+    hmf_model = forms.ChoiceField(
+        choices=HMFForm.choices, initial=HMFForm._initial, required=False
+    )
+    Om0 = forms.FloatField(
+        initial=hmf.cosmo.Planck15.Om0, min_value=0.02, max_value=2.0, required=False
+    )
+    Ob0 = forms.FloatField(
+        initial=hmf.cosmo.Planck15.Ob0, min_value=0.005, max_value=0.65, required=False
+    )
+    H0 = forms.FloatField(
+        initial=hmf.cosmo.Planck15.H0.value,
+        min_value=10,
+        max_value=500.0,
+        required=False,
+    )
+    sigma_8 = forms.FloatField(initial=0.802, min_value=0.1, required=False)
+    n = forms.FloatField(initial=0.965, min_value=-4, max_value=3, required=False)
+    z = forms.FloatField(initial=0, min_value=0, max_value=1100, required=False)
+    Mmin = forms.FloatField(initial=10, min_value=0, max_value=20, required=False)
+    Mmax = forms.FloatField(initial=15, min_value=0, max_value=20, required=False)
+    dlog10m = forms.FloatField(
+        initial=0.05, min_value=0.005, max_value=1, required=False
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if self.errors:
+            return cleaned_data
+
+        mmin, mmax = cleaned_data.get("Mmin"), cleaned_data.get("Mmax")
+        if mmax - mmin < 2 * cleaned_data.get("dlog10m"):
+            raise forms.ValidationError("Mass step-size must be less than its range.")
+        if cleaned_data.get("Ob0") >= cleaned_data.get("Om0"):
+            raise forms.ValidationError("Ob0 must be less than Om0.")
+        return cleaned_data
+
 
 class ContactForm(forms.Form):
     name = forms.CharField(required=True)
@@ -0,0 +1,187 @@
+"""
+Wavenumber grids chosen to meet an accuracy target, rather than by hand.
+
+The range and step of the wavenumber grid needed for a given accuracy depend on the
+range of masses (ie. of filter radii ``R``) and on the filter: far from ``k ~ 1/R``
+the integrand of sigma is negligible. A grid is chosen by comparing dn/dm, at a
+handful of masses across the range, to that computed on a reference grid that's
+wide (covering ``k R`` in ``REFERENCE_KR`` for every ``R``) and fine:
+
+1. the range is trimmed from each end, as far as it can be while changing dn/dm by
+   less than a quarter of the target each;
+2. the coarsest of ``STEPS`` that keeps the difference within the target is taken.
+
+The difference from the reference of the chosen grid is reported as its estimated
+error. For speed, transfer models with a cheap stand-in (see
+``HMFCALC_PREVIEW_TRANSFER``) are estimated with the stand-in, so the estimate
+doesn't include any change in the transfer function itself with the grid (eg. CAMB
+is run up to ``k_max``). Chosen grids are kept in the shared cache, and the
+estimated error of a model computed on one in its manifest (see
+:mod:`~HMFcalc.array_store`).
+"""
+import collections
+import hashlib
+import json
+import logging
+import warnings
+
+import hmf
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from . import array_store, sandbox, utils
+
+logger = logging.getLogger(__name__)
+
+GRID_PREFIX = "hmfcalc-kgrid:"
+
+# The reference grid, within which grids are chosen.
+REFERENCE_DLNK = 0.005
+REFERENCE_KR = (1e-4, 1e4)
+
+# Steps (in ln k) to choose from, coarsest first, and the step by which the range is
+# trimmed.
+STEPS = (0.5, 0.2, 0.1, 0.05, 0.02, 0.01, 0.005)
+TRIM_STEP = 0.25
+
+# Number of masses at which dn/dm is compared.
+PROBE_MASSES = 25
+
+KGrid = collections.namedtuple("KGrid", ["lnk_min", "lnk_max", "dlnk", "error"])
+
+
+class _Probe:
+    """A cheap version of a model, for comparing dn/dm on different k grids."""
+
+    def __init__(self, cls, kwargs):
+        kwargs = {
+            k: v for k, v in kwargs.items() if k not in ("lnk_min", "lnk_max", "dlnk")
+        }
+        cheap = settings.HMFCALC_PREVIEW_TRANSFER.get(kwargs.get("transfer_model"))
+        if cheap is not None:
+            kwargs["transfer_model"] = cheap
+            kwargs.pop("transfer_params", None)
+
+        self.obj = cls(**kwargs)
+        self.obj.update(dlog10m=(self.obj.Mmax - self.obj.Mmin) / (PROBE_MASSES - 1))
+
+        radii = self.obj.radii
+        self.lnk_min = np.log(REFERENCE_KR[0] / radii.max())
+        self.lnk_max = np.log(REFERENCE_KR[1] / radii.min())
+        self.reference = self.dndm(self.lnk_min, self.lnk_max, REFERENCE_DLNK)
+
+    def dndm(self, lnk_min, lnk_max, dlnk):
+        self.obj.update(lnk_min=lnk_min, lnk_max=lnk_max, dlnk=dlnk)
+        return np.array(self.obj.dndm)
+
+    def error(self, lnk_min, lnk_max, dlnk):
+        """The largest fractional difference of dn/dm from the reference."""
+        ref = self.reference
+        mask = np.isfinite(ref) & (ref > 0)
+        with np.errstate(all="ignore"):
+            diff = np.abs(self.dndm(lnk_min, lnk_max, dlnk)[mask] / ref[mask] - 1)
+        return float(np.max(np.where(np.isfinite(diff), diff, np.inf)))
+
+
+def _bisect(ok, n):
+    """The largest ``i`` in ``range(n)`` for which ``ok(i)``, given that ``ok(0)``."""
+    lo, hi = 0, n
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if ok(mid):
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def _search(cls, kwargs, target):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        probe = _Probe(cls, kwargs)
+        lo, hi = probe.lnk_min, probe.lnk_max
+        n = int((hi - lo) / TRIM_STEP)
+
+        trimmed = _bisect(
+            lambda i: probe.error(lo + i * TRIM_STEP, hi, REFERENCE_DLNK) <= target / 4,
+            n,
+        )
+        lnk_min = lo + trimmed * TRIM_STEP
+
+        trimmed = _bisect(
+            lambda i: probe.error(lo, hi - i * TRIM_STEP, REFERENCE_DLNK) <= target / 4,
+            int((hi - lnk_min) / TRIM_STEP),
+        )
+        lnk_max = hi - trimmed * TRIM_STEP
+
+        steps = [s for s in STEPS if s <= (lnk_max - lnk_min) / 4] or [REFERENCE_DLNK]
+        for dlnk in steps:
+            error = probe.error(lnk_min, lnk_max, dlnk)
+            if error <= target:
+                break
+
+    return KGrid(lnk_min, lnk_max, dlnk, error)
+
+
+def _key(cls, kwargs, target):
+    canon = json.dumps(
+        {
+            "cls": cls.__name__,
+            "hmf": hmf.__version__,
+            "kwargs": {
+                k: v
+                for k, v in kwargs.items()
+                if k not in ("lnk_min", "lnk_max", "dlnk")
+            },
+            "target": target,
+        },
+        sort_keys=True,
+        default=utils._canonical,
+    )
+    return GRID_PREFIX + hashlib.sha1(canon.encode()).hexdigest()
+
+
+def choose(cls, kwargs, target):
+    """
+    A wavenumber grid for the model ``cls(**kwargs)``, accurate to ``target``.
+
+    Accuracy is the largest fractional error in dn/dm (any given ``lnk_min``,
+    ``lnk_max`` and ``dlnk`` are ignored). Returns a :class:`KGrid`, whose ``error``
+    is the estimated error. The search is run in a child process (see
+    :mod:`~HMFcalc.sandbox`).
+    """
+    key = _key(cls, kwargs, target)
+    grid = cache.get(key)
+    if grid is None:
+        grid = KGrid(*sandbox.run(_search, cls, kwargs, target))
+        cache.set(key, grid, settings.HMFCALC_RESULT_CACHE_TIMEOUT)
+
+        logger.info(
+            "Chose lnk in [%.2f, %.2f] with step %g (%d points), error %.2g",
+            grid.lnk_min,
+            grid.lnk_max,
+            grid.dlnk,
+            (grid.lnk_max - grid.lnk_min) / grid.dlnk,
+            grid.error,
+        )
+
+    return grid
+
+
+def record_error(model, grid):
+    """Record that a (stored) model was computed on a grid chosen by :func:`choose`."""
+    key = getattr(model, "key", None)
+    if key is not None:
+        array_store.annotate_manifest(key, kgrid_error=grid.error)
+
+
+def estimated_error(model):
+    """
+    The estimated error of a model whose grid was chosen by :func:`choose`, or None.
+
+    The model may be stored, or spilled from a session.
+    """
+    key = getattr(model, "key", None)
+    manifest = None if key is None else array_store.read_manifest(key)
+    return None if manifest is None else manifest.get("kgrid_error")
@@ -0,0 +1,26 @@
+"""Remove the files of spilled models that no session can still be using."""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from HMFcalc import session_models
+
+
+class Command(BaseCommand):
+    help = (
+        "Remove the files of models spilled from sessions (see HMFCALC_SPILL_DIR) "
+        "that haven't been used for a while, eg. those of expired sessions. Meant to "
+        "be run periodically (eg. from cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-age",
+            type=float,
+            default=settings.SESSION_COOKIE_AGE,
+            help="Remove files unused for this many seconds (default: the age at "
+            "which sessions expire).",
+        )
+
+    def handle(self, *args, **options):
+        removed = session_models.clean_spilled(options["max_age"])
+        self.stdout.write("Removed {} spilled models".format(removed))
@@ -0,0 +1,27 @@
+"""Remove the models in the shared array store that haven't been used for a while."""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from HMFcalc import array_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Remove the manifests and arrays of models in the shared array store (see "
+        "HMFCALC_ARRAY_STORE) that haven't been used for a while, eg. those of "
+        "expired sessions. Meant to be run periodically (eg. from cron), like "
+        "clean_spill."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-age",
+            type=float,
+            default=settings.SESSION_COOKIE_AGE,
+            help="Remove files unused for this many seconds (default: the age at "
+            "which sessions expire).",
+        )
+
+    def handle(self, *args, **options):
+        removed = array_store.clean_store(options["max_age"])
+        self.stdout.write("Removed {} files from the array store".format(removed))
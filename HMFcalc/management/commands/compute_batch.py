@@ -0,0 +1,160 @@
+"""Compute many models (eg. for a parameter study), writing each to a binary file."""
+import json
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from hmf import MassFunction
+from hmf.alternatives.wdm import MassFunctionWDM
+
+from HMFcalc import utils
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+def read_runs(path):
+    """
+    Read a list of runs from a JSON or YAML file.
+
+    Each run is a dict of parameters, as passed to ``hmf_driver`` (eg.
+    ``{"hmf_model": "PS", "z": 1.0}``), and may have a ``name``, which names its
+    output file. Runs with a ``wdm_model`` are computed as WDM models.
+    """
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise CommandError("Reading YAML requires PyYAML to be installed.")
+            runs = yaml.safe_load(f)
+        else:
+            runs = json.load(f)
+
+    if not isinstance(runs, list) or not all(isinstance(r, dict) for r in runs):
+        raise CommandError("{} should contain a list of parameter sets.".format(path))
+    return runs
+
+
+def run_name(run):
+    """The name of a run's output file (without extension)."""
+    kwargs = {k: v for k, v in run.items() if k != "name"}
+    return str(run.get("name") or utils.parameter_hash(**kwargs))
+
+
+def compute(run, quantities, path):
+    """Compute one run, and write its quantities to ``path`` (atomically)."""
+    kwargs = {k: v for k, v in run.items() if k != "name"}
+    cls = MassFunctionWDM if "wdm_model" in kwargs else MassFunction
+
+    t0 = time.time()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        obj = utils.hmf_driver(cls=cls, **kwargs)
+        arrays = {q: np.asarray(getattr(obj, q)) for q in ("m", "k") + quantities}
+
+    parameters = json.dumps(kwargs, sort_keys=True, default=utils._canonical)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        if path.endswith(".h5"):
+            with h5py.File(tmp, "w") as f:
+                for q, a in arrays.items():
+                    f.create_dataset(q, data=a)
+                f.attrs["parameters"] = parameters
+        else:
+            with open(tmp, "wb") as f:
+                np.savez(f, parameters=parameters, **arrays)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return time.time() - t0
+
+
+class Command(BaseCommand):
+    help = (
+        "Compute each of a list of models, read from a JSON or YAML file of parameter "
+        "sets (in the vocabulary of hmf, eg. hmf_model, z, Mmin), and write each to "
+        "its own NPZ or HDF5 file. Runs whose output file already exists are skipped, "
+        "so the command may be interrupted and re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("runs", help="JSON or YAML file listing parameter sets.")
+        parser.add_argument(
+            "-o", "--output", default=".", help="Directory to write output files to."
+        )
+        parser.add_argument(
+            "--format",
+            default="npz",
+            choices=["npz", "hdf5"],
+            help="Output format (default: npz).",
+        )
+        parser.add_argument(
+            "--quantities",
+            nargs="+",
+            default=list(utils.MASS_QUANTITIES + utils.K_QUANTITIES),
+            help="Quantities to write, besides m and k (default: all).",
+        )
+        parser.add_argument(
+            "-j", "--jobs", type=int, default=1, help="Number of parallel processes."
+        )
+
+    def handle(self, *args, **options):
+        if options["format"] == "hdf5" and h5py is None:
+            raise CommandError("Writing HDF5 requires h5py to be installed.")
+
+        quantities = tuple(options["quantities"])
+        bad = set(quantities) - set(utils.MASS_QUANTITIES + utils.K_QUANTITIES)
+        if bad:
+            raise CommandError("Invalid quantities: {}".format(", ".join(bad)))
+
+        runs = read_runs(options["runs"])
+        ext = ".h5" if options["format"] == "hdf5" else ".npz"
+        os.makedirs(options["output"], exist_ok=True)
+        paths = [os.path.join(options["output"], run_name(r) + ext) for r in runs]
+
+        if len(set(paths)) < len(paths):
+            raise CommandError("Runs must have unique names (or parameters).")
+
+        todo = [(r, p) for r, p in zip(runs, paths) if not os.path.exists(p)]
+        self.stdout.write(
+            "{} runs, {} already done".format(len(runs), len(runs) - len(todo))
+        )
+
+        t0 = time.time()
+        failed = 0
+        with ProcessPoolExecutor(max_workers=options["jobs"]) as pool:
+            futures = {pool.submit(compute, r, quantities, p): p for r, p in todo}
+
+            # Report each run as it finishes, whatever order they were submitted in.
+            for i, future in enumerate(as_completed(futures)):
+                path = futures[future]
+                try:
+                    status = "done in {:.2f}s".format(future.result())
+                except Exception as e:
+                    failed += 1
+                    status = "failed: {}".format(e)
+
+                self.stdout.write(
+                    "[{}/{}] {}: {}".format(
+                        i + 1, len(todo), os.path.basename(path), status
+                    )
+                )
+
+        self.stdout.write(
+            "Done in {:.1f}s: {} computed, {} failed".format(
+                time.time() - t0, len(todo) - failed, failed
+            )
+        )
+        if failed:
+            raise CommandError("{} of {} runs failed.".format(failed, len(todo)))
@@ -0,0 +1,134 @@
+"""Measure how long a worker takes to start, and which imports it spends it on."""
+import statistics
+import subprocess
+import sys
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from HMFcalc import preload
+
+# Written (to stderr) once the module's imported, to separate what preloading imports.
+MARKER = "-- imported"
+
+# Run in a fresh interpreter: set up django, and import what a worker imports.
+SCRIPT = """
+import sys, time
+t0 = time.perf_counter()
+import django
+django.setup()
+import {module}
+t1 = time.perf_counter()
+sys.stderr.write("{marker}\\n")
+if {preload}:
+    from HMFcalc.preload import preload
+    preload()
+print(t1 - t0, time.perf_counter() - t1)
+"""
+
+
+def parse_importtime(stderr):
+    """
+    The time (seconds) spent importing each module, from ``-X importtime`` output.
+
+    Times are each module's own, excluding the modules it imports. Only modules
+    imported before the ``MARKER`` line (if any) are included.
+    """
+    times = {}
+    for line in stderr.splitlines():
+        if line == MARKER:
+            break
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        own, _, name = line[len("import time:") :].split("|")
+        if own.strip().isdigit():
+            times[name.strip()] = int(own) / 1e6
+    return times
+
+
+def by_package(times):
+    """The total import time of each top-level package, largest first."""
+    totals = Counter()
+    for name, t in times.items():
+        totals[name.split(".")[0]] += t
+    return totals.most_common()
+
+
+def measure(module, preload=False):
+    """
+    Start a fresh interpreter, and import ``module`` (after setting up django).
+
+    Returns the time to import, the time to preload (if asked to) and the import
+    times of each module.
+    """
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            SCRIPT.format(module=module, preload=preload, marker=MARKER),
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if result.returncode:
+        raise CommandError("Failed to import {}:\n{}".format(module, result.stderr))
+
+    t_import, t_preload = (float(t) for t in result.stdout.split()[-2:])
+    return t_import, t_preload, parse_importtime(result.stderr)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure how long a fresh worker takes to import the site (with python's "
+        "-X importtime), and list the packages that take longest. With --preload, "
+        "also measure the preloading done before workers are forked."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--module",
+            default="HMFcalc.urls",
+            help="Module to import (default: HMFcalc.urls, ie. all the views).",
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=3, help="Number of fresh interpreters."
+        )
+        parser.add_argument(
+            "--top", type=int, default=15, help="Number of packages to list."
+        )
+        parser.add_argument(
+            "--preload", action="store_true", help="Also measure preloading."
+        )
+
+    def handle(self, *args, **options):
+        runs = [
+            measure(options["module"], options["preload"])
+            for _ in range(options["repeat"])
+        ]
+        t_import = statistics.median(r[0] for r in runs)
+        times = runs[-1][2]
+
+        self.stdout.write(
+            "Imported {} in {:.0f}ms (median of {}), {} modules".format(
+                options["module"], t_import * 1000, len(runs), len(times)
+            )
+        )
+        if options["preload"]:
+            self.stdout.write(
+                "Preloaded in a further {:.0f}ms".format(
+                    statistics.median(r[1] for r in runs) * 1000
+                )
+            )
+
+        self.stdout.write("\nSlowest packages to import:")
+        for name, t in by_package(times)[: options["top"]]:
+            self.stdout.write("  {:>8.1f}ms  {}".format(t * 1000, name))
+
+        deferred = [m for m in preload.MODULES if m not in times]
+        if deferred:
+            self.stdout.write(
+                "\nDeferred until first use: {}".format(", ".join(deferred))
+            )
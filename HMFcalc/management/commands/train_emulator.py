@@ -0,0 +1,51 @@
+"""Train the emulators used for the fast (approximate) mass function."""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from HMFcalc import emulator
+from HMFcalc.forms import HMFForm
+
+
+class Command(BaseCommand):
+    help = "Train emulators of sigma(M) and dn/dM for the given fitting functions."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "hmf_models",
+            nargs="*",
+            help="Fitting functions to emulate (default: all those in the calculator).",
+        )
+        parser.add_argument(
+            "--samples", type=int, default=400, help="Number of training samples."
+        )
+        parser.add_argument(
+            "--order", type=int, default=3, help="Order of the polynomial fit."
+        )
+        parser.add_argument(
+            "--transfer-model",
+            default=None,
+            help="Transfer model to train with (default: HMFCALC_EMULATOR_TRANSFER).",
+        )
+        parser.add_argument("--seed", type=int, default=1234)
+
+    def handle(self, *args, **options):
+        hmf_models = options["hmf_models"] or [c[0] for c in HMFForm.choices]
+        transfer_model = options["transfer_model"] or settings.HMFCALC_EMULATOR_TRANSFER
+
+        emulators = emulator.train(
+            hmf_models,
+            n_samples=options["samples"],
+            order=options["order"],
+            transfer_model=transfer_model,
+            seed=options["seed"],
+        )
+
+        for hmf_model, emu in emulators.items():
+            emulator.save(hmf_model, emu)
+            self.stdout.write(
+                "{}: max error in ln(dn/dm) {:.3g} (over {} valid mass bins)".format(
+                    hmf_model, emu["err_lndndm"][emu["valid"]].max(), emu["valid"].sum()
+                )
+            )
+
+        emulator.load.cache_clear()
@@ -0,0 +1,194 @@
+"""Pre-compute (and cache) models and plots for combinations of the built-in models."""
+import itertools
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+from HMFcalc import array_store, forms, utils
+from HMFcalc.views import HMFInputBase, get_keymap
+
+# The components whose choices are enumerated, and the form holding their choices.
+COMPONENTS = (
+    ("cosmo_model", forms.CosmoForm),
+    ("transfer_model", forms.TransferForm),
+    ("hmf_model", forms.HMFForm),
+    ("filter_model", forms.FilterForm),
+)
+
+# The label that models get by default when created with the input form.
+LABEL = forms.HMFInput.base_fields["label"].initial
+
+
+def combinations(choices):
+    """All combinations of the given choices for each component, as dicts."""
+    names = [name for name, _ in COMPONENTS]
+    for combo in itertools.product(*[choices[name] for name in names]):
+        yield dict(zip(names, combo))
+
+
+def warm(combo, plots, formats):
+    """
+    Compute and cache the model, and its plots, for one combination of models.
+
+    Returns a tuple of the status ("cached", "computed" or "invalid"), the time taken
+    to compute the model, and the time taken to render its plots.
+    """
+    form = forms.HMFInput(data=forms.HMFInput.default_data(**combo))
+    if not form.is_valid():
+        return "invalid: " + form.errors.as_text().replace("\n", " "), 0, 0
+
+    cls, hmf_dict = HMFInputBase().cleaned_data_to_hmf_dict(form)
+    key = utils.parameter_hash(cls, **hmf_dict)
+
+    if array_store.read_manifest(key) is not None:
+        objects = {LABEL: array_store.StoredModel(key, cls, hmf_dict, [])}
+        if all(
+            cache.get(utils.plot_cache_key(objects, q, fmt)) is not None
+            for q in plots
+            for fmt in formats
+        ):
+            return "cached", 0, 0
+
+    t0 = time.time()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        objects = {
+            LABEL: utils.stored_hmf_driver(cls=cls, quantities=plots, **hmf_dict)
+        }
+
+    t1 = time.time()
+    keymap = get_keymap()
+    for q in plots:
+        for fmt in formats:
+            utils.cached_canvas(objects, q, keymap[q], plot_format=fmt)
+
+    return "computed", t1 - t0, time.time() - t1
+
+
+class Command(BaseCommand):
+    help = (
+        "Compute models and plots for combinations of the built-in cosmologies, "
+        "transfer models, fitting functions and filters, so that they're cached "
+        "before anyone asks for them. Combinations already cached are skipped, so "
+        "the command may be interrupted and re-run. It's safe to run while the site "
+        "is live: it shares computations with (and writes atomically alongside) "
+        "the web workers."
+    )
+
+    def add_arguments(self, parser):
+        for name, form in COMPONENTS:
+            parser.add_argument(
+                "--" + name.replace("_model", ""),
+                nargs="+",
+                dest=name,
+                metavar=name.upper(),
+                help="{} to use, or 'all' (default: {}).".format(
+                    name, "all" if name == "hmf_model" else form._initial,
+                ),
+            )
+
+        parser.add_argument(
+            "--plots",
+            nargs="+",
+            default=["dndm"],
+            help="Plot types to render, or 'all' (default: dndm).",
+        )
+        parser.add_argument(
+            "--formats",
+            nargs="+",
+            default=["svg"],
+            choices=["png", "svg", "pdf"],
+            help="Plot formats to render (default: svg).",
+        )
+        parser.add_argument(
+            "--limit", type=int, default=None, help="Maximum combinations to warm."
+        )
+        parser.add_argument(
+            "-j", "--jobs", type=int, default=1, help="Number of parallel processes."
+        )
+        parser.add_argument(
+            "--nice",
+            type=int,
+            default=10,
+            help="Niceness of the processes, so as not to starve the web workers.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only list the combinations that would be warmed.",
+        )
+
+    def handle(self, *args, **options):
+        choices = {}
+        for name, form in COMPONENTS:
+            valid = [c[0] for c in form.choices]
+            given = options[name] or (["all"] if name == "hmf_model" else None)
+
+            if given is None:
+                choices[name] = [form._initial]
+            elif given == ["all"]:
+                choices[name] = valid
+            else:
+                bad = set(given) - set(valid)
+                if bad:
+                    raise CommandError(
+                        "Invalid {}: {}. Choose from {}.".format(
+                            name, ", ".join(bad), ", ".join(valid)
+                        )
+                    )
+                choices[name] = given
+
+        keymap = get_keymap()
+        plots = options["plots"]
+        if plots == ["all"]:
+            plots = [q for q in keymap if not q.startswith("comparison")]
+        bad = set(plots) - set(keymap)
+        if bad:
+            raise CommandError("Invalid plot types: {}".format(", ".join(bad)))
+
+        combos = list(itertools.islice(combinations(choices), options["limit"]))
+
+        if options["dry_run"]:
+            for combo in combos:
+                self.stdout.write(_describe(combo))
+            return
+
+        with ProcessPoolExecutor(
+            max_workers=options["jobs"],
+            initializer=os.nice,
+            initargs=(options["nice"],),
+        ) as pool:
+            futures = [
+                pool.submit(warm, combo, plots, options["formats"]) for combo in combos
+            ]
+
+            counts = {}
+            t0 = time.time()
+            for i, (combo, future) in enumerate(zip(combos, futures)):
+                try:
+                    status, t_model, t_plots = future.result()
+                except Exception as e:
+                    status, t_model, t_plots = "failed: {}".format(e), 0, 0
+
+                kind = status.split(":")[0]
+                counts[kind] = counts.get(kind, 0) + 1
+                self.stdout.write(
+                    "[{}/{}] {}: {} (model {:.2f}s, plots {:.2f}s)".format(
+                        i + 1, len(combos), _describe(combo), status, t_model, t_plots
+                    )
+                )
+
+        self.stdout.write(
+            "Done in {:.1f}s: {}".format(
+                time.time() - t0,
+                ", ".join("{} {}".format(v, k) for k, v in sorted(counts.items())),
+            )
+        )
+
+
+def _describe(combo):
+    return " ".join("{}={}".format(k, v) for k, v in combo.items())
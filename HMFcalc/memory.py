@@ -0,0 +1,144 @@
+"""
+Diagnostics of the memory used by sessions and models.
+
+Reports how large each session is when pickled (as it is on every request), how
+large each model is, and which of its cached attributes dominate, and the memory
+allocated while computing models and rendering plots. All of it is only collected
+when ``HMFCALC_MEMORY_DEBUG`` is on, since it's costly, and is shown on a debug page
+(see :func:`~HMFcalc.views.memory_report`). Anything larger than
+``HMFCALC_MEMORY_LOG_BYTES`` is also logged.
+
+Allocations are traced with :mod:`tracemalloc`, which is started once per process
+and traces every thread at once. Peaks are thus only measured in sandboxed children
+(see :mod:`~HMFcalc.sandbox`), which run one job at a time. Elsewhere, concurrent
+requests would reset each other's peaks, so only the memory that a block allocates
+and still holds at its end is measured, which is only indicative.
+"""
+import contextlib
+import logging
+import pickle
+import threading
+import tracemalloc
+
+import numpy as np
+from django.conf import settings
+
+from . import array_store, sandbox
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_peaks = {}
+_session_sizes = []
+
+
+def pickled_size(obj):
+    """The size (in bytes) of an object when pickled, or None if it can't be."""
+    try:
+        return len(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return None
+
+
+def attribute_sizes(obj):
+    """
+    The size of each cached attribute of a model, largest first.
+
+    Arrays are measured by their size in memory, and everything else by its pickled
+    size. For stored models, these are the stored arrays, and the attributes of the
+    full framework (if it's been loaded).
+    """
+    sizes = {}
+    if isinstance(obj, array_store.StoredModel):
+        for q, digest in obj.manifest["arrays"].items():
+            sizes[q] = array_store.get_array(digest).nbytes
+        obj = obj.__dict__.get("_framework")
+
+    for name, value in vars(obj).items() if obj is not None else ():
+        if isinstance(value, np.ndarray):
+            sizes[name] = value.nbytes
+        else:
+            sizes[name] = pickled_size(value)
+
+    return sorted(sizes.items(), key=lambda kv: -(kv[1] or 0))
+
+
+def _log_if_large(what, nbytes):
+    if nbytes is not None and nbytes > settings.HMFCALC_MEMORY_LOG_BYTES:
+        logger.warning("%s is large: %.1f MiB", what, nbytes / 2 ** 20)
+
+
+def record_session(session):
+    """Record (and return) the pickled size of a session."""
+    size = pickled_size(dict(session.items()))
+    with _lock:
+        _session_sizes.append(size)
+        del _session_sizes[:-100]
+    _log_if_large("Session {}".format(session.session_key), size)
+    return size
+
+
+def start():
+    """Start tracing allocations in this process, if it isn't already."""
+    if settings.HMFCALC_MEMORY_DEBUG and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def record(name, nbytes):
+    """Record the memory used by a call of ``name`` (if it was measured)."""
+    if nbytes is None:
+        return
+
+    with _lock:
+        _, highest, count = _peaks.get(name, (0, 0, 0))
+        _peaks[name] = (nbytes, max(highest, nbytes), count + 1)
+    _log_if_large("Memory of {}".format(name), nbytes)
+
+
+def measure(fn, *args, **kwargs):
+    """
+    Call ``fn(*args, **kwargs)``, returning its result and the memory it used.
+
+    In a sandboxed child, this is the peak memory allocated during the call;
+    elsewhere, it's the memory allocated and still held after it. The memory is None
+    if ``HMFCALC_MEMORY_DEBUG`` is off.
+    """
+    if not settings.HMFCALC_MEMORY_DEBUG:
+        return fn(*args, **kwargs), None
+
+    start()
+    exclusive = sandbox._in_child
+    if exclusive:
+        tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+
+    result = fn(*args, **kwargs)
+    current, peak = tracemalloc.get_traced_memory()
+    return result, (peak if exclusive else current) - before
+
+
+@contextlib.contextmanager
+def trace(name):
+    """Record the memory used within the block (as for :func:`measure`), as ``name``."""
+    if not settings.HMFCALC_MEMORY_DEBUG:
+        yield
+        return
+
+    start()
+    before = tracemalloc.get_traced_memory()[0]
+    try:
+        yield
+    finally:
+        record(name, tracemalloc.get_traced_memory()[0] - before)
+
+
+def peaks():
+    """The last and highest memory used, and number of calls, of each traced block."""
+    with _lock:
+        return dict(_peaks)
+
+
+def session_sizes():
+    """The pickled sizes of the most recent sessions recorded."""
+    with _lock:
+        return list(_session_sizes)
@@ -0,0 +1,61 @@
+"""
+Cheap, in-process metrics for this worker, reported by the health check.
+
+Everything here is held in memory and updated under a lock, so that recording a
+metric costs next to nothing and reading them needs no I/O.
+"""
+import os
+import threading
+import time
+from collections import Counter, deque
+
+import numpy as np
+
+START_TIME = time.time()
+
+_lock = threading.Lock()
+_counters = Counter()
+_latencies = deque(maxlen=1000)
+
+
+def incr(name, n=1):
+    """Increment the counter ``name`` by ``n``."""
+    with _lock:
+        _counters[name] += n
+
+
+def record_latency(seconds):
+    """Record the time taken to serve a request."""
+    with _lock:
+        _latencies.append(seconds)
+
+
+def latency_percentile(p):
+    """The ``p``-th percentile of recent request latencies (seconds), or None."""
+    with _lock:
+        if not _latencies:
+            return None
+        return float(np.percentile(_latencies, p))
+
+
+def hit_rate(name):
+    """Fraction of lookups of ``name`` that were hits, or None if none were made."""
+    with _lock:
+        hits = _counters[name + "_hit"]
+        total = hits + _counters[name + "_miss"]
+    return hits / total if total else None
+
+
+def snapshot():
+    """Return a copy of all counters."""
+    with _lock:
+        return dict(_counters)
+
+
+def worker_info():
+    """Basic liveness information about this worker process."""
+    return {
+        "pid": os.getpid(),
+        "uptime": time.time() - START_TIME,
+        "threads": threading.active_count(),
+    }
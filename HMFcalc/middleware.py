@@ -0,0 +1,156 @@
+"""Middleware for HMFcalc."""
+import json
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from . import compression, memory, metrics, sandbox, singleflight, staticfiles
+
+logger = logging.getLogger(__name__)
+
+
+def _heartbeat_age():
+    """Seconds since the celery heartbeat was last written, or None."""
+    try:
+        return time.time() - os.path.getmtime(settings.HMFCALC_HEARTBEAT_FILE)
+    except OSError:
+        return None
+
+
+def health_report():
+    """
+    A JSON-able summary of the health of this worker.
+
+    Everything but the heartbeat is of this worker process alone: eg. ``compute``
+    counts its busy and waited-for compute slots (see :func:`sandbox.load`), and the
+    models it's leading the computation of for others (see :mod:`singleflight`).
+    """
+    heartbeat_age = _heartbeat_age()
+    heartbeat_ok = (
+        heartbeat_age is not None
+        and heartbeat_age < settings.HMFCALC_HEARTBEAT_MAX_AGE
+    )
+    return {
+        "status": "ok" if heartbeat_ok else "degraded",
+        "worker": metrics.worker_info(),
+        "compute": dict(sandbox.load(), in_flight=singleflight.in_flight()),
+        "cache_hit_rate": metrics.hit_rate("result_cache"),
+        "latency_p95": metrics.latency_percentile(95),
+        "heartbeat_age": heartbeat_age,
+        "counters": metrics.snapshot(),
+    }
+
+
+class HealthMiddleware:
+    """
+    Record request latencies, and answer health probes.
+
+    This should be first in ``MIDDLEWARE``, so that health probes are answered
+    before any session, CSRF or view machinery is touched. They are thus cheap
+    enough to be made every few seconds.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.path == settings.HMFCALC_HEALTH_URL:
+            return HttpResponse(
+                json.dumps(health_report()), content_type="application/json"
+            )
+
+        start = time.monotonic()
+        response = self.get_response(request)
+        metrics.record_latency(time.monotonic() - start)
+        metrics.incr("requests")
+        return response
+
+
+class StaticFilesMiddleware:
+    """
+    Serve collected static files, with far-future caching and precompression.
+
+    Only used when ``DEBUG`` is off (in development, ``runserver`` serves them). It
+    should come straight after :class:`HealthMiddleware`, so that static files skip
+    the session and CSRF machinery.
+    """
+
+    def __init__(self, get_response):
+        if settings.DEBUG:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.path.startswith(settings.STATIC_URL):
+            return staticfiles.serve(request, request.path[len(settings.STATIC_URL) :])
+        return self.get_response(request)
+
+
+class CompressionMiddleware:
+    """
+    Compress text-like responses (SVG plots, parameter and ASCII files etc.).
+
+    The encoding is chosen by the client's Accept-Encoding. Responses smaller than
+    ``HMFCALC_COMPRESS_MIN_BYTES``, or of types that are already compressed (PNG,
+    zip etc.), or that are already encoded (eg. cached plots) are left alone.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+
+        if (
+            response.streaming
+            or response.has_header("Content-Encoding")
+            or len(response.content) < settings.HMFCALC_COMPRESS_MIN_BYTES
+            or not compression.compressible(response.get("Content-Type"))
+        ):
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        encoding = compression.accepted_encoding(request)
+        if encoding is None:
+            return response
+
+        compressed = compression.compress(response.content, encoding)
+        if len(compressed) >= len(response.content):
+            return response
+
+        metrics.incr("compressed_bytes_saved", len(response.content) - len(compressed))
+        response.content = compressed
+        response["Content-Length"] = str(len(compressed))
+        response["Content-Encoding"] = encoding
+
+        # The ETag of the uncompressed content is only weakly valid for this.
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response["ETag"] = "W/" + etag
+        return response
+
+
+class MemoryMiddleware:
+    """
+    Record the pickled size of each request's session (see :mod:`~HMFcalc.memory`).
+
+    Only used when ``HMFCALC_MEMORY_DEBUG`` is on. It should come after the session
+    middleware.
+    """
+
+    def __init__(self, get_response):
+        if not settings.HMFCALC_MEMORY_DEBUG:
+            raise MiddlewareNotUsed
+        memory.start()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if hasattr(request, "session") and request.session.accessed:
+            memory.record_session(request.session)
+        return response
@@ -0,0 +1,56 @@
+"""
+Import and set up, once, everything that's slow to.
+
+Most of it is otherwise done on first use (matplotlib, for instance, is only
+imported when something is first plotted), so that management commands and tests
+start quickly. A server should instead do it all before forking its workers, by
+calling :func:`preload` (which wsgi.py does, if ``HMFCALC_PRELOAD`` is on), so that
+the workers share it copy-on-write rather than each having a private copy.
+
+Use the ``startup_benchmark`` command to see what's slow to import.
+"""
+import gc
+import importlib
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Modules imported in advance: the views (and all of hmf with them), and matplotlib.
+MODULES = (
+    "HMFcalc.urls",
+    "matplotlib.figure",
+    "matplotlib.backends.backend_agg",
+    "matplotlib.backends.backend_pdf",
+    "matplotlib.backends.backend_svg",
+)
+
+
+def preload():
+    """Import everything that's slow to, and fill the tables that are lazily filled."""
+    t0 = time.time()
+    for name in MODULES:
+        importlib.import_module(name)
+
+    import hmf
+    from . import forms, utils
+
+    # The built-in cosmologies are read from file by astropy when first used.
+    for name, _ in forms.CosmoForm.choices:
+        getattr(hmf.cosmo, name)
+
+    # The input form introspects the parameters of every model it offers.
+    forms.HMFInput()
+
+    # Render a figure, to load matplotlib's fonts and caches.
+    fig = utils._figure(figsize=(1, 1))
+    fig.add_subplot(111).set_xlabel("M")
+    utils.print_figure(fig, "png")
+
+    # Keep everything loaded so far out of garbage collections, which would otherwise
+    # touch (and so copy) every page of it in each worker.
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+    logger.info("Preloaded in %.2fs", time.time() - t0)
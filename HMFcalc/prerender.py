@@ -0,0 +1,124 @@
+"""
+Speculative rendering of the plots a user is likely to look at next.
+
+Right after a session's models change, the plots that are most often viewed are
+rendered in a background thread, into the shared plot cache (see
+:func:`~HMFcalc.utils.cached_canvas`), so that they're ready by the time they're
+asked for. Plots are ranked by how often each (type and format) has been viewed by
+this process, and until that's known, by ``HMFCALC_PRERENDER_PRIOR``.
+
+Each session's pre-rendering is cancelled when its models change again: a token for
+the latest models is kept in the shared cache, and a job stops as soon as it's no
+longer the latest (in whichever process it's running).
+"""
+import logging
+import threading
+import uuid
+import warnings
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics, utils
+
+logger = logging.getLogger(__name__)
+
+LATEST_PREFIX = "hmfcalc-prerender:"
+
+_lock = threading.Lock()
+_executor = None
+_views = Counter()
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.HMFCALC_PRERENDER_WORKERS,
+                thread_name_prefix="hmfcalc-prerender",
+            )
+        return _executor
+
+
+def record_view(plottype, filetype):
+    """Record that a plot was viewed."""
+    with _lock:
+        _views[plottype + "." + filetype] += 1
+
+
+def ranking():
+    """
+    All plots viewed (as ``"<plottype>.<filetype>"``), most viewed first.
+
+    Plots in ``HMFCALC_PRERENDER_PRIOR`` are included in its order, but are outranked
+    by any plot that's been viewed more often.
+    """
+    with _lock:
+        counts = Counter(_views)
+
+    prior = settings.HMFCALC_PRERENDER_PRIOR
+    for i, plot in enumerate(prior):
+        counts[plot] += (len(prior) - i) / (len(prior) + 1)
+    return [plot for plot, _ in counts.most_common()]
+
+
+def _client(session):
+    if "prerender_id" not in session:
+        session["prerender_id"] = uuid.uuid4().hex
+    return session["prerender_id"]
+
+
+def schedule(session, objects, keymap):
+    """
+    Pre-render the most viewed plots of a session's models, in the background.
+
+    Any pre-rendering for the session's previous models is cancelled. Only plots of
+    stored models (which are cached) are pre-rendered. Returns the future of the
+    job, or None if there's nothing to do.
+    """
+    key = LATEST_PREFIX + _client(session)
+    token = uuid.uuid4().hex
+    cache.set(key, token, settings.HMFCALC_RESULT_CACHE_TIMEOUT)
+
+    if None in [getattr(o, "key", None) for o in objects.values()]:
+        return None
+
+    plots = []
+    for plot in ranking():
+        plottype, _, filetype = plot.rpartition(".")
+        if plottype.startswith("comparison") and len(objects) < 2:
+            continue
+        if plottype in keymap:
+            plots.append((plottype, filetype))
+    plots = plots[: settings.HMFCALC_PRERENDER_PLOTS]
+    if not plots:
+        return None
+
+    def render():
+        for plottype, filetype in plots:
+            if cache.get(key) != token:
+                metrics.incr("prerender_cancelled")
+                logger.info("Pre-rendering cancelled: the models have changed")
+                return
+
+            if cache.has_key(utils.plot_cache_key(objects, plottype, filetype)):
+                continue
+
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                utils.cached_canvas(
+                    objects, plottype, keymap[plottype], plot_format=filetype
+                )
+            metrics.incr("prerendered")
+
+    future = _get_executor().submit(render)
+    future.add_done_callback(_done)
+    return future
+
+
+def _done(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Pre-rendering failed: %s", future.exception())
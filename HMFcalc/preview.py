@@ -0,0 +1,134 @@
+"""
+Live previews of the mass function, while a model's parameters are being edited.
+
+Each preview is computed in two passes. First, a coarse version of the model (with
+a large mass and wavenumber step, and a cheap transfer model where one may stand in
+for the requested one) is computed and returned straight away. Then the model is
+computed at the requested resolution in a background thread, and written to the
+array store, whence the client fetches it when it's ready -- and whence it's
+re-used if the model is then actually created. Coarse versions are throwaway, so
+they bypass the shared result cache (though they're still run in the sandbox).
+
+Previews are debounced by the client, and each client numbers its requests: a
+request that has been superseded by a newer one is dropped, as is any of the
+client's refinements that hasn't started yet.
+"""
+import logging
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from . import array_store, sandbox, utils
+
+logger = logging.getLogger(__name__)
+
+LATEST_PREFIX = "hmfcalc-preview:"
+
+_lock = threading.Lock()
+_executor = None
+_pending = {}
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.HMFCALC_PREVIEW_WORKERS,
+                thread_name_prefix="hmfcalc-preview",
+            )
+        return _executor
+
+
+def is_latest(client, seq):
+    """
+    Register request number ``seq`` of a client.
+
+    Returns whether it's the client's latest request (ie. hasn't been superseded).
+    """
+    key = LATEST_PREFIX + client
+    if seq < (cache.get(key) or 0):
+        return False
+
+    cache.set(key, seq, 3600)
+    return True
+
+
+def coarse_kwargs(hmf_dict):
+    """Parameters of a cheaper, lower-resolution version of a model."""
+    coarse = dict(hmf_dict)
+    coarse["dlog10m"] = max(
+        hmf_dict.get("dlog10m", 0), settings.HMFCALC_PREVIEW_DLOG10M
+    )
+    coarse["dlnk"] = max(hmf_dict.get("dlnk", 0), settings.HMFCALC_PREVIEW_DLNK)
+
+    cheap = settings.HMFCALC_PREVIEW_TRANSFER.get(hmf_dict.get("transfer_model"))
+    if cheap is not None:
+        coarse["transfer_model"] = cheap
+        coarse.pop("transfer_params", None)
+    return coarse
+
+
+def _coarse(cls, kwargs):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return utils.materialise(utils.hmf_driver(cls=cls, **kwargs), ("m", "dndm"))
+
+
+def coarse(cls, hmf_dict):
+    """Compute the coarse version of a model (in the sandbox, but not cached)."""
+    return sandbox.run(_coarse, cls, coarse_kwargs(hmf_dict))
+
+
+def refined(key):
+    """The stored (full-resolution) ``m`` and ``dndm`` of a model, or None."""
+    manifest = array_store.read_manifest(key)
+    if manifest is None or "dndm" not in manifest["arrays"]:
+        return None
+
+    return tuple(array_store.get_array(manifest["arrays"][q]) for q in ("m", "dndm"))
+
+
+def refine(client, cls, hmf_dict):
+    """
+    Compute a model at full resolution in the background.
+
+    Any of the client's refinements that haven't started yet are cancelled. Returns
+    the key under which the model will be stored (see :func:`refined`).
+    """
+    key = utils.parameter_hash(cls, **hmf_dict)
+
+    def compute():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            utils.stored_hmf_driver(cls=cls, quantities=("dndm",), **hmf_dict)
+
+    future = _get_executor().submit(compute)
+    future.add_done_callback(lambda f: _done(key, f))
+
+    with _lock:
+        previous = _pending.get(client)
+        _pending[client] = future
+    if previous is not None:
+        previous.cancel()
+
+    return key
+
+
+def _done(key, future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Refining preview %s failed: %s", key, future.exception())
+
+    with _lock:
+        for client, f in list(_pending.items()):
+            if f is future:
+                del _pending[client]
+
+
+def as_json(a):
+    """An array as a JSON-able list, with non-finite values as None."""
+    return [float(v) if np.isfinite(v) else None for v in a]
@@ -0,0 +1,296 @@
+"""
+Computations run in child processes, with limits on their time and memory.
+
+Some parameters make CAMB, or the integrals of sigma, take practically forever or
+use memory without bound. Models are therefore computed in a pool of (at most
+``HMFCALC_COMPUTE_WORKERS``) child processes of each web worker, which are killed if
+a job takes longer than ``HMFCALC_COMPUTE_TIMEOUT`` seconds, or grows the child's
+resident memory by more than ``HMFCALC_COMPUTE_MAX_RSS`` bytes. Since memory is
+only checked every :data:`POLL_INTERVAL`, each child's address space is also limited
+(with ``RLIMIT_AS``) to twice that more than it started with. The job then fails
+with :class:`ComputeLimitExceeded`, which is shown to the user like a form error.
+
+Children are forked from the web worker (so start instantly, sharing everything it
+has preloaded), and are retired after ``HMFCALC_COMPUTE_MAX_JOBS`` jobs, so that
+memory they've fragmented is returned. Each child closes the ends of its siblings'
+pipes that it inherits, so that they see the end of their pipe when retired. Metrics counted by a job are passed back to
+the web worker. Memory is measured from ``/proc``, so is only limited on Linux.
+"""
+import logging
+import multiprocessing
+import os
+import resource
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# How often (seconds) a running job's time and memory are checked.
+POLL_INTERVAL = 0.05
+
+_lock = threading.Lock()
+_idle = []
+# This process's ends of the pipes to all its children.
+_conns = set()
+# Held while forking, so that no pipe is missing from _conns.
+_fork_lock = threading.Lock()
+_slots = None
+_busy = 0
+_waiting = 0
+
+# Whether this is a child, which runs anything it's asked to itself.
+_in_child = False
+
+
+class ComputeLimitExceeded(Exception):
+    """A computation was stopped for using too much time or memory."""
+
+
+class ComputeBusy(ComputeLimitExceeded):
+    """No child was free to run a computation in time."""
+
+
+def _memory_exceeded():
+    return ComputeLimitExceeded(
+        "The calculation used more than {:.0f} MiB of memory, so was stopped. Try a "
+        "smaller range or a coarser resolution.".format(
+            settings.HMFCALC_COMPUTE_MAX_RSS / 2 ** 20
+        )
+    )
+
+
+def _limit_memory():
+    """
+    Limit the address space of this process to its current size, plus twice
+    ``HMFCALC_COMPUTE_MAX_RSS``.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            size = int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return
+
+    # Not all of the address space is used, so leave room beyond the memory limit.
+    limit = size + 2 * settings.HMFCALC_COMPUTE_MAX_RSS
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _serve(conn, inherited):
+    """
+    Run jobs sent down ``conn``, sending back each result, until it's closed.
+
+    ``inherited`` are the parent's ends of pipes, which are closed here.
+    """
+    global _in_child
+    _in_child = True
+
+    for other in inherited:
+        other.close()
+    _limit_memory()
+
+    while True:
+        try:
+            fn, args, kwargs = conn.recv()
+        except EOFError:
+            return
+
+        before = metrics.snapshot()
+        try:
+            result = (True, fn(*args, **kwargs))
+        except MemoryError:
+            result = (False, _memory_exceeded())
+        except Exception as e:
+            result = (False, e)
+
+        after = metrics.snapshot()
+        counters = {k: v - before.get(k, 0) for k, v in after.items()}
+        try:
+            conn.send(result + (counters,))
+        except Exception as e:
+            # The result (or exception) couldn't be pickled.
+            conn.send((False, RuntimeError(str(e)), counters))
+
+
+class _Worker:
+    def __init__(self):
+        with _fork_lock:
+            self.conn, child = multiprocessing.Pipe()
+            _conns.add(self.conn)
+            self.process = multiprocessing.Process(
+                target=_serve, args=(child, list(_conns)), daemon=True
+            )
+            self.process.start()
+        child.close()
+        self.jobs = 0
+
+    def rss(self):
+        """The resident memory (bytes) of the process, or None if unknown."""
+        try:
+            with open("/proc/{}/statm".format(self.process.pid)) as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            return None
+
+    def close(self):
+        with _fork_lock:
+            _conns.discard(self.conn)
+            self.conn.close()
+
+    def stop(self):
+        """Stop the process, once it's finished its job, or forcibly if it doesn't."""
+        self.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+    def kill(self):
+        self.close()
+        self.process.kill()
+        self.process.join()
+
+
+def _get_slots():
+    global _slots
+    with _lock:
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(settings.HMFCALC_COMPUTE_WORKERS)
+        return _slots
+
+
+def load():
+    """
+    The compute slots of this process: how many there are, are in use, and are waited
+    for (by jobs that are queued for a free child).
+    """
+    with _lock:
+        return {
+            "workers": settings.HMFCALC_COMPUTE_WORKERS,
+            "busy": _busy,
+            "waiting": _waiting,
+        }
+
+
+def _count(busy=0, waiting=0):
+    global _busy, _waiting
+    with _lock:
+        _busy += busy
+        _waiting += waiting
+
+
+def _checkout():
+    with _lock:
+        if _idle:
+            return _idle.pop()
+    return _Worker()
+
+
+def _checkin(worker):
+    worker.jobs += 1
+    if worker.jobs >= settings.HMFCALC_COMPUTE_MAX_JOBS:
+        logger.info("Retiring compute worker %s", worker.process.pid)
+        worker.stop()
+    else:
+        with _lock:
+            _idle.append(worker)
+
+
+def _wait(worker):
+    """Wait for a worker's result, killing it if it exceeds a limit."""
+    t0 = time.time()
+    rss0 = worker.rss()
+
+    while not worker.conn.poll(POLL_INTERVAL):
+        if not worker.process.is_alive():
+            raise ComputeLimitExceeded(
+                "The calculation stopped unexpectedly (exit code {}).".format(
+                    worker.process.exitcode
+                )
+            )
+
+        if time.time() - t0 > settings.HMFCALC_COMPUTE_TIMEOUT:
+            raise ComputeLimitExceeded(
+                "The calculation took longer than {:g} seconds, so was stopped. "
+                "Try a smaller range or a coarser resolution.".format(
+                    settings.HMFCALC_COMPUTE_TIMEOUT
+                )
+            )
+
+        rss = worker.rss()
+        if rss0 is not None and rss is not None:
+            if rss - rss0 > settings.HMFCALC_COMPUTE_MAX_RSS:
+                raise _memory_exceeded()
+
+    try:
+        return worker.conn.recv()
+    except (EOFError, OSError):
+        # The child died (closing its end of the pipe) before sending a result.
+        worker.process.join(1)
+        raise ComputeLimitExceeded(
+            "The calculation stopped unexpectedly (exit code {}).".format(
+                worker.process.exitcode
+            )
+        )
+
+
+def run(fn, *args, **kwargs):
+    """
+    Call ``fn(*args, **kwargs)`` in a child process, and return its result.
+
+    ``fn``, its arguments and its result must be picklable. Exceptions raised by
+    ``fn`` are re-raised. If ``HMFCALC_COMPUTE_WORKERS`` is 0, or this is already a
+    child, ``fn`` is simply called in this process (without further limits).
+
+    Raises
+    ------
+    ComputeLimitExceeded
+        If the call takes too long or uses too much memory, or no child is free to
+        run it within the time limit.
+    """
+    if not settings.HMFCALC_COMPUTE_WORKERS or _in_child:
+        return fn(*args, **kwargs)
+
+    slots = _get_slots()
+    _count(waiting=1)
+    try:
+        acquired = slots.acquire(timeout=settings.HMFCALC_COMPUTE_TIMEOUT)
+    finally:
+        _count(waiting=-1)
+    if not acquired:
+        metrics.incr("compute_busy")
+        raise ComputeBusy(
+            "The server is too busy to do this calculation. Please try again later."
+        )
+
+    _count(busy=1)
+    try:
+        worker = _checkout()
+        try:
+            worker.conn.send((fn, args, kwargs))
+            ok, value, counters = _wait(worker)
+        except BaseException as e:
+            if isinstance(e, ComputeLimitExceeded):
+                metrics.incr("compute_killed")
+                logger.warning("Killed compute worker %s: %s", worker.process.pid, e)
+            worker.kill()
+            raise
+
+        _checkin(worker)
+    finally:
+        _count(busy=-1)
+        slots.release()
+
+    for name, n in counters.items():
+        if n:
+            metrics.incr(name, n)
+
+    if not ok:
+        raise value
+    return value
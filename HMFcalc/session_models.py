@@ -0,0 +1,254 @@
+"""
+The models held in a user's session, with a quota on how many are kept there.
+
+Each session may hold at most ``HMFCALC_SESSION_MAX_MODELS`` models, whose arrays
+total at most ``HMFCALC_SESSION_MAX_BYTES``. Models in the array store (see
+:class:`array_store.StoredModel`) don't count towards the latter, since the session
+holds none of their arrays. When either is exceeded, the least recently viewed models are spilled: their entries (the
+model and its form data) are moved out of the session, to a local on-disk store in
+``HMFCALC_SPILL_DIR``, leaving only a small :class:`SpilledModel` marker behind.
+Spilled models are loaded back transparently whenever they're needed.
+
+Concurrent requests may hold older copies of a session, so spill files are never
+changed or removed once written, but left for :func:`clean_spilled` (see the
+``clean_spill`` command) to remove once no session can still be using them.
+
+Sessions hold ``objects`` (an ordered dict of models, by label, in the order they
+were created) and ``forms`` (the form data each was created with), which should be
+accessed via the functions here, rather than directly.
+"""
+import logging
+import os
+import pickle
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+from . import array_store
+
+logger = logging.getLogger(__name__)
+
+
+class SpilledModel:
+    """
+    Marker, held in the session, for a model that's been spilled to disk.
+
+    ``key`` is the parameter hash of the model, if it's stored (see
+    :mod:`~HMFcalc.array_store`).
+    """
+
+    def __init__(self, nbytes, name, key=None):
+        self.nbytes = nbytes
+        self.name = name
+        self.key = key
+
+
+def footprint(obj):
+    """The size (in bytes) of the arrays of a model."""
+    if isinstance(obj, SpilledModel):
+        return obj.nbytes
+    if isinstance(obj, array_store.StoredModel):
+        return sum(
+            array_store.get_array(digest).nbytes
+            for digest in obj.manifest["arrays"].values()
+        )
+    return sum(v.nbytes for v in vars(obj).values() if isinstance(v, np.ndarray))
+
+
+def _session_bytes(obj):
+    """The size (in bytes) of the arrays of a model that are held in the session."""
+    if isinstance(obj, array_store.StoredModel):
+        # Its arrays are memory-mapped from the store, so spilling it frees nothing.
+        return 0
+    return footprint(obj)
+
+
+def _spill_path(session, name):
+    if "spill_id" not in session:
+        session["spill_id"] = uuid.uuid4().hex
+    return os.path.join(settings.HMFCALC_SPILL_DIR, session["spill_id"], name + ".pkl")
+
+
+def _touch(session, label):
+    """Mark a model as the most recently viewed."""
+    recent = [name for name in session.get("recent", []) if name != label]
+    session["recent"] = recent + [label]
+
+
+def _spill(session, label):
+    obj = session["objects"][label]
+    name = uuid.uuid4().hex
+    path = _spill_path(session, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        pickle.dump((obj, session["forms"].get(label)), f)
+
+    session["objects"][label] = SpilledModel(
+        footprint(obj), name, getattr(obj, "key", None)
+    )
+    session["forms"].pop(label, None)
+    session.modified = True
+    logger.info("Spilled model %s to %s", label, path)
+
+
+def _unspill(session, label):
+    """
+    Read a spilled model (and its form data) back from disk.
+
+    Returns ``(None, None)`` if the file has been cleaned up.
+    """
+    path = _spill_path(session, session["objects"][label].name)
+    try:
+        with open(path, "rb") as f:
+            spilled = pickle.load(f)
+    except FileNotFoundError:
+        logger.warning("Spilled model %s is gone from %s", label, path)
+        return None, None
+
+    # Mark it as still in use.
+    os.utime(path)
+    return spilled
+
+
+def _enforce_quota(session):
+    """Spill the least recently viewed models until the session is within quota."""
+    objects = session["objects"]
+    resident = [
+        label for label, o in objects.items() if not isinstance(o, SpilledModel)
+    ]
+
+    recent = session.get("recent", [])
+    resident.sort(key=lambda label: recent.index(label) if label in recent else -1)
+
+    total = sum(_session_bytes(objects[label]) for label in resident)
+
+    # Always keep the most recently viewed model.
+    while len(resident) > 1 and (
+        len(resident) > settings.HMFCALC_SESSION_MAX_MODELS
+        or total > settings.HMFCALC_SESSION_MAX_BYTES
+    ):
+        label = resident.pop(0)
+        total -= _session_bytes(objects[label])
+        _spill(session, label)
+
+
+def labels(session):
+    """The labels of all models in the session, in order of creation."""
+    return list(session.get("objects", {}).keys())
+
+
+def get_model(session, label, default=None):
+    """
+    Get a single model (eg. for viewing or editing), loading it back if spilled.
+
+    The model is marked as the most recently viewed.
+    """
+    objects = session.get("objects", {})
+    if label not in objects:
+        return default
+
+    obj = objects[label]
+    if isinstance(obj, SpilledModel):
+        obj, form_data = _unspill(session, label)
+        if obj is None:
+            delete_model(session, label)
+            return default
+
+        objects[label] = obj
+        session["forms"][label] = form_data
+
+    _touch(session, label)
+    _enforce_quota(session)
+    session.modified = True
+    return obj
+
+
+def get_models(session):
+    """
+    All models in the session (eg. for plotting or exporting), by label.
+
+    Spilled models are read from disk, but remain spilled. Any that have been
+    cleaned up are left out.
+    """
+    objects = OrderedDict()
+    for label, obj in session.get("objects", {}).items():
+        if isinstance(obj, SpilledModel):
+            obj = _unspill(session, label)[0]
+        if obj is not None:
+            objects[label] = obj
+    return objects
+
+
+def get_form(session, label):
+    """The form data a model was created with."""
+    if isinstance(session.get("objects", {}).get(label), SpilledModel):
+        return _unspill(session, label)[1]
+    return session.get("forms", {}).get(label)
+
+
+def set_model(session, label, obj, form_data=None):
+    """Add (or replace) a model in the session."""
+    if "objects" not in session:
+        session["objects"] = OrderedDict()
+    if "forms" not in session:
+        session["forms"] = OrderedDict()
+
+    session["objects"][label] = obj
+    session["forms"][label] = form_data
+    _touch(session, label)
+    _enforce_quota(session)
+    session.modified = True
+
+
+def delete_model(session, label):
+    """Remove a model from the session (if it's there)."""
+    session.get("objects", {}).pop(label, None)
+    session.get("forms", {}).pop(label, None)
+    session["recent"] = [name for name in session.get("recent", []) if name != label]
+    session.modified = True
+
+
+def clear(session):
+    """Remove all models from the session."""
+    for key in ("objects", "forms", "recent", "spill_id"):
+        session.pop(key, None)
+
+
+def clean_spilled(max_age):
+    """
+    Remove spill files that haven't been used for ``max_age`` seconds.
+
+    Files are marked as used whenever they're read, so this should be at least the
+    age at which sessions expire. Returns the number of files removed.
+    """
+    removed = 0
+    cutoff = time.time() - max_age
+    for dirpath, _, filenames in os.walk(settings.HMFCALC_SPILL_DIR, topdown=False):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+
+        if dirpath != settings.HMFCALC_SPILL_DIR:
+            try:
+                if os.path.getmtime(dirpath) < cutoff:
+                    os.rmdir(dirpath)
+            except OSError:
+                # Not empty (or already gone).
+                pass
+    return removed
+
+
+def footprints(session):
+    """The footprint of each model, and whether it's spilled, by label."""
+    return OrderedDict(
+        (label, (footprint(obj), isinstance(obj, SpilledModel)))
+        for label, obj in session.get("objects", {}).items()
+    )
@@ -0,0 +1,176 @@
+"""
+Single-flight deduplication of identical in-flight computations.
+
+When many sessions submit the same parameters at once (eg. a class all opening the
+calculator together), we only want *one* of them to actually run the calculation.
+Calls are keyed by a canonical hash of their parameters. Within a process, concurrent
+callers with the same key wait on the leader's result. Across worker processes, the
+leader takes a lock in the shared cache (see ``CACHES`` in settings) and publishes its
+result there, so that followers in other processes can pick it up.
+
+Followers never wait forever: if the leader fails or takes longer than the timeout,
+they fall back to running the computation themselves. The exception is a leader
+whose computation was stopped for exceeding a limit of the sandbox (see
+:mod:`~HMFcalc.sandbox`): re-running it would only be stopped again, so the failure
+is recorded in the shared cache (for ``HMFCALC_FAILED_CACHE_TIMEOUT`` seconds), and
+raised by followers and later callers instead.
+"""
+import copy
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import sandbox
+
+logger = logging.getLogger(__name__)
+
+RESULT_PREFIX = "hmfcalc-result:"
+LOCK_PREFIX = "hmfcalc-lock:"
+FAILED_PREFIX = "hmfcalc-failed:"
+
+_lock = threading.Lock()
+_inflight = {}
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class _Call:
+    """An in-flight computation that other threads can wait on."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def get_result(key):
+    """Return the result stored in the shared cache under ``key``, or None."""
+    return cache.get(RESULT_PREFIX + key)
+
+
+def set_result(key, value):
+    """Store a result in the shared cache under ``key``."""
+    cache.set(
+        RESULT_PREFIX + key, value, _setting("HMFCALC_RESULT_CACHE_TIMEOUT", 86400)
+    )
+
+
+def release_result(key):
+    """Let the result under ``key`` expire, once followers have had time to get it."""
+    cache.touch(RESULT_PREFIX + key, _setting("HMFCALC_SINGLEFLIGHT_TIMEOUT", 120))
+
+
+def set_failure(key, error):
+    """Record that the computation under ``key`` exceeded a limit of the sandbox."""
+    cache.set(
+        FAILED_PREFIX + key, str(error), _setting("HMFCALC_FAILED_CACHE_TIMEOUT", 600)
+    )
+
+
+def _raise_failure(key):
+    message = cache.get(FAILED_PREFIX + key)
+    if message is not None:
+        raise sandbox.ComputeLimitExceeded(message)
+
+
+def in_flight():
+    """Number of computations currently being led by this process."""
+    with _lock:
+        return len(_inflight)
+
+
+def do(key, fn, timeout=None):
+    """
+    Run ``fn()`` at most once for concurrent callers sharing the same ``key``.
+
+    Parameters
+    ----------
+    key : str
+        Canonical hash identifying the computation.
+    fn : callable
+        Function of no arguments performing the computation.
+    timeout : float, optional
+        Maximum time (in seconds) that a follower will wait for the leader before
+        computing the result itself. Default is ``HMFCALC_SINGLEFLIGHT_TIMEOUT``.
+
+    Returns
+    -------
+    The result of ``fn()``, possibly computed by another caller. Followers receive
+    a copy, so that they may freely modify it.
+    """
+    if timeout is None:
+        timeout = _setting("HMFCALC_SINGLEFLIGHT_TIMEOUT", 120)
+
+    with _lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _inflight[key] = _Call()
+
+    if not leader:
+        if call.event.wait(timeout):
+            if call.error is None:
+                logger.info("Shared in-flight result for %s", key)
+                return copy.deepcopy(call.result)
+            if isinstance(call.error, sandbox.ComputeLimitExceeded):
+                raise sandbox.ComputeLimitExceeded(str(call.error))
+
+        logger.warning("Leader for %s failed or timed out, computing locally", key)
+        return fn()
+
+    try:
+        call.result = _do_shared(key, fn, timeout)
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            del _inflight[key]
+        call.event.set()
+
+    return call.result
+
+
+def _do_shared(key, fn, timeout):
+    """Run ``fn()`` at most once across processes, using the shared cache as a lock."""
+    result = get_result(key)
+    if result is not None:
+        return result
+    _raise_failure(key)
+
+    lock_key = LOCK_PREFIX + key
+    poll = _setting("HMFCALC_SINGLEFLIGHT_POLL", 0.1)
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        # The lock expires on its own, in case the leader process dies outright.
+        if cache.add(lock_key, os.getpid(), timeout=int(timeout) + 1):
+            try:
+                result = fn()
+                set_result(key, result)
+            except sandbox.ComputeLimitExceeded as e:
+                if not isinstance(e, sandbox.ComputeBusy):
+                    set_failure(key, e)
+                raise
+            finally:
+                cache.delete(lock_key)
+            return result
+
+        time.sleep(poll)
+        result = get_result(key)
+        if result is not None:
+            logger.info("Shared result for %s from another process", key)
+            return result
+        _raise_failure(key)
+
+        # If the lock has gone but there's no result, the leader failed. Go around
+        # again and try to become the leader ourselves.
+
+    logger.warning("Timed out waiting on other process for %s, computing locally", key)
+    return fn()
@@ -120,35 +120,238 @@ $(function () {
 
     });
 
+    // The query string choosing which model comparisons are made against.
+    function baseline_query() {
+        if ($('#id_baseline').length && $('#id_plot_choice').val().startsWith('comparison')) {
+            return '?baseline=' + encodeURIComponent($('#id_baseline').val());
+        }
+        return '';
+    }
+
     //Change plotted image to whatever user clicks on
-    $('#id_plot_choice').change(function () {
-        var src = $(this).val() + '.svg';
+    $('#id_plot_choice, #id_baseline').change(function () {
+        var src = $('#id_plot_choice').val() + '.svg' + baseline_query();
         $('#the_image').attr('src', src);
 
         //Also change download link
         if ($('#id_download_choice').val() == 'pdf-current') {
-            var newlink = 'download/' + $('#id_plot_choice').val() + '.pdf';
+            var newlink = $('#id_plot_choice').val() + '.pdf' + baseline_query();
             $('a#plot_download').attr('href', newlink);
         }
     });
 
+    // The gallery sprite is only loaded when the gallery is first opened.
+    $('#gallery').on('show.bs.collapse', function () {
+        var src = 'gallery.png' + ($('#id_baseline').length ? '?baseline=' + encodeURIComponent($('#id_baseline').val()) : '');
+        $('.gallery-thumb div').css('background-image', 'url(' + src + ')');
+    });
+
+    // Choose a plot by clicking its thumbnail.
+    $('.gallery-thumb').click(function (e) {
+        e.preventDefault();
+        $('#id_plot_choice').val($(this).data('plot')).change();
+    });
+
+    // Redshift evolution of the current plot, for the chosen model.
+    function zseries_url(suffix) {
+        var query = $('#zseries_form').find('input').serialize();
+        return 'zseries/' + encodeURIComponent($('#zseries_label').val()) + '/' + suffix + '?' + query;
+    }
+
+    function update_zseries_links() {
+        var plot = $('#id_plot_choice').val();
+        $('a#zseries_frames').attr('href', zseries_url(plot + '-frames.zip'));
+        $('a#zseries_data').attr('href', zseries_url('data.npz'));
+    }
+
+    if ($('#zseries_form').length) {
+        update_zseries_links();
+        $('#zseries_form').find('input, select').change(update_zseries_links);
+        $('#id_plot_choice').change(update_zseries_links);
+
+        $('#zseries_plot').click(function () {
+            $('#the_image').attr('src', zseries_url($('#id_plot_choice').val() + '.svg'));
+        });
+    }
+
+    // Uncertainty bands of the chosen model, shaded on the current plot (if it has them).
+    var uncertainty_url = null;
+
+    function show_uncertainty() {
+        var plot = $('#id_plot_choice').val();
+        if (uncertainty_url && ['dndm', 'ngtm', 'fsigma'].indexOf(plot) >= 0) {
+            $('#the_image').attr('src', uncertainty_url + plot + '.svg');
+        }
+    }
+
+    if ($('#uncertainty_form').length) {
+        $('#id_plot_choice').change(show_uncertainty);
+
+        $('#uncertainty_plot').click(function () {
+            var label = $('#uncertainty_label').val();
+            $('#uncertainty_status').text('Computing...');
+
+            $.ajax({
+                url: 'uncertainty/' + encodeURIComponent(label) + '/',
+                type: 'POST',
+                data: new FormData($('#uncertainty_form')[0]),
+                processData: false,
+                contentType: false,
+                success: function (data) {
+                    uncertainty_url = 'uncertainty/' + encodeURIComponent(label) + '/' + data.key + '/';
+                    $('a#uncertainty_data').attr('href', data.data).removeClass('d-none');
+                    $('#uncertainty_status').text(
+                        (data.n - data.failed) + ' of ' + data.n + ' samples computed.');
+                    if (['dndm', 'ngtm', 'fsigma'].indexOf($('#id_plot_choice').val()) < 0) {
+                        $('#id_plot_choice').val('dndm');
+                    }
+                    show_uncertainty();
+                },
+                error: function (xhr) {
+                    var errors = (xhr.responseJSON || {}).errors || {};
+                    var messages = [];
+                    $.each(errors, function (field, errs) {
+                        messages.push(errs.join(' '));
+                    });
+                    $('#uncertainty_status').text(messages.join(' ') || 'The bands could not be computed.');
+                }
+            });
+        });
+    }
+
+    // The query string choosing which columns are exported.
+    function columns_query() {
+        var columns = $('#id_columns').val();
+        if (columns && columns.length) {
+            return '?columns=' + encodeURIComponent(columns.join(','));
+        }
+        return '';
+    }
+
     //Change download link depending on what user wants to download
-    $('#id_download_choice').change(function () {
-        if ($(this).val() == 'pdf-current') {
-            var newlink = $('#id_plot_choice').val() + '.pdf'
+    $('#id_download_choice, #id_columns').change(function () {
+        var choice = $('#id_download_choice').val();
+        if (choice == 'pdf-current') {
+            var newlink = $('#id_plot_choice').val() + '.pdf' + baseline_query();
+            $('a#plot_download').attr('href', newlink);
+        }
+        if (choice == 'ASCII') {
+            var newlink = "download/allData.zip" + columns_query();
             $('a#plot_download').attr('href', newlink);
         }
-        if ($(this).val() == 'ASCII') {
-            var newlink = "download/allData.zip"
+        if (choice == 'npz') {
+            var newlink = "download/allData.npz" + columns_query();
             $('a#plot_download').attr('href', newlink);
         }
-        if ($(this).val() == 'parameters') {
+        if (choice == 'parameters') {
             var newlink = "download/parameters.txt"
             $('a#plot_download').attr('href', newlink);
         }
-        if ($(this).val() == 'halogen') {
+        if (choice == 'halogen') {
             var newlink = "download/halogen.zip"
             $('a#plot_download').attr('href', newlink);
         }
+        $('#div_id_columns').toggle(choice == 'ASCII' || choice == 'npz');
     });
+    $('#div_id_columns').toggle(false);
+
+    // Live preview of dn/dm while editing a model. Each request is numbered, so that
+    // the server can drop superseded ones, and we can ignore late responses.
+    var preview_seq = 0;
+    var preview_timer = null;
+
+    function draw_preview(data) {
+        var canvas = $('#preview_canvas')[0];
+        var ctx = canvas.getContext('2d');
+        ctx.clearRect(0, 0, canvas.width, canvas.height);
+
+        var x = [], y = [];
+        for (var i = 0; i < data.m.length; i++) {
+            if (data.dndm[i] > 0) {
+                x.push(Math.log10(data.m[i]));
+                y.push(Math.log10(data.dndm[i]));
+            }
+        }
+        if (!x.length) {
+            return;
+        }
+
+        var xmin = Math.min.apply(null, x), xmax = Math.max.apply(null, x);
+        var ymin = Math.min.apply(null, y), ymax = Math.max.apply(null, y);
+        var pad = 10;
+
+        ctx.beginPath();
+        for (i = 0; i < x.length; i++) {
+            var px = pad + (x[i] - xmin) / (xmax - xmin) * (canvas.width - 2 * pad);
+            var py = canvas.height - pad - (y[i] - ymin) / (ymax - ymin) * (canvas.height - 2 * pad);
+            if (i === 0) {
+                ctx.moveTo(px, py);
+            } else {
+                ctx.lineTo(px, py);
+            }
+        }
+        ctx.strokeStyle = data.resolution === 'fine' ? '#007bff' : '#aaaaaa';
+        ctx.stroke();
+
+        $('#preview_status').text(
+            'dn/dm, ' + Math.round(xmin) + ' < log10 m < ' + Math.round(xmax) +
+            (data.resolution === 'fine' ? '' : ' (coarse, refining...)')
+        );
+    }
+
+    function poll_refined(url, seq, tries) {
+        if (seq !== preview_seq || tries <= 0) {
+            return;
+        }
+        $.getJSON(url, function (data) {
+            if (seq !== preview_seq) {
+                return;
+            }
+            if (data.pending) {
+                setTimeout(function () { poll_refined(url, seq, tries - 1); }, 500);
+            } else {
+                draw_preview(data);
+            }
+        });
+    }
+
+    function request_preview() {
+        var seq = ++preview_seq;
+        var data = new FormData($('#input_form')[0]);
+        data.append('seq', seq);
+
+        $.ajax({
+            url: '/hmfcalc/preview/',
+            type: 'POST',
+            data: data,
+            processData: false,
+            contentType: false,
+            success: function (data) {
+                if (data.stale || seq !== preview_seq) {
+                    return;
+                }
+                draw_preview(data);
+                if (data.refined) {
+                    poll_refined(data.refined, seq, 120);
+                }
+            },
+            error: function () {
+                if (seq === preview_seq) {
+                    $('#preview_status').text('No preview: check the parameters.');
+                }
+            }
+        });
+    }
+
+    if ($('#preview_canvas').length) {
+        $('#input_form').on('change', 'input, select', function () {
+            clearTimeout(preview_timer);
+            preview_timer = setTimeout(request_preview, 200);
+        });
+        $('#input_form').on('slidestop', function () {
+            clearTimeout(preview_timer);
+            preview_timer = setTimeout(request_preview, 200);
+        });
+        request_preview();
+    }
 });
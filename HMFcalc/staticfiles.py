@@ -0,0 +1,109 @@
+"""
+Fingerprinted, precompressed static files, served with far-future caching.
+
+``collectstatic`` (with :class:`CompressedManifestStaticFilesStorage`) gives every
+file a content hash in its name, and writes compressed copies (see
+:mod:`~HMFcalc.compression`) of those that compress well. Since a hashed file never
+changes, it is served as immutable: browsers never ask for it again.
+"""
+import mimetypes
+import os
+import posixpath
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import (
+    ManifestStaticFilesStorage,
+    staticfiles_storage,
+)
+from django.core.files.base import ContentFile
+from django.http import FileResponse, HttpResponseNotFound, HttpResponseNotModified
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+from . import compression
+
+# Extensions of the compressed copies.
+EXTENSIONS = {"br": ".br", "gzip": ".gz"}
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Static files with hashed names, plus precompressed copies of each.
+
+    Copies are only kept if they're appreciably smaller than the original. Files
+    that haven't been collected (eg. when running tests) are linked to unhashed.
+    """
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+    def post_process(self, *args, **kwargs):
+        hashed = []
+        for name, hashed_name, processed in super().post_process(*args, **kwargs):
+            if hashed_name and not isinstance(processed, Exception):
+                hashed.append(hashed_name)
+            yield name, hashed_name, processed
+
+        for name in hashed:
+            if compression.compressible(mimetypes.guess_type(name)[0]):
+                for encoding in compression.encodings():
+                    self._write_compressed(name, encoding)
+
+    def _write_compressed(self, name, encoding):
+        with self.open(name) as f:
+            content = f.read()
+
+        compressed = compression.compress(content, encoding, fast=False)
+        path = name + EXTENSIONS[encoding]
+        if len(compressed) < 0.95 * len(content):
+            if self.exists(path):
+                self.delete(path)
+            self.save(path, ContentFile(compressed))
+
+
+def _hashed_names():
+    names = getattr(staticfiles_storage, "hashed_files", {})
+    return set(names.values())
+
+
+def serve(request, name, cache_control=IMMUTABLE):
+    """
+    Serve a collected static file, preferring a precompressed copy.
+
+    Files that don't have a hashed name are cached for a day rather than forever.
+    """
+    name = posixpath.normpath(name).lstrip("/")
+    path = os.path.join(settings.STATIC_ROOT, name)
+    if name.startswith("..") or not os.path.isfile(path):
+        return HttpResponseNotFound()
+
+    stat = os.stat(path)
+    if not was_modified_since(
+        request.META.get("HTTP_IF_MODIFIED_SINCE"), stat.st_mtime, stat.st_size
+    ):
+        return HttpResponseNotModified()
+
+    content_type, _ = mimetypes.guess_type(path)
+
+    encoding = None
+    for enc in compression.accepted_encodings(request):
+        if os.path.isfile(path + EXTENSIONS[enc]):
+            path, encoding = path + EXTENSIONS[enc], enc
+            break
+
+    response = FileResponse(
+        open(path, "rb"), content_type=content_type or "application/octet-stream"
+    )
+    if encoding:
+        response["Content-Encoding"] = encoding
+    response["Vary"] = "Accept-Encoding"
+    response["Last-Modified"] = http_date(stat.st_mtime)
+    response["Cache-Control"] = (
+        cache_control if name in _hashed_names() else "public, max-age=86400"
+    )
+    return response
@@ -15,6 +15,7 @@ from django.conf import settings
 # see http://celeryproject.org/docs/reference/celery.task.schedules.html#celery.task.schedules.crontab
 @periodic_task(run_every=crontab(hour="*", minute="*", day_of_week="*"))
 def writefile():
-    print("Writing to file...")
-    with open(settings.ROOT_DIR + "/heartbeat", "a") as f:
+    # Overwrite rather than append, so the file doesn't grow forever. The health check
+    # only looks at its modification time.
+    with open(settings.HMFCALC_HEARTBEAT_FILE, "w") as f:
         f.write(str(time()))
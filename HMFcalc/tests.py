@@ -5,12 +5,71 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import gzip
+import io
+import json
 import logging
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from collections import Counter, OrderedDict
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+from unittest import mock
 
-from django.test import TestCase
+import numpy as np
+from django.conf import settings
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, TestCase, override_settings
+from hmf import MassFunction, wdm
+
+from . import (
+    array_store,
+    components,
+    compression,
+    emulator,
+    export,
+    forms,
+    kgrid,
+    memory,
+    metrics,
+    preload,
+    prerender,
+    preview,
+    sandbox,
+    session_models,
+    singleflight,
+    staticfiles,
+    uncertainty,
+    utils,
+    views,
+    zseries,
+)
+from .management.commands import compute_batch, startup_benchmark, warm_cache
 
 logger = logging.getLogger(__name__)
 
+LOCMEM_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+}
+
+
+def _allocate(nbytes, seconds=0):
+    """Hold ``nbytes`` of memory for ``seconds`` (run in a sandboxed child)."""
+    a = np.ones(nbytes // 8)
+    time.sleep(seconds)
+    return a.nbytes
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -18,3 +77,1342 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SingleFlightTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_calls_share_one_computation(self):
+        calls = []
+        started = threading.Event()
+
+        def fn():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return {"value": 1}
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(singleflight.do("k", fn)))
+            for _ in range(5)
+        ]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"value": 1}] * 5)
+
+    def test_result_is_shared_via_cache(self):
+        singleflight.do("k", lambda: 1)
+        self.assertEqual(singleflight.do("k", lambda: 2), 1)
+
+    def test_followers_fall_back_when_leader_fails(self):
+        started = threading.Event()
+
+        def bad():
+            started.set()
+            time.sleep(0.1)
+            raise RuntimeError("leader failed")
+
+        def lead():
+            with self.assertRaises(RuntimeError):
+                singleflight.do("k", bad)
+
+        leader = threading.Thread(target=lead)
+        leader.start()
+        started.wait()
+        self.assertEqual(singleflight.do("k", lambda: 3), 3)
+        leader.join()
+
+    def test_limit_failures_not_recomputed(self):
+        started = threading.Event()
+
+        def runaway():
+            started.set()
+            time.sleep(0.1)
+            raise sandbox.ComputeLimitExceeded("Too slow!")
+
+        def lead():
+            with self.assertRaises(sandbox.ComputeLimitExceeded):
+                singleflight.do("k", runaway)
+
+        leader = threading.Thread(target=lead)
+        leader.start()
+        started.wait()
+        fn = mock.Mock(return_value=3)
+        with self.assertRaisesRegex(sandbox.ComputeLimitExceeded, "Too slow!"):
+            singleflight.do("k", fn)
+        leader.join()
+
+        # Later calls (eg. from other processes) fail straight away too.
+        with self.assertRaisesRegex(sandbox.ComputeLimitExceeded, "Too slow!"):
+            singleflight.do("k", fn)
+        fn.assert_not_called()
+
+    def test_busy_failures_not_recorded(self):
+        with self.assertRaises(sandbox.ComputeBusy):
+            singleflight.do("k", mock.Mock(side_effect=sandbox.ComputeBusy("Busy")))
+        self.assertEqual(singleflight.do("k", lambda: 3), 3)
+
+    def test_parameter_hash_is_order_independent(self):
+        self.assertEqual(
+            utils.parameter_hash(z=1, hmf_params={"a": 1, "b": 2}),
+            utils.parameter_hash(hmf_params={"b": 2, "a": 1}, z=1),
+        )
+        self.assertNotEqual(utils.parameter_hash(z=1), utils.parameter_hash(z=2))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ArrayStoreTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings = override_settings(HMFCALC_ARRAY_STORE=self.tmpdir)
+        self.settings.enable()
+        cache.clear()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def test_arrays_are_content_addressed(self):
+        a = np.linspace(0, 1, 10)
+        self.assertEqual(array_store.put_array(a), array_store.put_array(a.copy()))
+        self.assertNotEqual(array_store.put_array(a), array_store.put_array(a + 1))
+
+    def test_arrays_are_read_only_memmaps(self):
+        a = np.linspace(0, 1, 10)
+        b = array_store.get_array(array_store.put_array(a))
+        self.assertIsInstance(b, np.memmap)
+        self.assertTrue(np.array_equal(a, b))
+        with self.assertRaises(ValueError):
+            b[0] = 1
+
+    def test_stored_model(self):
+        obj = utils.stored_hmf_driver(Mmin=10, Mmax=12, transfer_model="EH")
+        self.assertIsInstance(obj.dndm, np.memmap)
+        self.assertEqual(obj.Mmin, 10)
+
+        obj = pickle.loads(pickle.dumps(obj))
+        self.assertEqual(len(obj.m), len(obj.dndm))
+
+    def test_only_requested_quantities_computed(self):
+        obj = utils.stored_hmf_driver(
+            Mmin=10, Mmax=12, transfer_model="EH", quantities=["power"]
+        )
+        self.assertIn("transfer_function", obj.manifest["arrays"])
+        self.assertNotIn("sigma", obj.manifest["arrays"])
+
+        # Accessing another k-based quantity never evaluates the fitting function.
+        obj.delta_k
+        self.assertNotIn("fsigma", obj.manifest["arrays"])
+        self.assertNotIn("_MassFunction__fsigma", vars(obj.framework()))
+
+        # Mass-based quantities are computed (and stored) on demand.
+        self.assertEqual(len(obj.dndm), len(obj.m))
+        self.assertIn("dndm", array_store.read_manifest(obj.key)["arrays"])
+
+    def test_expired_framework_remade_in_sandbox(self):
+        obj = utils.stored_hmf_driver(Mmin=10, Mmax=12, transfer_model="EH")
+        obj = pickle.loads(pickle.dumps(obj))
+        cache.clear()
+
+        with self.assertRaises(AttributeError):
+            obj.cosmo
+
+        with mock.patch.object(sandbox, "run", wraps=sandbox.run) as run:
+            self.assertEqual(obj.framework().Mmin, 10)
+        run.assert_called_once()
+
+    def test_framework_cached_without_stored_arrays(self):
+        obj = utils.stored_hmf_driver(
+            Mmin=10, Mmax=12, transfer_model="EH", quantities=["dndm"]
+        )
+        loc = "_MassFunction__dndm"
+
+        stripped, digests = cache.get(array_store.FRAMEWORK_PREFIX + obj.key)
+        self.assertIsNone(vars(stripped)[loc])
+        self.assertEqual(digests[loc], obj.manifest["arrays"]["dndm"])
+
+        framework = pickle.loads(pickle.dumps(obj)).framework()
+        np.testing.assert_array_equal(vars(framework)[loc], obj.dndm)
+        self.assertEqual(
+            framework.dndm.tolist(),
+            MassFunction(Mmin=10, Mmax=12, transfer_model="EH").dndm.tolist(),
+        )
+
+    def test_clean_store(self):
+        old = utils.stored_hmf_driver(Mmin=10, Mmax=12, transfer_model="EH")
+        past = time.time() - 1000
+        for dirpath, _, filenames in os.walk(self.tmpdir):
+            for name in filenames:
+                os.utime(os.path.join(dirpath, name), (past, past))
+
+        new = utils.stored_hmf_driver(Mmin=10, Mmax=13, transfer_model="EH")
+        self.assertGreater(array_store.clean_store(100), 0)
+
+        self.assertIsNone(array_store.read_manifest(old.key))
+        self.assertIsNotNone(array_store.read_manifest(new.key))
+        for digest in array_store.read_manifest(new.key)["arrays"].values():
+            self.assertTrue(os.path.exists(array_store._array_path(digest)))
+
+        # Arrays shared with the new model (eg. k) are kept, but no others.
+        kept = set(array_store.read_manifest(new.key)["arrays"].values())
+        for digest in old.manifest["arrays"].values():
+            self.assertEqual(
+                os.path.exists(array_store._array_path(digest)), digest in kept
+            )
+
+        out = io.StringIO()
+        call_command("clean_store", max_age=100, stdout=out)
+        self.assertIn("Removed 0 files", out.getvalue())
+
+    def test_required_quantities(self):
+        self.assertEqual(
+            utils.required_quantities(["delta_k"]),
+            {"delta_k", "power", "transfer_function", "k"},
+        )
+        self.assertIn("fsigma", utils.required_quantities(["ngtm"]))
+
+
+class HealthTest(TestCase):
+    def test_healthz(self):
+        response = self.client.get("/healthz")
+        self.assertEqual(response.status_code, 200)
+
+        health = json.loads(response.content)
+        for key in [
+            "status",
+            "worker",
+            "compute",
+            "cache_hit_rate",
+            "latency_p95",
+            "heartbeat_age",
+        ]:
+            self.assertIn(key, health)
+        self.assertEqual(
+            set(health["compute"]), {"workers", "busy", "waiting", "in_flight"}
+        )
+
+        self.assertNotIn("sessionid", response.cookies)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ComparisonTest(TestCase):
+    def test_models_on_different_grids(self):
+        m1 = np.logspace(10, 15, 501)
+        m2 = np.logspace(11, 16, 137)
+        objects = OrderedDict(
+            a=SimpleNamespace(m=m1, dndm=m1 ** -2.0),
+            b=SimpleNamespace(m=m2, dndm=2 * m2 ** -2.0),
+            c=SimpleNamespace(m=m2, dndm=m2 ** -1.0),
+        )
+
+        x, ratios = utils.comparison_ratios(objects, "dndm")
+        self.assertEqual(list(ratios.keys()), ["b", "c"])
+        self.assertAlmostEqual(x[0], 1e11)
+        self.assertAlmostEqual(x[-1], 1e15)
+        self.assertTrue(np.allclose(ratios["b"], 2))
+        self.assertTrue(np.allclose(ratios["c"], x))
+
+        x, ratios = utils.comparison_ratios(objects, "dndm", baseline="b")
+        self.assertEqual(list(ratios.keys()), ["a", "c"])
+        self.assertTrue(np.allclose(ratios["a"], 0.5))
+
+
+class RedshiftSeriesTest(TestCase):
+    def test_matches_hmf_at_each_redshift(self):
+        obj = MassFunction(transfer_model="EH", Mmin=10, Mmax=14)
+        z = np.array([0.0, 1.0, 3.0])
+        series = zseries.redshift_series(obj, z)
+
+        self.assertEqual(series.dndm.shape, (3, len(obj.m)))
+        self.assertEqual(series.power.shape, (3, len(obj.k)))
+
+        for i, zz in enumerate(z):
+            obj.update(z=zz)
+            self.assertTrue(np.allclose(series.dndm[i], obj.dndm))
+            self.assertTrue(np.allclose(series.ngtm[i], obj.ngtm, rtol=1e-3))
+
+
+class EmulatorTest(TestCase):
+    box = {
+        "Om0": (0.28, 0.33),
+        "Ob0": (0.04, 0.05),
+        "H0": (65.0, 70.0),
+        "sigma_8": (0.78, 0.84),
+        "n": (0.95, 0.98),
+        "z": (0.0, 1.0),
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.override = override_settings(HMFCALC_EMULATOR_DIR=self.tmpdir)
+        self.override.enable()
+        emulator.load.cache_clear()
+
+        emulators = emulator.train(
+            ["Tinker08"],
+            n_samples=60,
+            order=2,
+            box=self.box,
+            transfer_model="EH",
+            log10m=np.arange(10, 15.01, 0.1),
+        )
+        emulator.save("Tinker08", emulators["Tinker08"])
+
+    def tearDown(self):
+        self.override.disable()
+        emulator.load.cache_clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_accurate_inside_box(self):
+        params = dict(Om0=0.3, Ob0=0.045, H0=67.0, sigma_8=0.8, n=0.96, z=0.5)
+        m = 10 ** np.arange(11, 14, 0.1)
+        out = emulator.emulate("Tinker08", params, m, transfer_model="EH")
+
+        obj = MassFunction(
+            transfer_model="EH",
+            Mmin=11,
+            Mmax=14,
+            dlog10m=0.1,
+            **emulator._hmf_kwargs(params)
+        )
+        self.assertTrue(np.allclose(out["dndm"], obj.dndm, rtol=0.02))
+        self.assertTrue(np.all(out["dndm_error"] < 0.02))
+
+    def test_falls_back_outside_box(self):
+        params = dict(Om0=0.5, Ob0=0.045, H0=67.0, sigma_8=0.8, n=0.96, z=0.5)
+        m = 10 ** np.arange(11, 14, 0.1)
+        self.assertIsNone(emulator.emulate("Tinker08", params, m))
+        self.assertIsNone(emulator.emulate("PS", params, m))
+
+    def test_falls_back_when_inaccurate(self):
+        params = dict(Om0=0.3, Ob0=0.045, H0=67.0, sigma_8=0.8, n=0.96, z=0.5)
+        m = 10 ** np.arange(11, 14, 0.1)
+        self.assertIsNotNone(emulator.emulate("Tinker08", params, m))
+
+        with override_settings(HMFCALC_EMULATOR_MAX_ERROR=1e-6):
+            self.assertIsNone(emulator.emulate("Tinker08", params, m))
+            out = emulator.fast_hmf(
+                "Tinker08", params, 11, 14, 0.1, transfer_model="EH"
+            )
+        self.assertFalse(out["emulated"])
+        self.assertTrue(np.all(out["dndm_error"] == 0))
+
+    def test_invalid_query_is_bad_request(self):
+        self.assertFalse(forms.EmulatorForm({"Mmin": "25"}).is_valid())
+        self.assertEqual(self.client.get("/hmfcalc/fast/?Mmin=25").status_code, 400)
+        self.assertFalse(forms.RedshiftSeriesForm({"zmin": "-1"}).is_valid())
+
+    def test_unphysical_cosmology_is_bad_request(self):
+        for query in ["Om0=-1", "H0=0", "Ob0=0.5&Om0=0.3"]:
+            response = self.client.get("/hmfcalc/fast/?" + query)
+            self.assertEqual(response.status_code, 400, query)
+
+    def test_model_errors_are_bad_request(self):
+        with mock.patch.object(
+            emulator, "fast_hmf", side_effect=ValueError("bad cosmology")
+        ):
+            response = self.client.get("/hmfcalc/fast/")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(b"bad cosmology", response.content)
+
+
+class WarmCacheTest(TestCase):
+    def test_default_data_is_valid(self):
+        data = forms.HMFInput.default_data(transfer_model="EH_BAO", hmf_model="PS")
+        self.assertEqual(data["hmf_model"], "PS")
+        self.assertFalse(any(k.startswith("hmf_Tinker08_") for k in data))
+
+        form = forms.HMFInput(data=data)
+        self.assertTrue(form.is_valid(), form.errors)
+
+        cls, hmf_dict = views.HMFInputBase().cleaned_data_to_hmf_dict(form)
+        self.assertEqual(hmf_dict["hmf_model"], "PS")
+        self.assertEqual(hmf_dict["transfer_model"], "EH_BAO")
+
+    def test_plot_key_defaults_to_first_baseline(self):
+        objects = OrderedDict(a=SimpleNamespace(key="1"), b=SimpleNamespace(key="2"))
+        self.assertEqual(
+            utils.plot_cache_key(objects, "dndm"),
+            utils.plot_cache_key(objects, "dndm", baseline="a"),
+        )
+        self.assertNotEqual(
+            utils.plot_cache_key(objects, "dndm"),
+            utils.plot_cache_key(objects, "dndm", baseline="b"),
+        )
+
+    def test_first_plot_is_cached(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache.clear()
+
+        defaults = {name: form._initial for name, form in warm_cache.COMPONENTS}
+        with override_settings(HMFCALC_ARRAY_STORE=tmpdir, HMFCALC_PRERENDER_PLOTS=0):
+            with mock.patch.object(
+                utils, "create_canvas", return_value=io.BytesIO(b"<svg/>")
+            ):
+                status = warm_cache.warm(defaults, ["dndm"], ["svg"])[0]
+            self.assertEqual(status, "computed")
+
+            # A fresh session's default model is the one warmed, so its plot is cached.
+            self.client.get("/hmfcalc/")
+            with mock.patch.object(utils, "create_canvas") as create_canvas:
+                response = self.client.get("/hmfcalc/dndm.svg")
+
+        create_canvas.assert_not_called()
+        self.assertEqual(response.content, b"<svg/>")
+
+
+class SessionModelsTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.override = override_settings(
+            HMFCALC_SPILL_DIR=self.tmpdir,
+            HMFCALC_SESSION_MAX_MODELS=2,
+            HMFCALC_SESSION_MAX_BYTES=10 ** 6,
+        )
+        self.override.enable()
+        self.session = SessionStore()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def model(self, n=100):
+        return SimpleNamespace(m=np.ones(n), dndm=np.ones(n))
+
+    def test_spills_least_recently_viewed(self):
+        for label in "abc":
+            session_models.set_model(self.session, label, self.model(), {"x": label})
+
+        # Created in order a, b, c, so a is spilled, but is still there.
+        self.assertEqual(session_models.labels(self.session), ["a", "b", "c"])
+        self.assertTrue(session_models.footprints(self.session)["a"][1])
+        self.assertEqual(session_models.footprints(self.session)["a"][0], 1600)
+        self.assertEqual(len(session_models.get_models(self.session)["a"].m), 100)
+        self.assertEqual(session_models.get_form(self.session, "a"), {"x": "a"})
+
+        # Viewing a brings it back, and spills b.
+        session_models.get_model(self.session, "a")
+        spilled = {
+            label: f[1] for label, f in session_models.footprints(self.session).items()
+        }
+        self.assertEqual(spilled, {"a": False, "b": True, "c": False})
+
+    def test_byte_quota(self):
+        session_models.set_model(self.session, "a", self.model())
+        session_models.set_model(self.session, "b", self.model(10 ** 5))
+        self.assertTrue(session_models.footprints(self.session)["a"][1])
+
+    def test_byte_quota_ignores_stored_arrays(self):
+        with override_settings(HMFCALC_ARRAY_STORE=self.tmpdir):
+            big = SimpleNamespace(m=np.ones(2 * 10 ** 5), parameter_values={})
+            array_store.write_manifest("big", big, {}, ["m"])
+            stored = array_store.StoredModel("big", MassFunction, {}, ["m"])
+
+            session_models.set_model(self.session, "a", self.model())
+            session_models.set_model(self.session, "b", stored)
+            footprints = session_models.footprints(self.session)
+
+        # Its arrays are bigger than the quota, but aren't held in the session.
+        self.assertEqual(footprints["b"], (1600000, False))
+        self.assertFalse(footprints["a"][1])
+
+    def test_delete_and_clear(self):
+        for label in "abc":
+            session_models.set_model(self.session, label, self.model())
+
+        session_models.delete_model(self.session, "a")
+        self.assertEqual(session_models.labels(self.session), ["b", "c"])
+
+        session_models.clear(self.session)
+        self.assertEqual(session_models.labels(self.session), [])
+
+    def test_stale_session_copies(self):
+        for label in "abc":
+            session_models.set_model(self.session, label, self.model())
+
+        # Another request, holding an older copy of the session, still sees a model
+        # after it's been loaded back (and even deleted).
+        stale = SessionStore()
+        stale.update(pickle.loads(pickle.dumps(dict(self.session))))
+        session_models.get_model(self.session, "a")
+        session_models.delete_model(self.session, "a")
+        self.assertEqual(len(session_models.get_models(stale)["a"].m), 100)
+
+    def test_clean_spilled(self):
+        for label in "abc":
+            session_models.set_model(self.session, label, self.model())
+
+        self.assertEqual(session_models.clean_spilled(3600), 0)
+        call_command("clean_spill", "--max-age=-1", stdout=io.StringIO())
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+        # Models whose files are gone are left out.
+        self.assertEqual(list(session_models.get_models(self.session)), ["b", "c"])
+        self.assertIsNone(session_models.get_model(self.session, "a"))
+        self.assertEqual(session_models.labels(self.session), ["b", "c"])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PreviewTest(TestCase):
+    def test_coarse_kwargs(self):
+        kwargs = preview.coarse_kwargs(
+            dict(dlog10m=0.01, dlnk=0.05, transfer_model="CAMB", transfer_params={})
+        )
+        self.assertEqual(kwargs["dlog10m"], 0.1)
+        self.assertEqual(kwargs["dlnk"], 0.2)
+        self.assertEqual(kwargs["transfer_model"], "EH_BAO")
+        self.assertNotIn("transfer_params", kwargs)
+
+        kwargs = preview.coarse_kwargs(dict(dlog10m=0.5, transfer_model="BBKS"))
+        self.assertEqual(kwargs["dlog10m"], 0.5)
+        self.assertEqual(kwargs["transfer_model"], "BBKS")
+
+    def test_superseded_requests_are_stale(self):
+        self.assertTrue(preview.is_latest("client", 2))
+        self.assertFalse(preview.is_latest("client", 1))
+        self.assertTrue(preview.is_latest("client", 3))
+
+    def test_coarse_not_cached(self):
+        hmf_dict = dict(transfer_model="EH_BAO", Mmin=12, Mmax=14)
+        obj = preview.coarse(MassFunction, hmf_dict)
+        self.assertEqual(len(obj.m), 20)
+
+        key = utils.parameter_hash(MassFunction, **preview.coarse_kwargs(hmf_dict))
+        self.assertIsNone(singleflight.get_result(key))
+
+
+class StaticFilesTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.override = override_settings(
+            STATIC_ROOT=os.path.join(self.tmpdir, "static"),
+            MEDIA_ROOT=os.path.join(self.tmpdir, "media"),
+        )
+        self.override.enable()
+        os.mkdir(settings.MEDIA_ROOT)
+        call_command("collectstatic", interactive=False, verbosity=0)
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def test_hashed_and_compressed(self):
+        name = staticfiles_storage.stored_name("HMFcalc/js/HideShowRules.js")
+        self.assertNotEqual(name, "HMFcalc/js/HideShowRules.js")
+        self.assertTrue(staticfiles_storage.exists(name + ".gz"))
+
+        response = self.client.get("/static/" + name, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["Cache-Control"], staticfiles.IMMUTABLE)
+
+        response = self.client.get("/static/" + name)
+        self.assertNotIn("Content-Encoding", response)
+        self.assertIn(b"function", b"".join(response.streaming_content))
+
+    def test_unhashed_and_missing(self):
+        response = self.client.get("/static/HMFcalc/js/HideShowRules.js")
+        self.assertEqual(response["Cache-Control"], "public, max-age=86400")
+
+        response = self.client.get("/static/../manage.py")
+        self.assertEqual(response.status_code, 404)
+
+    def test_favicon(self):
+        response = self.client.get("/favicon.ico")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/x-icon")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PageCacheTest(TestCase):
+    def test_cached_per_deploy(self):
+        cache.clear()
+        hits = metrics.snapshot().get("page_cache_hit", 0)
+
+        first = self.client.get("/help/")
+        second = self.client.get("/help/")
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(metrics.snapshot()["page_cache_hit"], hits + 1)
+
+        with self.settings(HMFCALC_DEPLOY_ID="next"):
+            self.client.get("/help/")
+        self.assertEqual(metrics.snapshot()["page_cache_hit"], hits + 1)
+
+
+# Plots are counted, so mustn't be pre-rendered in the background.
+@override_settings(CACHES=LOCMEM_CACHES, HMFCALC_PRERENDER_PLOTS=0)
+class CompressionTest(TestCase):
+    # A stand-in for a rendered plot, so that these tests don't depend on matplotlib.
+    SVG = b"<?xml version='1.0'?>" + b"<svg></svg>" * 1000
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.override = override_settings(HMFCALC_ARRAY_STORE=self.tmpdir)
+        self.override.enable()
+        self.canvas = mock.patch.object(
+            utils, "create_canvas", side_effect=lambda *a, **kw: io.BytesIO(self.SVG)
+        )
+        self.canvas.start()
+
+    def tearDown(self):
+        self.canvas.stop()
+        self.override.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def test_accepted_encoding(self):
+        factory = RequestFactory()
+        for header, expected in [
+            ("gzip, deflate", "gzip"),
+            ("gzip;q=0", None),
+            ("identity", None),
+            ("*", compression.encodings()[0]),
+        ]:
+            request = factory.get("/", HTTP_ACCEPT_ENCODING=header)
+            self.assertEqual(compression.accepted_encoding(request), expected)
+
+    def test_cached_plot_compressed_once(self):
+        cache.clear()
+        objects = {"a": utils.stored_hmf_driver(transfer_model="EH")}
+        d = views.get_keymap()["dndm"]
+
+        svg = utils.cached_canvas(objects, "dndm", d, plot_format="svg").getvalue()
+        key = utils.plot_cache_key(objects, "dndm", "svg")
+        self.assertEqual(gzip.decompress(cache.get(key + ":gzip")), svg)
+
+        gz = utils.cached_canvas(
+            objects, "dndm", d, plot_format="svg", encoding="gzip"
+        ).getvalue()
+        self.assertEqual(gz, cache.get(key + ":gzip"))
+        self.assertEqual(utils.create_canvas.call_count, 1)
+
+    def test_text_responses_compressed(self):
+        self.client.get("/hmfcalc/")
+        response = self.client.get("/hmfcalc/dndm.svg", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertTrue(gzip.decompress(response.content).startswith(b"<?xml"))
+
+        response = self.client.get("/hmfcalc/dndm.png", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertNotIn("Content-Encoding", response)
+
+        with self.settings(HMFCALC_COMPRESS_MIN_BYTES=100):
+            response = self.client.get(
+                "/hmfcalc/download/parameters.txt", HTTP_ACCEPT_ENCODING="gzip"
+            )
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn(b"PARAMETERS", gzip.decompress(response.content))
+
+        with self.settings(HMFCALC_COMPRESS_MIN_BYTES=10 ** 6):
+            response = self.client.get(
+                "/hmfcalc/download/parameters.txt", HTTP_ACCEPT_ENCODING="gzip"
+            )
+        self.assertNotIn("Content-Encoding", response)
+
+
+class ExportTest(TestCase):
+    def members(self):
+        x = np.linspace(0, 1, 100)
+        return [
+            ("{}.txt".format(i), [x, x ** i], ["x", "x^{}".format(i)]) for i in range(5)
+        ]
+
+    def test_zip_archive(self):
+        content = export.zip_archive(self.members())
+
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(
+                archive.namelist(), ["0.txt", "1.txt", "2.txt", "3.txt", "4.txt"]
+            )
+            table = archive.read("2.txt")
+
+        self.assertEqual(table, export.table(*self.members()[2][1:]))
+        self.assertTrue(table.startswith(b"# [1] x \n# [2] x^2 \n"))
+
+    def test_parallel_matches_serial(self):
+        with self.settings(HMFCALC_EXPORT_WORKERS=1):
+            serial = zipfile.ZipFile(io.BytesIO(export.zip_archive(self.members())))
+        with self.settings(HMFCALC_EXPORT_WORKERS=2):
+            parallel = zipfile.ZipFile(io.BytesIO(export.zip_archive(self.members())))
+
+        for name in serial.namelist():
+            self.assertEqual(serial.read(name), parallel.read(name))
+
+    def test_unicode_names(self):
+        members = [("σ_8=0.8.txt", *self.members()[1][1:])]
+
+        with zipfile.ZipFile(io.BytesIO(export.zip_archive(members))) as archive:
+            self.assertIsNone(archive.testzip())
+            info = archive.infolist()[0]
+            self.assertEqual(info.filename, "σ_8=0.8.txt")
+            self.assertTrue(info.flag_bits & 0x800)
+
+    def test_broken_pool_replaced(self):
+        broken = mock.Mock(submit=mock.Mock(side_effect=BrokenProcessPool))
+        with mock.patch.object(export, "_executor", broken):
+            with self.settings(HMFCALC_EXPORT_WORKERS=2):
+                with self.assertRaises(BrokenProcessPool):
+                    export.zip_archive(self.members())
+                self.assertIsNone(export._executor)
+                broken.shutdown.assert_called_once_with(wait=False)
+
+                content = export.zip_archive(self.members())
+            self.assertEqual(len(zipfile.ZipFile(io.BytesIO(content)).namelist()), 5)
+            export._get_executor().shutdown()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class EditTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.override = override_settings(HMFCALC_ARRAY_STORE=self.tmpdir)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def test_changed_parameters(self):
+        obj = MassFunction(transfer_model="EH", z=0.0)
+        self.assertEqual(
+            utils.changed_parameters(obj, MassFunction, transfer_model="EH", z=0.0), {},
+        )
+        self.assertEqual(
+            utils.changed_parameters(obj, MassFunction, transfer_model="EH", z=1.0),
+            {"z": 1.0},
+        )
+        self.assertIn(
+            "z", utils.changed_parameters(obj, wdm.MassFunctionWDM, z=0.0),
+        )
+
+    def test_params_only_reset_for_changed_models(self):
+        obj = MassFunction(
+            transfer_model="EH", hmf_model="Tinker08", hmf_params={"A_200": 0.2}
+        )
+        new = utils.hmf_driver(
+            previous=obj, transfer_model="EH", hmf_model="Tinker08", z=1.0
+        )
+        self.assertEqual(new.hmf_params, {"A_200": 0.2})
+        self.assertEqual(new.z, 1.0)
+
+        new = utils.hmf_driver(previous=obj, transfer_model="EH", hmf_model="PS")
+        self.assertEqual(new.hmf_params, {})
+
+    def test_new_params_for_changed_model(self):
+        obj = MassFunction(
+            transfer_model="EH", hmf_model="Tinker08", hmf_params={"A_200": 0.2}
+        )
+        new = utils.hmf_driver(
+            previous=obj, transfer_model="EH", hmf_model="SMT", hmf_params={"a": 0.7}
+        )
+        self.assertEqual(new.hmf_model.__name__, "SMT")
+        self.assertEqual(new.hmf_params, {"a": 0.7})
+        self.assertEqual(new.hmf.params["a"], 0.7)
+
+    def test_rename_skips_computation(self):
+        data = forms.HMFInput.default_data(transfer_model="EH_BAO")
+        with mock.patch.object(
+            utils, "stored_hmf_driver", wraps=utils.stored_hmf_driver
+        ) as driver:
+            self.client.post("/hmfcalc/create/", dict(data, label="a"))
+            self.client.post("/hmfcalc/edit/a/", dict(data, label="b"))
+            self.assertEqual(driver.call_count, 1)
+
+            self.client.post("/hmfcalc/edit/b/", dict(data, label="b", z=1))
+            self.assertEqual(driver.call_count, 2)
+
+        session = self.client.session
+        self.assertEqual(session_models.labels(session), ["b"])
+        self.assertEqual(session_models.get_model(session, "b").z, 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ComponentsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_stage_keys(self):
+        sigma = components.STAGES[1]
+        a = dict(transfer_model="EH", hmf_model="Tinker08")
+        b = dict(transfer_model="EH", hmf_model="Watson")
+        self.assertEqual(
+            components.stage_key(sigma, MassFunction, a),
+            components.stage_key(sigma, MassFunction, b),
+        )
+        self.assertNotEqual(
+            components.stage_key(sigma, MassFunction, a),
+            components.stage_key(sigma, MassFunction, dict(a, z=1)),
+        )
+
+    def test_upstream_stages_reused(self):
+        components.build(
+            MassFunction,
+            transfer_model="EH",
+            hmf_model="Tinker08",
+            hmf_params={"A_200": 0.2},
+        )
+        hits = metrics.snapshot().get("component_cache_hit", 0)
+
+        obj = components.build(MassFunction, transfer_model="EH", hmf_model="Watson")
+        self.assertEqual(metrics.snapshot()["component_cache_hit"], hits + 1)
+        self.assertEqual(obj.hmf_params, {})
+        self.assertTrue(
+            np.allclose(
+                obj.dndm, MassFunction(transfer_model="EH", hmf_model="Watson").dndm
+            )
+        )
+
+    def test_params_not_merged(self):
+        components.build(
+            MassFunction,
+            transfer_model="EH",
+            hmf_model="Tinker08",
+            hmf_params={"A_200": 0.2},
+        )
+        obj = components.build(
+            MassFunction,
+            transfer_model="EH",
+            hmf_model="Tinker08",
+            hmf_params={"a_200": 1.5},
+        )
+        self.assertEqual(obj.hmf_params, {"a_200": 1.5})
+
+        obj = components.build(
+            MassFunction, transfer_model="EH", hmf_model="SMT", hmf_params={"a": 0.7}
+        )
+        self.assertEqual(obj.hmf_params, {"a": 0.7})
+
+    def test_transfer_reused_for_new_normalisation(self):
+        components.build(MassFunction, transfer_model="EH")
+        hits = metrics.snapshot().get("component_cache_hit", 0)
+
+        obj = components.build(MassFunction, transfer_model="EH", sigma_8=0.9, n=0.95)
+        self.assertEqual(metrics.snapshot()["component_cache_hit"], hits + 1)
+        expected = MassFunction(transfer_model="EH", sigma_8=0.9, n=0.95)
+        self.assertTrue(np.allclose(obj.power, expected.power))
+        self.assertTrue(np.allclose(obj.dndm, expected.dndm))
+
+    def test_unset_parameters_not_carried_over(self):
+        components.build(MassFunction, transfer_model="EH", delta_c=1.5)
+        obj = components.build(MassFunction, transfer_model="EH")
+        self.assertEqual(obj.delta_c, MassFunction(transfer_model="EH").delta_c)
+
+
+# Plots are counted, so mustn't be pre-rendered in the background.
+@override_settings(CACHES=LOCMEM_CACHES, HMFCALC_PRERENDER_PLOTS=0)
+class GalleryTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.override = override_settings(HMFCALC_ARRAY_STORE=self.tmpdir)
+        self.override.enable()
+        cache.clear()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def test_layout(self):
+        w, h = utils.GALLERY_THUMBNAIL
+        layout = utils.gallery_layout(["q{}".format(i) for i in range(6)])
+        self.assertEqual(layout["q0"], (0, 0))
+        self.assertEqual(layout["q1"], (w, 0))
+        self.assertEqual(layout["q{}".format(utils.GALLERY_COLUMNS)], (0, h))
+
+    def test_gallery_rendered_once(self):
+        self.client.get("/hmfcalc/")
+
+        # Don't depend on the installed matplotlib's plotting API.
+        with mock.patch.object(utils, "_plot_quantity") as plot:
+            response = self.client.get("/hmfcalc/gallery.png")
+            self.assertEqual(response["Content-Type"], "image/png")
+            self.assertTrue(response.content.startswith(b"\x89PNG"))
+            self.assertEqual(plot.call_count, 13)
+
+            self.client.get("/hmfcalc/gallery.png")
+            self.assertEqual(plot.call_count, 13)
+
+
+class ComputeBatchTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_compute_batch(self):
+        runs = os.path.join(self.tmpdir, "runs.json")
+        with open(runs, "w") as f:
+            json.dump(
+                [
+                    {"name": "ps", "hmf_model": "PS", "transfer_model": "EH"},
+                    {"hmf_model": "ST", "transfer_model": "EH", "z": 1.0},
+                ],
+                f,
+            )
+
+        out = io.StringIO()
+        output = os.path.join(self.tmpdir, "out")
+        call_command(
+            "compute_batch", runs, output=output, quantities=["dndm"], stdout=out
+        )
+        self.assertIn("2 computed, 0 failed", out.getvalue())
+
+        data = np.load(os.path.join(output, "ps.npz"))
+        self.assertEqual(set(data.files), {"m", "k", "dndm", "parameters"})
+        self.assertEqual(json.loads(str(data["parameters"]))["hmf_model"], "PS")
+
+        out = io.StringIO()
+        call_command("compute_batch", runs, output=output, stdout=out)
+        self.assertIn("2 runs, 2 already done", out.getvalue())
+
+    def test_failures(self):
+        runs = os.path.join(self.tmpdir, "runs.json")
+        with open(runs, "w") as f:
+            json.dump(
+                [
+                    {"name": "good", "transfer_model": "EH"},
+                    {"name": "bad", "transfer_model": "EH", "Mmin": "x"},
+                ],
+                f,
+            )
+
+        out = io.StringIO()
+        output = os.path.join(self.tmpdir, "out")
+        with self.assertRaises(CommandError):
+            call_command(
+                "compute_batch", runs, output=output, quantities=["dndm"], stdout=out
+            )
+        self.assertIn("1 computed, 1 failed", out.getvalue())
+        self.assertEqual(os.listdir(output), ["good.npz"])
+
+    def test_no_partial_files(self):
+        path = os.path.join(self.tmpdir, "a.npz")
+        with mock.patch.object(np, "savez", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                compute_batch.compute({"transfer_model": "EH"}, ("dndm",), path)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, HMFCALC_MEMORY_DEBUG=True)
+class MemoryTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.override = override_settings(HMFCALC_ARRAY_STORE=self.tmpdir)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def test_attribute_sizes(self):
+        obj = MassFunction(transfer_model="EH")
+        obj.dndm
+        sizes = memory.attribute_sizes(obj)
+        self.assertGreaterEqual(sizes[0][1], sizes[-1][1] or 0)
+        self.assertIn("_MassFunction__dndm", dict(sizes))
+
+    def test_trace(self):
+        with memory.trace("test"):
+            a = np.ones(10 ** 6)
+        self.assertGreaterEqual(memory.peaks()["test"][0], a.nbytes)
+        self.assertTrue(tracemalloc.is_tracing())
+
+    @override_settings(HMFCALC_COMPUTE_WORKERS=1)
+    def test_peak_measured_in_child(self):
+        nbytes, used = sandbox.run(memory.measure, _allocate, 8 * 10 ** 6)
+        self.assertEqual(nbytes, 8 * 10 ** 6)
+        self.assertGreaterEqual(used, nbytes)
+
+    def test_report(self):
+        self.client.get("/hmfcalc/")
+        response = self.client.get("/hmfcalc/memory/")
+        self.assertContains(response, "default")
+        self.assertContains(response, "hmf_driver")
+
+        with self.settings(HMFCALC_MEMORY_DEBUG=False):
+            response = self.client.get("/hmfcalc/memory/")
+        self.assertEqual(response.status_code, 404)
+
+
+class StartupTest(TestCase):
+    def test_parse_importtime(self):
+        stderr = "\n".join(
+            [
+                "import time: self [us] | cumulative | imported package",
+                "import time:       120 |        120 |   hmf.cosmology",
+                "import time:        80 |        200 | hmf",
+                startup_benchmark.MARKER,
+                "import time:       500 |        500 | matplotlib",
+            ]
+        )
+        times = startup_benchmark.parse_importtime(stderr)
+        self.assertEqual(times, {"hmf.cosmology": 120e-6, "hmf": 80e-6})
+        self.assertEqual(startup_benchmark.by_package(times), [("hmf", 200e-6)])
+
+    def test_matplotlib_deferred(self):
+        _, _, times = startup_benchmark.measure("HMFcalc.urls")
+        self.assertIn("HMFcalc.views", times)
+        self.assertNotIn("matplotlib.figure", times)
+
+    def test_preload(self):
+        with mock.patch("gc.freeze") as freeze:
+            preload.preload()
+        freeze.assert_called_once_with()
+        self.assertTrue(all(m in sys.modules for m in preload.MODULES))
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    HMFCALC_PRERENDER_PLOTS=2,
+    HMFCALC_PRERENDER_PRIOR=("dndm.svg", "fsigma.svg", "ngtm.svg"),
+)
+class PrerenderTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.override = override_settings(HMFCALC_ARRAY_STORE=self.tmpdir)
+        self.override.enable()
+        cache.clear()
+        self.views = mock.patch.object(prerender, "_views", Counter())
+        self.views.start()
+        self.canvas = mock.patch.object(
+            utils, "create_canvas", side_effect=lambda *a, **kw: io.BytesIO(b"<svg/>")
+        )
+        self.canvas.start()
+        self.objects = {"a": utils.stored_hmf_driver(transfer_model="EH")}
+
+    def tearDown(self):
+        self.canvas.stop()
+        self.views.stop()
+        self.override.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def test_ranking(self):
+        self.assertEqual(prerender.ranking(), ["dndm.svg", "fsigma.svg", "ngtm.svg"])
+        prerender.record_view("ngtm", "svg")
+        prerender.record_view("power", "png")
+        self.assertEqual(prerender.ranking()[:2], ["ngtm.svg", "power.png"])
+
+    def test_prerendered(self):
+        prerender.schedule({}, self.objects, views.get_keymap()).result()
+        self.assertEqual(utils.create_canvas.call_count, 2)
+        for q in ("dndm", "fsigma"):
+            key = utils.plot_cache_key(self.objects, q, "svg")
+            self.assertEqual(cache.get(key), b"<svg/>")
+
+        # Already rendered.
+        prerender.schedule({}, self.objects, views.get_keymap()).result()
+        self.assertEqual(utils.create_canvas.call_count, 2)
+
+    def test_cancelled(self):
+        session = {}
+
+        def change_models(*args, **kwargs):
+            prerender.schedule(session, {"b": None}, {})
+            return io.BytesIO(b"<svg/>")
+
+        utils.create_canvas.side_effect = change_models
+        prerender.schedule(session, self.objects, views.get_keymap()).result()
+        self.assertEqual(utils.create_canvas.call_count, 1)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    HMFCALC_COMPUTE_WORKERS=1,
+    HMFCALC_COMPUTE_TIMEOUT=10,
+    HMFCALC_COMPUTE_MAX_RSS=100 * 1024 ** 2,
+)
+class SandboxTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.override = override_settings(HMFCALC_ARRAY_STORE=self.tmpdir)
+        self.override.enable()
+        cache.clear()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def test_run(self):
+        self.assertEqual(sandbox.run(_allocate, 8000), 8000)
+        with self.assertRaises(ValueError):
+            sandbox.run(int, "not a number")
+
+    def test_limits(self):
+        with self.settings(HMFCALC_COMPUTE_TIMEOUT=0.5):
+            with self.assertRaisesRegex(sandbox.ComputeLimitExceeded, "longer"):
+                sandbox.run(time.sleep, 5)
+
+        with self.assertRaisesRegex(sandbox.ComputeLimitExceeded, "memory"):
+            sandbox.run(_allocate, 400 * 1024 ** 2, 5)
+
+        # A new child takes over.
+        self.assertEqual(sandbox.run(_allocate, 8), 8)
+
+    def test_child_died(self):
+        with self.assertRaisesRegex(sandbox.ComputeLimitExceeded, "exit code 3"):
+            sandbox.run(os._exit, 3)
+        self.assertEqual(sandbox.run(_allocate, 8), 8)
+
+    @mock.patch.object(sandbox, "_slots", None)
+    def test_load(self):
+        def wait_for(**counts):
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                if sandbox.load() == dict({"workers": 1}, **counts):
+                    return True
+                time.sleep(0.01)
+            return False
+
+        jobs = [threading.Thread(target=sandbox.run, args=(time.sleep, 0.5))]
+        jobs[0].start()
+        self.assertTrue(wait_for(busy=1, waiting=0))
+
+        jobs.append(threading.Thread(target=sandbox.run, args=(time.sleep, 0.1)))
+        jobs[1].start()
+        self.assertTrue(wait_for(busy=1, waiting=1))
+
+        for job in jobs:
+            job.join()
+        self.assertTrue(wait_for(busy=0, waiting=0))
+
+    def test_recycled(self):
+        with self.settings(HMFCALC_COMPUTE_MAX_JOBS=2):
+            pids = Counter(sandbox.run(os.getpid) for _ in range(5))
+        self.assertEqual(max(pids.values()), 2)
+        self.assertNotIn(os.getpid(), pids)
+
+        # Retired children have exited.
+        for pid, jobs in pids.items():
+            if jobs == 2:
+                with self.assertRaises(ProcessLookupError):
+                    os.kill(pid, 0)
+
+    def test_model_computed(self):
+        def lookups():
+            counters = metrics.snapshot()
+            return sum(counters.get("component_cache_" + k, 0) for k in ("hit", "miss"))
+
+        before = lookups()
+        obj = utils.stored_hmf_driver(transfer_model="EH", z=0.3)
+        self.assertEqual(len(obj.dndm), len(obj.m))
+
+        # Metrics are counted in the child, but reported by this process.
+        self.assertEqual(lookups(), before + 1)
+
+    def test_error_shown(self):
+        with mock.patch.object(
+            sandbox, "run", side_effect=sandbox.ComputeLimitExceeded("Too slow!")
+        ):
+            response = self.client.post(
+                "/hmfcalc/create/",
+                forms.HMFInput.default_data(transfer_model="EH_BAO", label="slow"),
+            )
+        self.assertContains(response, "Too slow!")
+        self.assertNotIn("slow", self.client.session.get("objects", {}))
+
+    def test_redshift_series_computed(self):
+        obj = utils.stored_hmf_driver(transfer_model="EH", Mmin=10, Mmax=14)
+        with mock.patch.object(sandbox, "run", wraps=sandbox.run) as run:
+            series = zseries.redshift_series(obj, [0.0, 1.0])
+        self.assertIs(run.call_args[0][0], zseries._series)
+        self.assertEqual(series.dndm.shape, (2, len(obj.m)))
+
+        self.client.post(
+            "/hmfcalc/create/",
+            forms.HMFInput.default_data(transfer_model="EH_BAO", label="a"),
+        )
+        with mock.patch.object(
+            sandbox, "run", side_effect=sandbox.ComputeLimitExceeded("Too slow!")
+        ):
+            response = self.client.get("/hmfcalc/zseries/a/data.npz?zmax=2")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b"Too slow!")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class KGridTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.override = override_settings(HMFCALC_ARRAY_STORE=self.tmpdir)
+        self.override.enable()
+        cache.clear()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def test_choose(self):
+        kwargs = {"transfer_model": "EH", "Mmin": 11, "Mmax": 14, "dlog10m": 0.1}
+        grid = kgrid.choose(MassFunction, kwargs, 1e-3)
+        self.assertLessEqual(grid.error, 1e-3)
+        self.assertLess((grid.lnk_max - grid.lnk_min) / grid.dlnk, 567)
+
+        reference = MassFunction(lnk_min=-20, lnk_max=15, dlnk=0.002, **kwargs)
+        chosen = MassFunction(
+            lnk_min=grid.lnk_min, lnk_max=grid.lnk_max, dlnk=grid.dlnk, **kwargs
+        )
+        np.testing.assert_allclose(chosen.dndm, reference.dndm, rtol=2e-3)
+
+        with mock.patch.object(sandbox, "run") as run:
+            self.assertEqual(kgrid.choose(MassFunction, kwargs, 1e-3), grid)
+        run.assert_not_called()
+
+    def test_form(self):
+        self.client.post(
+            "/hmfcalc/create/",
+            dict(
+                forms.HMFInput.default_data(transfer_model="EH_BAO"),
+                label="auto",
+                k_accuracy="0.01",
+            ),
+        )
+        obj = session_models.get_model(self.client.session, "auto")
+        self.assertNotEqual(obj.kwargs["dlnk"], 0.05)
+        self.assertLessEqual(kgrid.estimated_error(obj), 0.01)
+        self.assertContains(self.client.get("/hmfcalc/"), "k grid")
+
+        # It's kept with the model, so outlives the cache, and is known once spilled.
+        cache.clear()
+        spilled = session_models.SpilledModel(0, "spilled", obj.key)
+        self.assertEqual(kgrid.estimated_error(spilled), kgrid.estimated_error(obj))
+        self.assertLessEqual(kgrid.estimated_error(spilled), 0.01)
+
+
+class SwitchClassTest(TestCase):
+    quantities = ("dndm", "ngtm", "sigma", "power", "transfer_function")
+
+    def assert_same(self, obj, fresh):
+        for q in self.quantities:
+            np.testing.assert_allclose(getattr(obj, q), getattr(fresh, q), rtol=1e-10)
+
+    def test_toggle_wdm(self):
+        wdm_kwargs = {"wdm_mass": 1.0, "wdm_model": "Viel05", "alter_model": None}
+        cdm = MassFunction(transfer_model="EH_BAO")
+        utils.materialise(cdm, self.quantities)
+
+        with mock.patch.object(type(cdm.transfer), "lnt", side_effect=AssertionError):
+            obj = utils.hmf_driver(previous=cdm, transfer_model="EH_BAO", **wdm_kwargs)
+            self.assertIsInstance(obj, wdm.MassFunctionWDM)
+            utils.materialise(obj, self.quantities)
+
+            back = utils.hmf_driver(previous=obj, transfer_model="EH_BAO")
+            self.assertNotIsInstance(back, wdm.MassFunctionWDM)
+            utils.materialise(back, self.quantities)
+
+        self.assertIs(obj.transfer, cdm.transfer)
+        self.assert_same(
+            obj, wdm.MassFunctionWDM(transfer_model="EH_BAO", **wdm_kwargs)
+        )
+        self.assert_same(back, cdm)
+
+    def test_changed_parameters(self):
+        cdm = MassFunction(transfer_model="EH_BAO")
+        utils.materialise(cdm, self.quantities)
+
+        kwargs = {"transfer_model": "EH_BAO", "wdm_model": "Viel05", "z": 1.0}
+        kwargs["cosmo_params"] = {"H0": 70.0}
+        obj = utils.hmf_driver(previous=cdm, **kwargs)
+        self.assert_same(obj, wdm.MassFunctionWDM(**kwargs))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, HMFCALC_PRERENDER_PLOTS=0)
+class UncertaintyTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.override = override_settings(HMFCALC_ARRAY_STORE=self.tmpdir)
+        self.override.enable()
+        cache.clear()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def test_bands(self):
+        obj = MassFunction(transfer_model="EH_BAO", dlog10m=0.1)
+        rows = uncertainty.draw([obj.sigma_8, obj.n], np.diag([0.01, 0.004]) ** 2, 20)
+        rows[0] = [-1, obj.n]
+
+        bands = uncertainty.sample_bands(obj, ["sigma_8", "n"], rows)
+        self.assertEqual(bands.failed, 1)
+        self.assertEqual(bands.dndm.shape, (len(uncertainty.PERCENTILES), len(obj.m)))
+        self.assertTrue(np.all(np.diff(bands.dndm, axis=0) >= 0))
+        np.testing.assert_allclose(bands.dndm[2], obj.dndm, rtol=0.05)
+
+        # Batches computed in the sandbox's children give the same result.
+        with self.settings(
+            HMFCALC_COMPUTE_WORKERS=2,
+            HMFCALC_UNCERTAINTY_WORKERS=2,
+            HMFCALC_UNCERTAINTY_BATCH_SIZE=6,
+        ):
+            with mock.patch.object(sandbox, "run", wraps=sandbox.run) as run:
+                pooled = uncertainty.sample_bands(obj, ["sigma_8", "n"], rows)
+            self.assertEqual(run.call_count, 4)
+        np.testing.assert_allclose(pooled.ngtm, bands.ngtm)
+
+        with self.settings(HMFCALC_UNCERTAINTY_TIMEOUT=-1):
+            with self.assertRaises(sandbox.ComputeLimitExceeded):
+                uncertainty.sample_bands(obj, ["sigma_8", "n"], rows)
+
+        ax = mock.MagicMock()
+        utils._plot_quantity(
+            ax, {"a": obj}, "dndm", {"yscale": "log"}, bands={"a": bands}
+        )
+        self.assertEqual(ax.fill_between.call_count, 2)
+
+    def test_form(self):
+        form = forms.UncertaintyForm(
+            {"parameters": ["H0"], "mean": "70", "covariance": "-1", "n_samples": 5}
+        )
+        self.assertFalse(form.is_valid())
+
+        upload = SimpleUploadedFile(
+            "chain.txt", b"# weight sigma_8 H0\n1 0.8 67\n1 0.82 68\n2 nan 69\n"
+        )
+        form = forms.UncertaintyForm({"n_samples": 5}, {"samples": upload})
+        self.assertTrue(form.is_valid(), form.errors)
+        names, rows = form.draws()
+        self.assertEqual(names, ["H0", "sigma_8"])
+        np.testing.assert_array_equal(rows, [[67, 0.8], [68, 0.82]])
+
+    def test_views(self):
+        self.client.post(
+            "/hmfcalc/create/",
+            forms.HMFInput.default_data(transfer_model="EH_BAO", label="eh"),
+        )
+        response = self.client.post(
+            "/hmfcalc/uncertainty/eh/",
+            {
+                "parameters": ["sigma_8"],
+                "mean": "0.8",
+                "covariance": "0.0001",
+                "n_samples": 8,
+            },
+        )
+        data = response.json()
+        self.assertEqual((data["n"], data["failed"]), (8, 0))
+
+        with mock.patch.object(
+            utils, "create_canvas", side_effect=lambda *a, **kw: io.BytesIO(b"<svg/>")
+        ) as canvas:
+            response = self.client.get(
+                "/hmfcalc/uncertainty/eh/{}/ngtm.svg".format(data["key"])
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("eh", canvas.call_args[1]["bands"])
+
+        arrays = np.load(io.BytesIO(self.client.get(data["data"]).content))
+        self.assertEqual(arrays["fsigma"].shape[0], len(uncertainty.PERCENTILES))
+
+        response = self.client.get(
+            "/hmfcalc/uncertainty/eh/{}/dndm.svg".format("0" * 40)
+        )
+        self.assertEqual(response.status_code, 404)
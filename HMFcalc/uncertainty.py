@@ -0,0 +1,241 @@
+"""
+Uncertainty bands of a model, from a distribution of its cosmological parameters.
+
+The parameters in :data:`PARAMETERS` are drawn from a multivariate normal (given its
+mean and covariance), or taken from samples (eg. of an MCMC chain), and the model is
+evaluated at each draw. Percentiles of each quantity in :data:`QUANTITIES` over the
+draws then give its uncertainty bands.
+
+Draws are split into batches of ``HMFCALC_UNCERTAINTY_BATCH_SIZE``, each run as a
+job in the sandbox (see :mod:`~HMFcalc.sandbox`), so they share its bounded pool of
+children, and its limits on time and memory, with every other computation. At most
+``HMFCALC_UNCERTAINTY_WORKERS`` batches of a request are run at once, and batches not
+started within ``HMFCALC_UNCERTAINTY_TIMEOUT`` seconds are dropped. Within a batch, a
+single copy of the model is updated to each draw in turn, so that hmf only
+re-computes what depends on the parameters drawn: eg. drawing only ``n`` and
+``sigma_8`` re-uses the transfer function throughout.
+"""
+import copy
+import hashlib
+import logging
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from . import array_store, metrics, sandbox
+
+logger = logging.getLogger(__name__)
+
+BANDS_PREFIX = "hmfcalc-uncertainty:"
+
+# Parameters that may be drawn, and the group of model parameters each belongs to
+# (None for top-level parameters).
+PARAMETERS = OrderedDict(
+    [
+        ("H0", "cosmo_params"),
+        ("Om0", "cosmo_params"),
+        ("Ob0", "cosmo_params"),
+        ("n", None),
+        ("sigma_8", None),
+    ]
+)
+
+# Quantities that bands are computed for, and the percentiles that bound them
+# (giving the median, and 68% and 95% bands).
+QUANTITIES = ("dndm", "ngtm", "fsigma")
+PERCENTILES = (2.5, 16, 50, 84, 97.5)
+
+
+class Bands:
+    """
+    Percentiles of the quantities of a model over draws of its parameters.
+
+    Each quantity in :data:`QUANTITIES` is an attribute of shape
+    ``(len(PERCENTILES), len(m))``.
+    """
+
+    def __init__(self, key, model_key, names, n, failed, m, **quantities):
+        self.key = key
+        self.model_key = model_key
+        self.names = names
+        self.n = n
+        self.failed = failed
+        self.m = m
+        self.quantities = quantities
+
+    def __getattr__(self, name):
+        if name.startswith("_") or "quantities" not in self.__dict__:
+            raise AttributeError(name)
+        try:
+            return self.quantities[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def intervals(self, q):
+        """The (lower, upper) bounds of each band of ``q``, widest first."""
+        p = self.quantities[q]
+        return [(p[i], p[-1 - i]) for i in range(len(PERCENTILES) // 2)]
+
+    def arrays(self):
+        """All arrays of the bands, by name (eg. for saving)."""
+        return dict(
+            self.quantities, m=self.m, percentiles=np.array(PERCENTILES, dtype=float)
+        )
+
+
+def draw(mean, covariance, n, seed=0):
+    """``n`` draws from a multivariate normal, as an array of shape ``(n, len(mean))``."""
+    rng = np.random.default_rng(seed)
+    return rng.multivariate_normal(mean, covariance, size=n)
+
+
+def resample(samples, n, seed=0):
+    """``n`` of the rows of ``samples``, chosen at random (or all, if there are fewer)."""
+    if len(samples) <= n:
+        return samples
+    rng = np.random.default_rng(seed)
+    return samples[rng.choice(len(samples), size=n, replace=False)]
+
+
+def _parameters(obj, names, row):
+    """The parameters with which to update ``obj`` to a draw."""
+    params = {}
+    for name, value in zip(names, row):
+        group = PARAMETERS[name]
+        if group is None:
+            params[name] = float(value)
+        else:
+            params.setdefault(group, dict(getattr(obj, group)))[name] = float(value)
+    return params
+
+
+def _evaluate(obj, names, rows):
+    """
+    The quantities of ``obj`` at each of the draws ``rows``.
+
+    Returns a dict of arrays of shape ``(len(rows), len(m))``, which are NaN for draws
+    the model can't be computed at (eg. unphysical ones).
+    """
+    obj = copy.deepcopy(obj)
+    out = {q: np.full((len(rows), len(obj.m)), np.nan) for q in QUANTITIES}
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for i, row in enumerate(rows):
+            try:
+                obj.update(**_parameters(obj, names, row))
+                values = [np.asarray(getattr(obj, q)) for q in QUANTITIES]
+            except Exception as e:
+                logger.info("Couldn't compute the model at %s: %s", row.tolist(), e)
+                continue
+
+            for q, v in zip(QUANTITIES, values):
+                out[q][i] = v
+    return out
+
+
+def _evaluate_all(obj, names, rows):
+    size = settings.HMFCALC_UNCERTAINTY_BATCH_SIZE
+    batches = [rows[i : i + size] for i in range(0, len(rows), size)]
+    deadline = time.time() + settings.HMFCALC_UNCERTAINTY_TIMEOUT
+    stopped = threading.Event()
+
+    def evaluate(batch):
+        if stopped.is_set():
+            return None
+        if time.time() > deadline:
+            metrics.incr("compute_killed")
+            raise sandbox.ComputeLimitExceeded(
+                "The calculation took longer than {:g} seconds, so was stopped. "
+                "Try fewer samples.".format(settings.HMFCALC_UNCERTAINTY_TIMEOUT)
+            )
+        return sandbox.run(_evaluate, obj, names, batch)
+
+    workers = min(max(settings.HMFCALC_UNCERTAINTY_WORKERS, 1), len(batches))
+    with ThreadPoolExecutor(workers, thread_name_prefix="hmfcalc-uncertainty") as pool:
+        try:
+            return list(pool.map(evaluate, batches))
+        finally:
+            # Once a batch has failed, the rest are skipped rather than started.
+            stopped.set()
+
+
+def bands_key(obj, names, rows):
+    """The key of the bands of a (stored) model for the given draws, or None."""
+    key = getattr(obj, "key", None)
+    if key is None:
+        return None
+
+    digest = hashlib.sha1(key.encode())
+    digest.update(",".join(names).encode())
+    digest.update(np.ascontiguousarray(rows, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+def sample_bands(obj, names, rows):
+    """
+    Compute the uncertainty bands of a model, from draws of its parameters.
+
+    Parameters
+    ----------
+    obj : :class:`hmf.MassFunction` or :class:`~array_store.StoredModel`
+        The model. It is not modified.
+    names : list of str
+        The parameters drawn (in :data:`PARAMETERS`).
+    rows : array_like
+        The draws, of shape ``(n, len(names))``.
+
+    Returns
+    -------
+    :class:`Bands`
+
+    Raises
+    ------
+    ValueError
+        If the model couldn't be computed at any of the draws.
+    """
+    rows = np.atleast_2d(np.asarray(rows, dtype=float))
+    key = bands_key(obj, names, rows)
+    model_key = getattr(obj, "key", None)
+
+    if isinstance(obj, array_store.StoredModel):
+        obj = obj.framework()
+
+    results = _evaluate_all(obj, names, rows)
+    values = {q: np.concatenate([r[q] for r in results]) for q in QUANTITIES}
+    failed = int(np.sum(np.all(np.isnan(values["dndm"]), axis=1)))
+    metrics.incr("uncertainty_samples", len(rows))
+
+    if failed == len(rows):
+        raise ValueError("The model couldn't be computed at any of the samples.")
+
+    with warnings.catch_warnings():
+        # Some masses may have no finite value at all (eg. where ngtm is 0).
+        warnings.simplefilter("ignore")
+        quantities = {
+            q: np.nanpercentile(v, PERCENTILES, axis=0) for q, v in values.items()
+        }
+
+    return Bands(key, model_key, list(names), len(rows), failed, obj.m, **quantities)
+
+
+def cached_bands(obj, names, rows):
+    """Like :func:`sample_bands`, but cached (by :attr:`Bands.key`) for stored models."""
+    key = bands_key(obj, names, np.atleast_2d(np.asarray(rows, dtype=float)))
+    bands = None if key is None else cache.get(BANDS_PREFIX + key)
+    if bands is None:
+        bands = sample_bands(obj, names, rows)
+        if key is not None:
+            cache.set(BANDS_PREFIX + key, bands, settings.HMFCALC_RESULT_CACHE_TIMEOUT)
+    return bands
+
+
+def get_bands(key):
+    """Bands computed by :func:`cached_bands`, by their key, or None if expired."""
+    return cache.get(BANDS_PREFIX + key)
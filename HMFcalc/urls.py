@@ -1,20 +1,16 @@
 from django.urls import path
-from django.views.generic.base import RedirectView
 
-from . import views
+from . import utils, views
 
 urlpatterns = [
-    path(
-        r"favicon\.ico",
-        RedirectView.as_view(url="http://hmfstatic.appspot.com/img/favicon.ico"),
-    ),
-    path("", views.home.as_view(), name="home"),
+    path("favicon.ico", views.favicon, name="favicon"),
+    path("", utils.cached_page(views.home.as_view()), name="home"),
     path("hmfcalc/create/", views.HMFInputCreate.as_view(), name="calculate"),
     path("hmfcalc/create/<label>/", views.HMFInputCreate.as_view(), name="calculate"),
     path("hmfcalc/edit/<label>/", views.HMFInputEdit.as_view(), name="calculate"),
     path("hmfcalc/delete/<label>/", views.delete_plot, name="delete"),
     path("hmfcalc/restart/", views.complete_reset, name="restart"),
-    path("help/", views.help.as_view(), name="help"),
+    path("help/", utils.cached_page(views.help.as_view()), name="help"),
     # path(
     #     'hmf_resources/',
     #     views.resources.as_view(),
@@ -26,10 +22,46 @@ urlpatterns = [
     #     name='acknowledgments'
     # ),
     path("hmfcalc/", views.ViewPlots.as_view(), name="image-page"),
+    path("hmfcalc/gallery.png", views.gallery, name="gallery"),
+    path("hmfcalc/memory/", views.memory_report, name="memory"),
     path("hmfcalc/<plottype>.<filetype>", views.plots, name="images"),
+    path("hmfcalc/zseries/<label>/data.npz", views.zseries_data, name="zseries-data"),
+    path(
+        "hmfcalc/zseries/<label>/<plottype>-frames.zip",
+        views.zseries_frames,
+        name="zseries-frames",
+    ),
+    path(
+        "hmfcalc/zseries/<label>/<plottype>.<filetype>",
+        views.zseries_plots,
+        name="zseries-images",
+    ),
+    path("hmfcalc/uncertainty/<label>/", views.uncertainty_bands, name="uncertainty",),
+    path(
+        "hmfcalc/uncertainty/<label>/<slug:key>/data.npz",
+        views.uncertainty_data,
+        name="uncertainty-data",
+    ),
+    path(
+        "hmfcalc/uncertainty/<label>/<slug:key>/<plottype>.<filetype>",
+        views.uncertainty_plots,
+        name="uncertainty-images",
+    ),
     path("hmfcalc/download/allData.zip", views.data_output, name="data-output"),
+    path("hmfcalc/download/allData.npz", views.data_npz, name="data-npz"),
+    path("hmfcalc/fast/", views.fast_hmf, name="fast-hmf"),
+    path("hmfcalc/preview/", views.live_preview, name="preview"),
+    path(
+        "hmfcalc/preview/<slug:key>/",
+        views.live_preview_refined,
+        name="preview-refined",
+    ),
     path("hmfcalc/download/parameters.txt", views.header_txt, name="header-txt"),
     path("emailme/", views.ContactFormView.as_view(), name="contact-email"),
-    path("email-sent/", views.EmailSuccess.as_view(), name="email-success"),
+    path(
+        "email-sent/",
+        utils.cached_page(views.EmailSuccess.as_view()),
+        name="email-success",
+    ),
     path("hmfcalc/download/halogen.zip", views.halogen, name="halogen-output"),
 ]
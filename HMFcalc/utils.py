@@ -1,49 +1,449 @@
 """Plotting and driving utilities for hmf."""
 import copy
+import functools
+import hashlib
 import io
+import json
 import logging
+import zipfile
+from collections import OrderedDict
 
-import matplotlib.ticker as tick
+import hmf
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
 from hmf import MassFunction
+from hmf._internals._cache import hidden_loc
 from hmf.alternatives.wdm import MassFunctionWDM
-from matplotlib.backends.backend_agg import FigureCanvasAgg
-from matplotlib.backends.backend_pdf import FigureCanvasPdf
-from matplotlib.backends.backend_svg import FigureCanvasSVG
-from matplotlib.figure import Figure
+
+from . import (
+    array_store,
+    compression,
+    memory,
+    metrics,
+    sandbox,
+    singleflight,
+    zseries,
+)
 
 logger = logging.getLogger(__name__)
 
+# Quantities that are plotted and exported for every model.
+MASS_QUANTITIES = (
+    "sigma",
+    "lnsigma",
+    "n_eff",
+    "fsigma",
+    "dndm",
+    "dndlnm",
+    "dndlog10m",
+    "ngtm",
+    "rho_gtm",
+    "rho_ltm",
+    "how_big",
+)
+K_QUANTITIES = ("power", "transfer_function", "delta_k")
+
+# Quantities that may be written to the shared array store for every model.
+STORED_QUANTITIES = ("m", "k") + MASS_QUANTITIES + K_QUANTITIES
+
+# Plot formats that are worth compressing (PNG and PDF are compressed already).
+COMPRESSIBLE_PLOT_FORMATS = ("svg",)
+
+# Size (pixels) of the thumbnails of the plot gallery, and how many are in each row.
+GALLERY_THUMBNAIL = (240, 180)
+GALLERY_COLUMNS = 4
+
+# The quantities of hmf that each quantity is directly computed from. The fitting
+# function is only evaluated for ``fsigma`` (and everything that depends on it).
+QUANTITY_DEPENDENCIES = {
+    "m": (),
+    "k": (),
+    "transfer_function": ("k",),
+    "power": ("transfer_function",),
+    "delta_k": ("power",),
+    "sigma": ("m", "power"),
+    "lnsigma": ("sigma",),
+    "n_eff": ("sigma",),
+    "fsigma": ("sigma",),
+    "dndm": ("fsigma",),
+    "dndlnm": ("dndm",),
+    "dndlog10m": ("dndm",),
+    "ngtm": ("dndm",),
+    "rho_gtm": ("dndm",),
+    "rho_ltm": ("rho_gtm",),
+    "how_big": ("ngtm",),
+}
+
+
+def required_quantities(quantities):
+    """All quantities needed to compute the given ones (including themselves)."""
+    out = set()
+    todo = list(quantities)
+    while todo:
+        q = todo.pop()
+        if q not in out:
+            out.add(q)
+            todo.extend(QUANTITY_DEPENDENCIES[q])
+    return out
+
+
+def quantity_grid(q):
+    """The grid ("m" or "k") on which a quantity is defined."""
+    return "k" if q == "k" or q in K_QUANTITIES else "m"
+
+
+def _canonical(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, type):
+        return obj.__name__
+    return str(obj)
+
+
+def parameter_hash(cls=MassFunction, **kwargs):
+    """
+    Return a canonical hash of the model defined by ``cls`` and its ``kwargs``.
+
+    Two sets of inputs that define the same model always get the same hash, regardless
+    of the order of the parameters.
+    """
+    canon = json.dumps(
+        {"cls": cls.__name__, "hmf": hmf.__version__, "kwargs": kwargs},
+        sort_keys=True,
+        default=_canonical,
+    )
+    return hashlib.sha1(canon.encode()).hexdigest()
+
+
+def _model_name(model):
+    """The name of a component model, whether given as a name, class or instance."""
+    if model is None or isinstance(model, str):
+        return model
+    if isinstance(model, type):
+        return model.__name__
+    return getattr(model, "name", None) or model.__class__.__name__
+
+
+def _same_value(a, b):
+    return json.dumps(a, sort_keys=True, default=_canonical) == json.dumps(
+        b, sort_keys=True, default=_canonical
+    )
+
+
+def changed_parameters(previous, cls=MassFunction, **kwargs):
+    """
+    The parameters (of ``kwargs``) whose values differ from those of a previous model.
+
+    If the previous model is of a different class, or has parameters that aren't in
+    ``kwargs`` (which can't be unset by an update), all parameters are changed.
+    """
+    if isinstance(previous, array_store.StoredModel):
+        if previous.cls is not cls or set(previous.kwargs) - set(kwargs):
+            return dict(kwargs)
+        values = previous.kwargs
+    else:
+        if type(previous) is not cls:
+            return dict(kwargs)
+        values = previous.parameter_values
+
+    missing = object()
+    changed = {}
+    for k, v in kwargs.items():
+        old = values.get(k, missing)
+        if k.endswith("_model"):
+            old, v = _model_name(old), _model_name(v)
+        if old is missing or not _same_value(old, v):
+            changed[k] = kwargs[k]
+    return changed
+
+
+def switch_class(previous, cls, **kwargs):
+    """
+    Make a model of a different class to a previous one (ie. WDM from CDM, or back).
+
+    The two classes differ only in the WDM suppression of the transfer function, so
+    everything ``previous`` has computed upstream of it (eg. the cosmology, growth
+    factor and transfer model) is carried across, as is its transfer function (eg.
+    from CAMB), with the suppression applied or removed. Only the quantities
+    downstream of the transfer function are then recomputed. Nothing is carried
+    across that depends on a parameter whose value differs.
+    """
+    # Calling the class would validate the model, computing it all, so construct it
+    # without validating (as its metaclass would), and validate once it's filled in.
+    this = type.__call__(cls, **kwargs)
+
+    def index(obj, name):
+        return getattr(obj, hidden_loc(obj, name))
+
+    def keep(q, value, params):
+        setattr(this, hidden_loc(this, q), value)
+        index(this, "recalc")[q] = False
+        index(this, "recalc_prop_par")[q] = set(params)
+        for p in params:
+            index(this, "recalc_par_prop").setdefault(p, set()).add(q)
+        kept.append(q)
+
+    recalc = index(previous, "recalc")
+    prop_par = index(previous, "recalc_prop_par")
+    transfer_params = prop_par.get("_unnormalised_lnT")
+
+    values = this.parameter_values
+    differ = set(
+        changed_parameters(
+            previous,
+            type(previous),
+            **{p: values[p] for p in set(values) & set(previous.parameter_values)},
+        )
+    )
+
+    kept = []
+    for q, stale in recalc.items():
+        params = prop_par.get(q, set())
+        if stale or not isinstance(getattr(cls, q, None), property):
+            continue
+        if transfer_params is not None and transfer_params <= params:
+            continue
+        if not params & differ:
+            keep(q, getattr(previous, hidden_loc(previous, q)), params)
+
+    if transfer_params is not None and not recalc["_unnormalised_lnT"]:
+        if not transfer_params & differ:
+            lnt = getattr(previous, hidden_loc(previous, "_unnormalised_lnT"))
+            with np.errstate(divide="ignore"):
+                if isinstance(this, MassFunctionWDM):
+                    lnt = lnt + np.log(this.wdm.transfer(this.k))
+                    params = (
+                        transfer_params
+                        | index(this, "recalc_prop_par")["wdm"]
+                        | index(this, "recalc_prop_par")["k"]
+                    )
+                else:
+                    lnt = lnt - np.log(previous.wdm.transfer(previous.k))
+                    params = {p for p in transfer_params if p in values}
+
+            # The suppression can underflow at high k, and then can't be removed.
+            if np.all(np.isfinite(lnt)):
+                keep("_unnormalised_lnT", lnt, params)
+
+    this.validate()
+    logger.info(
+        "Switched from %s to %s, keeping %s",
+        type(previous).__name__,
+        cls.__name__,
+        ", ".join(sorted(kept)) or "nothing",
+    )
+    return this
+
 
 def hmf_driver(cls=MassFunction, previous=None, **kwargs):
+    if isinstance(previous, array_store.StoredModel):
+        previous = previous.framework()
+
     if previous is None:
         return cls(**kwargs)
     elif "wdm_model" in kwargs and not isinstance(previous, MassFunctionWDM):
-        return MassFunctionWDM(**kwargs)
+        return switch_class(previous, MassFunctionWDM, **kwargs)
     elif "wdm_model" not in kwargs and isinstance(previous, MassFunctionWDM):
-        return MassFunction(**kwargs)
+        return switch_class(previous, MassFunction, **kwargs)
     else:
         this = copy.deepcopy(previous)
 
+        # Only update what's changed, so that as much as possible is kept.
+        changed = changed_parameters(previous, type(previous), **kwargs)
+
         # TODO: this is a hack, and should be fixed in hmf
-        # we have to set all _params whose model has been changed to {}
-        # so that they don't get carry-over parameters from other models.
-        for k, v in kwargs.items():
-            if k.endswith("model") and v != getattr(this, k).__class__.__name__:
-                this.update(**{k.replace("model", "params"): {}})
+        # hmf merges new _params into the old ones, so we have to clear all _params
+        # that have changed, or whose model has been changed (along with the model
+        # itself), before setting the new ones, so that they don't get carry-over
+        # parameters from other models (or values that have since been unset).
+        reset = {}
+        for k in list(changed):
+            if k.endswith("_model"):
+                params = k.replace("model", "params")
+                reset[k] = changed.pop(k)
+                changed.setdefault(params, kwargs.get(params, {}))
+        for k in changed:
+            if k.endswith("_params"):
+                reset[k] = {}
 
-        this.update(**kwargs)
+        if reset:
+            this.update(**reset)
+        this.update(**changed)
 
     return this
 
 
-def create_canvas(objects, q, d, plot_format="png"):
-    # TODO: make log scaling automatic
-    fig = Figure(figsize=(10, 6), edgecolor="white", facecolor="white", dpi=100)
-    ax = fig.add_subplot(111)
-    ax.grid(True)
-    ax.set_xlabel(d["xlab"], fontsize=15)
-    ax.set_ylabel(d["ylab"], fontsize=15)
+def materialise(obj, quantities=STORED_QUANTITIES):
+    """Compute (and thereby cache on the object) all the given quantities."""
+    for q in quantities:
+        getattr(obj, q)
+    return obj
+
+
+def _compute(cls, previous, quantities, kwargs):
+    # components builds on this module, so is only imported once it's needed.
+    from . import components
+
+    if previous is None:
+        # Re-use any upstream stages (eg. sigma) already computed for others.
+        obj = components.build(cls, **kwargs)
+    else:
+        obj = hmf_driver(cls=cls, previous=previous, **kwargs)
+    return materialise(obj, quantities)
+
+
+def shared_hmf_driver(cls=MassFunction, previous=None, quantities=(), **kwargs):
+    """
+    Compute a model with :func:`hmf_driver`, sharing identical computations.
+
+    Concurrent requests for the same parameters (within this process or across
+    worker processes) wait on a single computation rather than each running their own.
+    The computation itself is run in a child process, with limits on its time and
+    memory (see :mod:`~HMFcalc.sandbox`). The returned object has the given
+    ``quantities`` already computed.
+    """
+    key = parameter_hash(cls, **kwargs)
+
+    def compute():
+        # Measured in the child (if any), where the model is actually computed.
+        obj, used = sandbox.run(
+            memory.measure, _compute, cls, previous, quantities, kwargs
+        )
+        memory.record("hmf_driver", used)
+        return obj
+
+    obj = singleflight.do(key, compute)
+    return materialise(obj, quantities)
+
+
+def stored_hmf_driver(cls=MassFunction, previous=None, quantities=(), **kwargs):
+    """
+    Compute a model, returning a :class:`~array_store.StoredModel`.
+
+    Only the given ``quantities`` (and what they depend on, including the ``m`` and
+    ``k`` grids) are computed and written to the shared on-disk array store (if
+    they're not there already), so that every process reads the same memory-mapped
+    copy. Any other quantity is computed when it's first accessed.
+    """
+    required = required_quantities(("m", "k") + tuple(quantities))
+    quantities = tuple(q for q in STORED_QUANTITIES if q in required)
+    key = parameter_hash(cls, **kwargs)
+
+    if array_store.read_manifest(key) is None:
+        metrics.incr("result_cache_miss")
+        obj = shared_hmf_driver(
+            cls=cls, previous=previous, quantities=quantities, **kwargs
+        )
+        manifest = array_store.write_manifest(key, obj, kwargs, quantities)
+        array_store.share_framework(key, obj, manifest)
+    else:
+        metrics.incr("result_cache_hit")
+
+    model = array_store.StoredModel(key, cls, kwargs, STORED_QUANTITIES)
+    model.compute(quantities)
+    return model
+
+
+def _batched_loglog_interp(xs, ys, xnew):
+    """
+    Interpolate each of the curves ``(xs[i], ys[i])`` onto ``xnew``, in log-log space.
+
+    All curves are interpolated in a single vectorized call, by offsetting each
+    curve's (log) grid so that they may all be concatenated into one monotonic grid.
+    Returns an array of shape ``(len(xs), len(xnew))``.
+    """
+    lxs = [np.log(x) for x in xs]
+    lnew = np.log(xnew)
+
+    lo = min(lx[0] for lx in lxs)
+    hi = max(lx[-1] for lx in lxs)
+    span = max(hi, lnew.max()) - min(lo, lnew.min()) + 1
+    offsets = span * np.arange(len(xs))
+
+    # Only interpolate in log-space if we can.
+    logy = all(np.all(y > 0) for y in ys)
+
+    xp = np.concatenate([lx + off for lx, off in zip(lxs, offsets)])
+    fp = np.concatenate([np.log(y) if logy else y for y in ys])
+    xq = (lnew[None, :] + offsets[:, None]).ravel()
+
+    out = np.interp(xq, xp, fp).reshape(len(xs), len(xnew))
+    return np.exp(out) if logy else out
+
+
+def comparison_ratios(objects, q, baseline=None, x="m"):
+    """
+    Ratio of quantity ``q`` of each model to that of the ``baseline`` model.
+
+    Models may be defined on different grids. All are interpolated onto the
+    baseline's grid, restricted to the range that every model covers. The result is
+    cached, keyed by the models being compared.
+
+    Parameters
+    ----------
+    objects : dict
+        Labelled models to compare.
+    q : str
+        The quantity to compare, eg. "dndm".
+    baseline : str, optional
+        The label of the model to compare against. Default is the first model.
+    x : str, optional
+        The grid on which ``q`` is defined, eg. "m".
+
+    Returns
+    -------
+    x : array
+        The common grid.
+    ratios : OrderedDict
+        Ratio of each (non-baseline) model to the baseline, keyed by label.
+    """
+    if baseline is None:
+        baseline = list(objects.keys())[0]
+
+    keys = [getattr(o, "key", None) for o in objects.values()]
+    cache_key = None
+    if None not in keys:
+        cache_key = "hmfcalc-compare:" + hashlib.sha1(
+            json.dumps([list(objects.keys()), keys, q, baseline, x]).encode()
+        ).hexdigest()
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    base = objects[baseline]
+    others = OrderedDict(
+        (label, o) for label, o in objects.items() if label != baseline
+    )
+    xs = [getattr(o, x) for o in others.values()]
+    ys = [getattr(o, q) for o in others.values()]
+
+    xbase = np.asarray(getattr(base, x))
+    lo = max([xbase[0]] + [xx[0] for xx in xs])
+    hi = min([xbase[-1]] + [xx[-1] for xx in xs])
+    mask = (xbase >= lo) & (xbase <= hi)
+    xnew = xbase[mask]
+
+    if len(xnew) and others:
+        ratios = _batched_loglog_interp(xs, ys, xnew) / getattr(base, q)[mask]
+    else:
+        ratios = np.zeros((len(others), len(xnew)))
+
+    result = (xnew, OrderedDict(zip(others.keys(), ratios)))
+    if cache_key is not None:
+        cache.set(cache_key, result)
+    return result
+
+
+def _plot_quantity(ax, objects, q, d, baseline=None, bands=None):
+    """
+    Plot a quantity of each model (or its ratio to the baseline) on the axes.
 
+    Models with uncertainty bands (in ``bands``, a dict of :class:`~uncertainty.Bands`
+    by label) that include the quantity have them shaded around their line.
+    """
     lines = ["-", "--", "-.", ":"]
 
     if q.startswith("comparison"):
@@ -52,10 +452,7 @@ def create_canvas(objects, q, d, plot_format="png"):
     else:
         compare = False
 
-    if len(list(objects.values())[0].m) == len(getattr(list(objects.values())[0], q)):
-        x = "m"
-    else:
-        x = "k"
+    x = quantity_grid(q)
 
     if not compare:
         for i, (l, o) in enumerate(objects.items()):
@@ -67,44 +464,299 @@ def create_canvas(objects, q, d, plot_format="png"):
                 linestyle=lines[(i // 7) % 4],
                 label=l,
             )
+
+            if bands and l in bands and q in bands[l].quantities:
+                for lower, upper in bands[l].intervals(q):
+                    ax.fill_between(
+                        bands[l].m,
+                        lower,
+                        upper,
+                        color="C{}".format((i % 7)),
+                        alpha=0.2,
+                        linewidth=0,
+                    )
     else:
-        for i, (l, o) in enumerate(objects.items()):
-            if i == 0:
-                comp_obj = o
+        xnew, ratios = comparison_ratios(objects, q, baseline=baseline, x=x)
+        for i, l in enumerate(objects.keys()):
+            if l not in ratios:
                 continue
 
-            y = getattr(o, q) / getattr(comp_obj, q)
             ax.plot(
-                getattr(o, x),
-                y,
+                xnew,
+                ratios[l],
                 color="C{}".format((i + 1) % 7),
                 linestyle=lines[((i + 1) // 7) % 4],
                 label=l,
             )
 
-    # Shrink current axis by 30%
     ax.set_xscale("log")
 
     ax.set_yscale(d["yscale"], basey=d.get("basey", 10))
     if d["yscale"] == "log":
         if d.get("basey", 10) == 2:
-            ax.yaxis.set_major_formatter(tick.ScalarFormatter())
+            from matplotlib.ticker import ScalarFormatter
+
+            ax.yaxis.set_major_formatter(ScalarFormatter())
+
+
+def _figure(**kwargs):
+    """
+    A new figure.
+
+    matplotlib (and its backends) are only imported when first plotting, as they're
+    slow to import and most requests don't plot (see :mod:`HMFcalc.preload`).
+    """
+    from matplotlib.figure import Figure
 
+    return Figure(**kwargs)
+
+
+@memory.trace("create_canvas")
+def create_canvas(objects, q, d, plot_format="png", baseline=None, bands=None):
+    # TODO: make log scaling automatic
+    fig = _figure(figsize=(10, 6), edgecolor="white", facecolor="white", dpi=100)
+    ax = fig.add_subplot(111)
+    ax.grid(True)
+    ax.set_xlabel(d["xlab"], fontsize=15)
+    ax.set_ylabel(d["ylab"], fontsize=15)
+
+    _plot_quantity(ax, objects, q, d, baseline=baseline, bands=bands)
+
+    # Shrink current axis by 30%
     box = ax.get_position()
     ax.set_position([box.x0, box.y0, box.width * 0.6, box.height])
 
     # Put a legend to the right of the current axis
     ax.legend(loc="center left", bbox_to_anchor=(1, 0.5), fontsize=15)
 
+    return print_figure(fig, plot_format)
+
+
+def gallery_layout(quantities):
+    """
+    The position (in pixels) of each thumbnail in a gallery of the given quantities.
+
+    Thumbnails are ``GALLERY_THUMBNAIL`` pixels in size, in rows of
+    ``GALLERY_COLUMNS``.
+    """
+    w, h = GALLERY_THUMBNAIL
+    return OrderedDict(
+        (q, ((i % GALLERY_COLUMNS) * w, (i // GALLERY_COLUMNS) * h))
+        for i, q in enumerate(quantities)
+    )
+
+
+def create_gallery(objects, quantities, keymap, baseline=None):
+    """
+    Thumbnails of all the given plots, in a single PNG (a sprite, see
+    :func:`gallery_layout`).
+
+    All thumbnails are drawn on one figure, and rendered together.
+    """
+    w, h = GALLERY_THUMBNAIL
+    cols = GALLERY_COLUMNS
+    rows = -(-len(quantities) // cols)
+
+    fig = _figure(figsize=(cols * w / 80, rows * h / 80), facecolor="white", dpi=80)
+    for q, (x, y) in gallery_layout(quantities).items():
+        # Leave room within each thumbnail for its tick labels.
+        ax = fig.add_axes(
+            [
+                (x + 0.2 * w) / (cols * w),
+                1 - (y + 0.88 * h) / (rows * h),
+                0.76 / cols,
+                0.82 / rows,
+            ]
+        )
+        ax.tick_params(labelsize=6)
+        _plot_quantity(ax, objects, q, keymap[q], baseline=baseline)
+
+    return print_figure(fig, "png")
+
+
+def cached_gallery(objects, quantities, keymap, baseline=None):
+    """Like :func:`create_gallery`, but cached (like :func:`cached_canvas`)."""
+    if None in [getattr(o, "key", None) for o in objects.values()]:
+        return create_gallery(objects, quantities, keymap, baseline=baseline)
+
+    cache_key = "hmfcalc-gallery:" + plot_cache_key(
+        objects, ",".join(quantities), "png", baseline
+    )
+    content = cache.get(cache_key)
+    if content is None:
+        metrics.incr("plot_cache_miss")
+        content = create_gallery(objects, quantities, keymap, baseline).getvalue()
+        cache.set(cache_key, content, settings.HMFCALC_RESULT_CACHE_TIMEOUT)
+    else:
+        metrics.incr("plot_cache_hit")
+
+    return io.BytesIO(content)
+
+
+def cached_canvas(objects, q, d, plot_format="png", baseline=None, encoding=None):
+    """
+    Like :func:`create_canvas`, but cached in the shared cache.
+
+    Plots are keyed by the labels and parameter hashes of the models in them, so only
+    plots of models that are all stored (see :func:`stored_hmf_driver`) are cached.
+
+    If ``encoding`` is given, the plot is returned compressed with it. Compressed
+    copies of compressible (ie. SVG) plots are made once, when they're cached.
+    """
+    keys = [getattr(o, "key", None) for o in objects.values()]
+    if None in keys:
+        buf = create_canvas(objects, q, d, plot_format=plot_format, baseline=baseline)
+        if encoding is None:
+            return buf
+        return io.BytesIO(compression.compress(buf.getvalue(), encoding))
+
+    cache_key = plot_cache_key(objects, q, plot_format, baseline)
+    encoded_key = cache_key if encoding is None else cache_key + ":" + encoding
+
+    content = cache.get(encoded_key)
+    if content is not None:
+        metrics.incr("plot_cache_hit")
+        return io.BytesIO(content)
+
+    content = cache.get(cache_key)
+    if content is None:
+        metrics.incr("plot_cache_miss")
+        content = create_canvas(
+            objects, q, d, plot_format=plot_format, baseline=baseline
+        ).getvalue()
+
+        values = {cache_key: content}
+        if plot_format in COMPRESSIBLE_PLOT_FORMATS:
+            for enc in compression.encodings():
+                values[cache_key + ":" + enc] = compression.compress(
+                    content, enc, fast=False
+                )
+        cache.set_many(values, settings.HMFCALC_RESULT_CACHE_TIMEOUT)
+        if encoded_key in values:
+            return io.BytesIO(values[encoded_key])
+    else:
+        metrics.incr("plot_cache_hit")
+
+    # The plot isn't cached with this encoding (eg. it was cached before it could be).
+    content = compression.compress(content, encoding, fast=False)
+    cache.set(encoded_key, content, settings.HMFCALC_RESULT_CACHE_TIMEOUT)
+    return io.BytesIO(content)
+
+
+def cached_page(view):
+    """
+    Cache the whole response of a view that doesn't depend on the session.
+
+    Responses are cached per URL and per deploy. Only plain GET requests are cached.
+    """
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method != "GET" or request.GET:
+            return view(request, *args, **kwargs)
+
+        cache_key = "hmfcalc-page:{}:{}".format(
+            settings.HMFCALC_DEPLOY_ID, hashlib.sha1(request.path.encode()).hexdigest()
+        )
+        response = cache.get(cache_key)
+        if response is None:
+            metrics.incr("page_cache_miss")
+            response = view(request, *args, **kwargs)
+            if hasattr(response, "render"):
+                response.render()
+            if response.status_code == 200:
+                cache.set(cache_key, response, settings.HMFCALC_PAGE_CACHE_TIMEOUT)
+        else:
+            metrics.incr("page_cache_hit")
+
+        return response
+
+    return wrapper
+
+
+def plot_cache_key(objects, q, plot_format="png", baseline=None):
+    """The key under which a plot of the given (stored) models is cached."""
+    if baseline is None:
+        baseline = list(objects.keys())[0]
+
+    models = [[label, o.key] for label, o in objects.items()]
+    return "hmfcalc-plot:" + hashlib.sha1(
+        json.dumps([models, q, plot_format, baseline]).encode()
+    ).hexdigest()
+
+
+def print_figure(fig, plot_format="png"):
+    """Render a figure to a new buffer in the given format."""
     buf = io.BytesIO()
 
     if plot_format == "png":
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
         FigureCanvasAgg(fig).print_png(buf)
     elif plot_format == "pdf":
+        from matplotlib.backends.backend_pdf import FigureCanvasPdf
+
         FigureCanvasPdf(fig).print_pdf(buf)
     elif plot_format == "svg":
+        from matplotlib.backends.backend_svg import FigureCanvasSVG
+
         FigureCanvasSVG(fig).print_svg(buf)
     else:
         raise ValueError("plot_format should be png, pdf or svg!")
 
     return buf
+
+
+def _zseries_axes(series, q, d):
+    fig = _figure(figsize=(10, 6), edgecolor="white", facecolor="white", dpi=100)
+    ax = fig.add_subplot(111)
+    ax.grid(True)
+    ax.set_xlabel(d["xlab"], fontsize=15)
+    ax.set_ylabel(d["ylab"], fontsize=15)
+    ax.set_xscale("log")
+    ax.set_yscale(d["yscale"])
+    return fig, ax, getattr(series, zseries.SERIES_QUANTITIES[q])
+
+
+def create_zseries_canvas(series, q, d, plot_format="png"):
+    """Plot quantity ``q`` of a redshift series, with one line per redshift."""
+    from matplotlib import cm
+    from matplotlib.colors import Normalize
+
+    fig, ax, x = _zseries_axes(series, q, d)
+
+    norm = Normalize(vmin=series.z.min(), vmax=series.z.max())
+    for z, y in zip(series.z, getattr(series, q)):
+        ax.plot(x, y, color=cm.viridis(norm(z)))
+
+    sm = cm.ScalarMappable(norm=norm, cmap=cm.viridis)
+    sm.set_array(series.z)
+    fig.colorbar(sm, ax=ax).set_label("Redshift", fontsize=15)
+
+    return print_figure(fig, plot_format)
+
+
+def create_zseries_frames(series, q, d):
+    """
+    Render one PNG frame per redshift of quantity ``q``, for animation.
+
+    The figure is set up once, with fixed limits, and only the line is updated for
+    each frame. Returns a buffer containing a zip archive of the frames.
+    """
+    fig, ax, x = _zseries_axes(series, q, d)
+    y = getattr(series, q)
+
+    finite = y[np.isfinite(y) & ((y > 0) | (d["yscale"] != "log"))]
+    if len(finite):
+        ax.set_ylim(finite.min(), finite.max())
+    (line,) = ax.plot(x, y[0])
+    title = ax.set_title("")
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as archive:
+        for i, z in enumerate(series.z):
+            line.set_ydata(y[i])
+            title.set_text("z = {:.3g}".format(z))
+            archive.writestr("{}_{:03d}.png".format(q, i), print_figure(fig).getvalue())
+
+    return buf
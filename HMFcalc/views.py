@@ -3,13 +3,24 @@ import datetime
 # import logging
 import io
 import logging
-import zipfile
+import uuid
 from collections import OrderedDict
 
 import numpy as np
 from django.conf import settings
 from django.core.mail import send_mail
-from django.http import HttpResponse, HttpResponseRedirect
+from django.contrib.staticfiles import finders
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    JsonResponse,
+)
+from django.shortcuts import render
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
 from django.views.generic.base import TemplateView
 from django.views.generic.edit import FormView
 from hmf import __version__
@@ -17,7 +28,21 @@ from hmf import wdm, MassFunction
 from tabination.views import TabView
 
 from . import forms
-from . import utils
+from . import (
+    compression,
+    emulator,
+    export,
+    kgrid,
+    memory,
+    metrics,
+    prerender,
+    preview,
+    sandbox,
+    session_models,
+    uncertainty,
+    utils,
+    zseries,
+)
 from . import version as calc_version
 
 logger = logging.getLogger(__name__)
@@ -75,6 +100,9 @@ class HMFInputBase(FormView):
                 hmf_dict["Mmin"] = v[0]
                 hmf_dict["Mmax"] = v[1]
                 continue
+            elif k == "k_accuracy":
+                # Not an hmf argument: used to choose lnk_min, lnk_max and dlnk.
+                continue
 
             component = getattr(form.fields[k], "component", None)
 
@@ -120,23 +148,51 @@ class HMFInputBase(FormView):
         label = form.cleaned_data["label"]
 
         cls, hmf_dict = self.cleaned_data_to_hmf_dict(form)
+
+        target = form.cleaned_data.get("k_accuracy")
+        if target:
+            try:
+                grid = kgrid.choose(cls, hmf_dict, target)
+            except sandbox.ComputeLimitExceeded as e:
+                form.add_error(None, str(e))
+                return self.form_invalid(form)
+            hmf_dict.update(lnk_min=grid.lnk_min, lnk_max=grid.lnk_max, dlnk=grid.dlnk)
+
         logger.info("Constructed hmf_dct: %s", hmf_dict)
 
         previous = self.kwargs.get("label", None)
 
-        if previous and previous in self.request.session["objects"]:
-            previous = self.request.session["objects"].get(previous)
+        if previous:
+            previous = session_models.get_model(self.request.session, previous)
+
+        changed = None
+        if previous is not None:
+            changed = utils.changed_parameters(previous, cls, **hmf_dict)
+            if not changed:
+                metrics.incr("recompute_avoided")
+            logger.info(
+                "Edited %s: changed %s (%d recomputations avoided so far)",
+                label,
+                ", ".join(sorted(changed)) or "nothing numeric",
+                metrics.snapshot().get("recompute_avoided", 0),
+            )
 
-        # Calculate all objects
-        obj = utils.hmf_driver(previous=previous, cls=cls, **hmf_dict)
+        if changed == {}:
+            # Only the label (or nothing at all) has changed.
+            obj = previous
+        else:
+            # Calculate all objects
+            try:
+                obj = utils.stored_hmf_driver(previous=previous, cls=cls, **hmf_dict)
+            except sandbox.ComputeLimitExceeded as e:
+                form.add_error(None, str(e))
+                return self.form_invalid(form)
 
-        if "objects" not in self.request.session:
-            self.request.session["objects"] = OrderedDict()
-        if "forms" not in self.request.session:
-            self.request.session["forms"] = OrderedDict()
+        if target:
+            kgrid.record_error(obj, grid)
 
-        self.request.session["objects"].update({label: obj})
-        self.request.session["forms"].update({label: form.data})
+        session_models.set_model(self.request.session, label, obj, form.data)
+        _prerender(self.request)
 
         return super().form_valid(form)
 
@@ -146,13 +202,13 @@ class HMFInputCreate(HMFInputBase):
         kwargs = super().get_form_kwargs()
         prev_label = self.kwargs.get("label", None)
 
-        forms = self.request.session.get("forms", None)
-
         kwargs.update(
             current_models=self.request.session.get("objects", None),
             model_label=prev_label,
             #            previous_form=forms.get(prev_label, None) if prev_label else None,
-            initial=forms.get(prev_label, None) if prev_label else None,
+            initial=session_models.get_form(self.request.session, prev_label)
+            if prev_label
+            else None,
         )
         return kwargs
 
@@ -167,7 +223,7 @@ class HMFInputEdit(HMFInputCreate):
         """
         Handles GET requests and instantiates a blank version of the form.
         """
-        if kwargs.get("label", "") not in self.request.session.get("objects", {}):
+        if kwargs.get("label", "") not in session_models.labels(self.request.session):
             return HttpResponseRedirect("/hmfcalc/create/")
 
         return super().get(request, *args, **kwargs)
@@ -176,35 +232,34 @@ class HMFInputEdit(HMFInputCreate):
         result = super().form_valid(form)
 
         # If editing, and the label was changed, we need to remove the old label.
-        if form.cleaned_data["label"] != self.kwargs["label"]:
-            del self.request.session["objects"][self.kwargs["label"]]
-            del self.request.session["forms"][self.kwargs["label"]]
+        if not form.errors and form.cleaned_data["label"] != self.kwargs["label"]:
+            session_models.delete_model(self.request.session, self.kwargs["label"])
+            _prerender(self.request)
 
         return result
 
 
 def delete_plot(request, label):
-    if len(request.session["objects"]) > 1:
+    if len(session_models.labels(request.session)) > 1:
+        session_models.delete_model(request.session, label)
+        _prerender(request)
 
-        try:
-            del request.session["objects"][label]
-        except KeyError:
-            pass
+    return HttpResponseRedirect("/hmfcalc/")
 
-        try:
-            del request.session["forms"][label]
-        except KeyError:
-            pass
 
-    return HttpResponseRedirect("/hmfcalc/")
+def favicon(request):
+    """The favicon, served locally (browsers ask for it at the root)."""
+    path = finders.find("HMFcalc/img/favicon.ico")
+    if path is None:
+        raise Http404
+
+    response = FileResponse(open(path, "rb"), content_type="image/x-icon")
+    response["Cache-Control"] = "public, max-age=604800"
+    return response
 
 
 def complete_reset(request):
-    try:
-        del request.session["objects"]
-        del request.session["forms"]
-    except KeyError:
-        pass
+    session_models.clear(request.session)
 
     return HttpResponseRedirect("/hmfcalc/")
 
@@ -212,20 +267,41 @@ def complete_reset(request):
 class ViewPlots(BaseTab):
     def get(self, request, *args, **kwargs):
         # Create a default MassFunction object that displays upon opening.
-        if "objects" not in request.session:
-            default_obj = MassFunction()
-
-            request.session["objects"] = OrderedDict(default=default_obj)
-            request.session["forms"] = OrderedDict()
+        # It's built from the input form's defaults, like the model that warm_cache
+        # pre-computes, so that they share a key (and cached plots).
+        if not session_models.labels(request.session):
+            form = forms.HMFInput(data=forms.HMFInput.default_data())
+            form.is_valid()
+            cls, hmf_dict = HMFInputBase().cleaned_data_to_hmf_dict(form)
+            default_obj = utils.stored_hmf_driver(cls=cls, **hmf_dict)
+            session_models.set_model(request.session, "default", default_obj, form.data)
+            _prerender(request)
 
         self.form = forms.PlotChoice(request)
 
+        # Thumbnails of every plot, as positions within the gallery sprite.
+        choices = self.form.fields["plot_choice"].choices
+        layout = utils.gallery_layout([q for q, _ in choices])
+        gallery = [(q, label) + layout[q] for q, label in choices]
+
+        # The size of each model, whether it's on disk, and the estimated error (%) of
+        # its wavenumber grid (if it was chosen automatically).
+        footprints = OrderedDict()
+        for label, footprint in session_models.footprints(request.session).items():
+            error = kgrid.estimated_error(request.session["objects"][label])
+            footprints[label] = footprint + (None if error is None else 100 * error,)
+
         self.warnings = ""  # request.session['warnings']
         return self.render_to_response(
             self.get_context_data(
                 form=self.form,
                 warnings=self.warnings,
                 objects=request.session["objects"],
+                footprints=footprints,
+                zseries_form=forms.RedshiftSeriesForm(),
+                uncertainty_form=forms.UncertaintyForm(),
+                gallery=gallery,
+                thumbnail_size=utils.GALLERY_THUMBNAIL,
             )
         )
 
@@ -236,18 +312,89 @@ class ViewPlots(BaseTab):
     top = True
 
 
-def plots(request, filetype, plottype):
+def live_preview(request):
     """
-    Chooses the type of plot needed and the filetype (pdf or png) and outputs it
+    A quick, coarse preview of dn/dm for the (unsaved) parameters of the input form.
+
+    The form is POSTed, along with ``seq``, the number of this request from the
+    client. Requests superseded by a newer one are dropped (returning ``stale``).
+    Otherwise, the response includes the URL from which the full-resolution result
+    may be fetched once it has been computed in the background.
     """
-    objects = request.session.get("objects", None)
+    if request.method != "POST":
+        return HttpResponseBadRequest("Previews must be POSTed")
 
-    if not objects:
-        return HttpResponseRedirect("/hmfcalc/")
+    try:
+        seq = int(request.POST.get("seq", 0))
+    except ValueError:
+        return HttpResponseBadRequest("seq must be an integer")
+
+    if "preview_id" not in request.session:
+        request.session["preview_id"] = uuid.uuid4().hex
+    client = request.session["preview_id"]
+
+    if not preview.is_latest(client, seq):
+        return JsonResponse({"seq": seq, "stale": True})
+
+    form = forms.HMFInput(data=request.POST, files=request.FILES, edit=True)
+    if not form.is_valid():
+        return JsonResponse({"seq": seq, "errors": form.errors}, status=400)
+
+    cls, hmf_dict = HMFInputBase().cleaned_data_to_hmf_dict(form)
+    key = utils.parameter_hash(cls, **hmf_dict)
+
+    fine = preview.refined(key)
+    if fine is not None:
+        m, dndm = fine
+        return JsonResponse(
+            {
+                "seq": seq,
+                "resolution": "fine",
+                "m": preview.as_json(m),
+                "dndm": preview.as_json(dndm),
+            }
+        )
 
-    if filetype not in ["png", "svg", "pdf", "zip"]:
-        raise ValueError("{} is not a valid plot filetype".format(filetype))
+    preview.refine(client, cls, hmf_dict)
+    try:
+        obj = preview.coarse(cls, hmf_dict)
+    except sandbox.ComputeLimitExceeded as e:
+        return JsonResponse({"seq": seq, "errors": {"__all__": [str(e)]}}, status=400)
+
+    return JsonResponse(
+        {
+            "seq": seq,
+            "resolution": "coarse",
+            "m": preview.as_json(obj.m),
+            "dndm": preview.as_json(obj.dndm),
+            "refined": reverse("preview-refined", args=[key]),
+        }
+    )
 
+
+def live_preview_refined(request, key):
+    """The full-resolution preview of a model, once it has been computed."""
+    fine = preview.refined(key)
+    if fine is None:
+        return JsonResponse({"pending": True})
+
+    m, dndm = fine
+    return JsonResponse(
+        {"resolution": "fine", "m": preview.as_json(m), "dndm": preview.as_json(dndm)}
+    )
+
+
+def _prerender(request):
+    """Start rendering the plots that are likely to be viewed next, if they're not."""
+    objects = session_models.get_models(request.session)
+    if objects and settings.HMFCALC_PRERENDER_PLOTS:
+        prerender.schedule(
+            request.session, objects, get_keymap(list(objects.keys())[0])
+        )
+
+
+def get_keymap(baseline=None):
+    """Axis labels and scalings for each plot type."""
     MLABEL = r"Mass $(M_{\odot}h^{-1})$"
     KLABEL = r"Wavenumber, $k$ [$h$/Mpc]"
 
@@ -309,22 +456,53 @@ def plots(request, filetype, plottype):
         "comparison_dndm": {
             "xlab": MLABEL,
             "ylab": r"Ratio of Mass Functions $ \left(\frac{dn}{dM}\right) / \left( \frac{dn}{dM} \right)_{%s} $"
-            % list(objects.keys())[0],
+            % baseline,
             "yscale": "log",
             "basey": 2,
         },
         "comparison_fsigma": {
             "xlab": MLABEL,
             "ylab": r"Ratio of Fitting Functions $f(\sigma)/ f(\sigma)_{%s}$"
-            % list(objects.keys())[0],
+            % baseline,
             "yscale": "log",
             "basey": 2,
         },
     }
 
-    figure_buf = utils.create_canvas(
-        objects, plottype, keymap[plottype], plot_format=filetype
+    return keymap
+
+
+def plots(request, filetype, plottype):
+    """
+    Chooses the type of plot needed and the filetype (pdf or png) and outputs it
+    """
+    objects = session_models.get_models(request.session)
+
+    if not objects:
+        return HttpResponseRedirect("/hmfcalc/")
+
+    if filetype not in ["png", "svg", "pdf", "zip"]:
+        raise ValueError("{} is not a valid plot filetype".format(filetype))
+
+    baseline = request.GET.get("baseline", None)
+    if baseline not in objects:
+        baseline = list(objects.keys())[0]
+
+    keymap = get_keymap(baseline)
+
+    encoding = None
+    if filetype in utils.COMPRESSIBLE_PLOT_FORMATS:
+        encoding = compression.accepted_encoding(request)
+
+    figure_buf = utils.cached_canvas(
+        objects,
+        plottype,
+        keymap[plottype],
+        plot_format=filetype,
+        baseline=baseline,
+        encoding=encoding,
     )
+    prerender.record_view(plottype, filetype)
 
     # How to output the image
     if filetype == "png":
@@ -337,16 +515,292 @@ def plots(request, filetype, plottype):
     elif filetype == "zip":
         response = io.StringIO()
 
+    if filetype in utils.COMPRESSIBLE_PLOT_FORMATS:
+        patch_vary_headers(response, ("Accept-Encoding",))
+        if encoding is not None:
+            response["Content-Encoding"] = encoding
+
+    return response
+
+
+def gallery(request):
+    """Thumbnails of every plot of the current models, in a single PNG sprite."""
+    objects = session_models.get_models(request.session)
+
+    if not objects:
+        return HttpResponseRedirect("/hmfcalc/")
+
+    baseline = request.GET.get("baseline", None)
+    if baseline not in objects:
+        baseline = list(objects.keys())[0]
+
+    quantities = [q for q, _ in forms.PlotChoice(request).fields["plot_choice"].choices]
+    buf = utils.cached_gallery(
+        objects, quantities, get_keymap(baseline), baseline=baseline
+    )
+    return HttpResponse(buf.getvalue(), content_type="image/png")
+
+
+def memory_report(request):
+    """A debug page of the memory used by the session and its models."""
+    if not settings.HMFCALC_MEMORY_DEBUG:
+        raise Http404
+
+    models = [
+        {
+            "label": label,
+            "pickled": memory.pickled_size(o),
+            "attributes": memory.attribute_sizes(o),
+        }
+        for label, o in session_models.get_models(request.session).items()
+    ]
+    sizes = [s for s in memory.session_sizes() if s is not None]
+
+    return render(
+        request,
+        "memory.html",
+        {
+            "session_size": memory.pickled_size(dict(request.session.items())),
+            "largest_session": max(sizes) if sizes else None,
+            "peaks": memory.peaks(),
+            "models": models,
+        },
+    )
+
+
+def _get_zseries(request, label):
+    """
+    Get the redshift series of a model, for redshifts given in the query string.
+
+    Returns the series, or a response to return instead.
+    """
+    obj = session_models.get_models(request.session).get(label)
+
+    if obj is None:
+        return HttpResponseRedirect("/hmfcalc/")
+
+    form = forms.RedshiftSeriesForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest(form.errors.as_text())
+
+    try:
+        return zseries.cached_redshift_series(obj, form.redshifts())
+    except sandbox.ComputeLimitExceeded as e:
+        return HttpResponseBadRequest(str(e))
+
+
+def zseries_plots(request, label, plottype, filetype):
+    """
+    Plot the redshift evolution of a quantity, with one line per redshift.
+    """
+    if filetype not in ["png", "svg", "pdf"]:
+        raise ValueError("{} is not a valid plot filetype".format(filetype))
+    if plottype not in zseries.SERIES_QUANTITIES:
+        raise ValueError("{} can not be plotted against redshift".format(plottype))
+
+    series = _get_zseries(request, label)
+    if isinstance(series, HttpResponse):
+        return series
+
+    figure_buf = utils.create_zseries_canvas(
+        series, plottype, get_keymap()[plottype], plot_format=filetype
+    )
+
+    if filetype == "png":
+        response = HttpResponse(figure_buf.getvalue(), content_type="image/png")
+    elif filetype == "svg":
+        response = HttpResponse(figure_buf.getvalue(), content_type="image/svg+xml")
+    elif filetype == "pdf":
+        response = HttpResponse(figure_buf.getvalue(), content_type="application/pdf")
+        response["Content-Disposition"] = "attachment;filename=" + plottype + ".pdf"
+
+    return response
+
+
+def zseries_frames(request, label, plottype):
+    """
+    A zip of PNG frames (one per redshift) of a quantity, for making animations.
+    """
+    if plottype not in zseries.SERIES_QUANTITIES:
+        raise ValueError("{} can not be plotted against redshift".format(plottype))
+
+    series = _get_zseries(request, label)
+    if isinstance(series, HttpResponse):
+        return series
+
+    buf = utils.create_zseries_frames(series, plottype, get_keymap()[plottype])
+
+    response = HttpResponse(buf.getvalue(), content_type="application/zip")
+    response["Content-Disposition"] = "attachment; filename=%s_frames.zip" % plottype
+    return response
+
+
+def zseries_data(request, label):
+    """
+    All quantities of the redshift series of a model, as a numpy .npz file.
+
+    The file contains ``z``, ``m`` and ``k`` arrays, and a 2D array of shape
+    ``(len(z), len(m))`` (or ``len(k)``) for each quantity.
+    """
+    series = _get_zseries(request, label)
+    if isinstance(series, HttpResponse):
+        return series
+
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **series.arrays())
+
+    response = HttpResponse(buf.getvalue(), content_type="application/octet-stream")
+    response["Content-Disposition"] = "attachment; filename=zseries_%s.npz" % label
+    return response
+
+
+def uncertainty_bands(request, label):
+    """
+    Compute the uncertainty bands of a model, from a distribution of its parameters.
+
+    The distribution is POSTed as a :class:`~forms.UncertaintyForm`. The response
+    includes the number of samples (and of those that failed), and the key under which
+    the bands may be plotted (see :func:`uncertainty_plots`) and downloaded.
+    """
+    if request.method != "POST":
+        return HttpResponseBadRequest("Uncertainty bands must be POSTed")
+
+    obj = session_models.get_models(request.session).get(label)
+    if obj is None:
+        return HttpResponseRedirect("/hmfcalc/")
+
+    form = forms.UncertaintyForm(data=request.POST, files=request.FILES)
+    if not form.is_valid():
+        return JsonResponse({"errors": form.errors}, status=400)
+
+    names, rows = form.draws()
+    try:
+        bands = uncertainty.cached_bands(obj, names, rows)
+    except (sandbox.ComputeLimitExceeded, ValueError) as e:
+        return JsonResponse({"errors": {"__all__": [str(e)]}}, status=400)
+
+    return JsonResponse(
+        {
+            "key": bands.key,
+            "parameters": bands.names,
+            "n": bands.n,
+            "failed": bands.failed,
+            "data": reverse("uncertainty-data", args=[label, bands.key]),
+        }
+    )
+
+
+def _get_bands(request, label, key):
+    """
+    Get a model and its uncertainty bands (computed by :func:`uncertainty_bands`).
+
+    Returns both, or a response to return instead.
+    """
+    obj = session_models.get_models(request.session).get(label)
+
+    if obj is None:
+        return HttpResponseRedirect("/hmfcalc/")
+
+    bands = uncertainty.get_bands(key)
+    if bands is None or bands.model_key != getattr(obj, "key", None):
+        raise Http404(
+            "These uncertainty bands have expired. Please compute them again."
+        )
+
+    return obj, bands
+
+
+def uncertainty_plots(request, label, key, plottype, filetype):
+    """
+    Plot a quantity of a model, with its uncertainty bands shaded.
+    """
+    if filetype not in ["png", "svg", "pdf"]:
+        raise ValueError("{} is not a valid plot filetype".format(filetype))
+    if plottype not in uncertainty.QUANTITIES:
+        raise ValueError("{} has no uncertainty bands".format(plottype))
+
+    result = _get_bands(request, label, key)
+    if isinstance(result, HttpResponse):
+        return result
+    obj, bands = result
+
+    figure_buf = utils.create_canvas(
+        {label: obj},
+        plottype,
+        get_keymap()[plottype],
+        plot_format=filetype,
+        bands={label: bands},
+    )
+
+    if filetype == "png":
+        response = HttpResponse(figure_buf.getvalue(), content_type="image/png")
+    elif filetype == "svg":
+        response = HttpResponse(figure_buf.getvalue(), content_type="image/svg+xml")
+    elif filetype == "pdf":
+        response = HttpResponse(figure_buf.getvalue(), content_type="application/pdf")
+        response["Content-Disposition"] = "attachment;filename=" + plottype + ".pdf"
+
+    return response
+
+
+def uncertainty_data(request, label, key):
+    """
+    The uncertainty bands of a model, as a numpy .npz file.
+
+    The file contains ``m`` and ``percentiles`` arrays, and a 2D array of shape
+    ``(len(percentiles), len(m))`` for each quantity.
+    """
+    result = _get_bands(request, label, key)
+    if isinstance(result, HttpResponse):
+        return result
+    _, bands = result
+
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **bands.arrays())
+
+    response = HttpResponse(buf.getvalue(), content_type="application/octet-stream")
+    response["Content-Disposition"] = "attachment; filename=uncertainty_%s.npz" % label
     return response
 
 
+def fast_hmf(request):
+    """
+    A fast, approximate (emulated) mass function, as JSON.
+
+    Parameters are given in the query string (see :class:`forms.EmulatorForm`).
+    If they're outside the range the emulator was trained on, the exact
+    calculation is done instead. Each quantity comes with its estimated fractional
+    error.
+    """
+    form = forms.EmulatorForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest(form.errors.as_text())
+
+    params = form.cleaned_data
+    try:
+        result = emulator.fast_hmf(
+            params["hmf_model"],
+            params,
+            params["Mmin"],
+            params["Mmax"],
+            params["dlog10m"],
+            transfer_model=settings.HMFCALC_EMULATOR_TRANSFER,
+        )
+    except (sandbox.ComputeLimitExceeded, ValueError) as e:
+        return HttpResponseBadRequest(str(e))
+
+    return JsonResponse(
+        {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in result.items()}
+    )
+
+
 def header_txt(request):
     # Set up the response object as a text file
     response = HttpResponse(content_type="text/plain")
     response["Content-Disposition"] = "attachment; filename=parameters.txt"
 
     # Import all the input form data so it can be written to file
-    objects = request.session["objects"]
+    objects = session_models.get_models(request.session)
 
     labels = list(objects.keys())
     objects = list(objects.values())
@@ -369,115 +823,129 @@ def header_txt(request):
         return response
 
 
+# Descriptions (and units) of each exported column.
+COLUMN_HEADERS = {
+    "m": "m:            [M_sun/h]",
+    "sigma": "sigma",
+    "lnsigma": "ln(1/sigma)",
+    "n_eff": "n_eff",
+    "fsigma": "f(sigma)",
+    "dndm": "dn/dm:        [h^4/(Mpc^3*M_sun)]",
+    "dndlnm": "dn/dlnm:      [h^3/Mpc^3]",
+    "dndlog10m": "dn/dlog10m:   [h^3/Mpc^3]",
+    "ngtm": "n(>m):        [h^3/Mpc^3]",
+    "rho_gtm": "rho(>m):     [M_sun*h^2/Mpc^3]",
+    "rho_ltm": "rho(<m):     [M_sun*h^2/Mpc^3]",
+    "how_big": "Lbox(N=1):   [Mpc/h]",
+    "k": "k:    [h/Mpc]",
+    "power": "P:    [Mpc^3/h^3]",
+    "transfer_function": "T:    ",
+    "delta_k": "Delta_k",
+}
+
+
+def export_columns(request):
+    """
+    The mass- and k-based quantities requested for export (default all of them).
+
+    Returns None if any requested column is invalid.
+    """
+    columns = [c for c in request.GET.get("columns", "").split(",") if c]
+    if not columns:
+        return utils.MASS_QUANTITIES, utils.K_QUANTITIES
+
+    if set(columns) - set(utils.MASS_QUANTITIES + utils.K_QUANTITIES):
+        return None
+
+    return (
+        tuple(q for q in utils.MASS_QUANTITIES if q in columns),
+        tuple(q for q in utils.K_QUANTITIES if q in columns),
+    )
+
+
+def _table_member(filename, o, columns):
+    """A member of an exported archive (see :func:`export.zip_archive`)."""
+    return (
+        filename,
+        [np.asarray(getattr(o, q)) for q in columns],
+        [COLUMN_HEADERS[q] for q in columns],
+    )
+
+
 def data_output(request):
+    """
+    ASCII tables of the quantities of each model, in a zip archive.
+
+    The quantities may be chosen with ``?columns=`` (comma-separated). Only the
+    chosen quantities (and what they depend on) are computed.
+    """
     # TODO: output HDF5 format
-    # Import all the data we need
-    objects = request.session["objects"]
+    columns = export_columns(request)
+    if columns is None:
+        return HttpResponseBadRequest("Invalid columns")
+    mass_columns, k_columns = columns
 
-    labels = list(objects.keys())
-    objects = list(objects.values())
+    # Import all the data we need
+    objects = session_models.get_models(request.session)
+
+    # Mass-based and k-based data files, formatted and compressed in parallel
+    members = []
+    for label, o in objects.items():
+        if mass_columns:
+            members.append(
+                _table_member("mVector_{}.txt".format(label), o, ("m",) + mass_columns)
+            )
+        if k_columns:
+            members.append(
+                _table_member("kVector_{}.txt".format(label), o, ("k",) + k_columns)
+            )
 
-    # Open up file-like objects for response
-    response = HttpResponse(content_type="application/zip")
+    response = HttpResponse(export.zip_archive(members), content_type="application/zip")
     response["Content-Disposition"] = "attachment; filename=all_plots.zip"
-    buff = io.BytesIO()
-    archive = zipfile.ZipFile(buff, "w", zipfile.ZIP_DEFLATED)
-
-    # Write out mass-based and k-based data files
-    for i, o in enumerate(objects):
-        s = io.BytesIO()
-
-        # MASS BASED
-        s.write(b"# [1] m:            [M_sun/h] \n")
-        s.write(b"# [2] sigma \n")
-        s.write(b"# [3] ln(1/sigma) \n")
-        s.write(b"# [4] n_eff \n")
-        s.write(b"# [5] f(sigma) \n")
-        s.write(b"# [6] dn/dm:        [h^4/(Mpc^3*M_sun)] \n")
-        s.write(b"# [7] dn/dlnm:      [h^3/Mpc^3] \n")
-        s.write(b"# [8] dn/dlog10m:   [h^3/Mpc^3] \n")
-        s.write(b"# [9] n(>m):        [h^3/Mpc^3] \n")
-        s.write(b"# [10] rho(>m):     [M_sun*h^2/Mpc^3] \n")
-        s.write(b"# [11] rho(<m):     [M_sun*h^2/Mpc^3] \n")
-        s.write(b"# [12] Lbox(N=1):   [Mpc/h]\n")
-
-        out = np.array(
-            [
-                o.m,
-                o.sigma,
-                o.lnsigma,
-                o.n_eff,
-                o.fsigma,
-                o.dndm,
-                o.dndlnm,
-                o.dndlog10m,
-                o.ngtm,
-                o.rho_gtm,
-                o.rho_ltm,
-                o.how_big,
-            ]
-        ).T
-        np.savetxt(s, out)
-
-        archive.writestr("mVector_{}.txt".format(labels[i]), s.getvalue())
-
-        s.close()
-        s = io.BytesIO()
-
-        # K BASED
-        s.write(b"# [1] k:    [h/Mpc] \n")
-        s.write(b"# [2] P:    [Mpc^3/h^3] \n")
-        s.write(b"# [3] T:     \n")
-        s.write(b"# [4] Delta_k \n")
-
-        out = np.exp(np.array([o.k, o.power, o.transfer_function, o.delta_k]).T)
-        np.savetxt(s, out)
-        archive.writestr("kVector_{}.txt".format(labels[i]), s.getvalue())
-
-    archive.close()
-    buff.flush()
-    ret_zip = buff.getvalue()
-    buff.close()
-    response.write(ret_zip)
     return response
 
 
-def halogen(request):
-    # Import all the data we need
-    objects = request.session["objects"]
+def data_npz(request):
+    """
+    The quantities of each model as a (binary) .npz file.
 
-    labels = list(objects.keys())
-    objects = list(objects.values())
+    Arrays are named ``<label>_<quantity>``. The quantities may be chosen with
+    ``?columns=``, as for :func:`data_output`.
+    """
+    columns = export_columns(request)
+    if columns is None:
+        return HttpResponseBadRequest("Invalid columns")
+    mass_columns, k_columns = columns
 
-    # Open up file-like objects for response
-    response = HttpResponse(content_type="application/zip")
-    response["Content-Disposition"] = "attachment; filename=halogen.zip"
-    buff = io.BytesIO()
-    archive = zipfile.ZipFile(buff, "w", zipfile.ZIP_DEFLATED)
+    objects = session_models.get_models(request.session)
 
-    # Write out ngtm and lnP data files
-    for i, o in enumerate(objects):
-        s = io.BytesIO()
+    arrays = {}
+    for label, o in objects.items():
+        for q in (("m",) + mass_columns if mass_columns else ()) + (
+            ("k",) + k_columns if k_columns else ()
+        ):
+            arrays["{}_{}".format(label, q)] = getattr(o, q)
+
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
 
-        # MASS BASED
-        out = np.array([o.m, o.ngtm]).T
-        np.savetxt(s, out)
+    response = HttpResponse(buf.getvalue(), content_type="application/octet-stream")
+    response["Content-Disposition"] = "attachment; filename=all_data.npz"
+    return response
 
-        archive.writestr("ngtm_%s.txt" % labels[i], s.getvalue())
 
-        s.close()
-        s = io.StringIO()
+def halogen(request):
+    # Import all the data we need
+    objects = session_models.get_models(request.session)
 
-        # K BASED
-        out = np.array([o.k, o.power]).T
-        np.savetxt(s, out)
-        archive.writestr("matterpower_%s.txt" % labels[i], s.getvalue())
+    # ngtm and lnP data files, formatted and compressed in parallel
+    members = []
+    for label, o in objects.items():
+        members.append(("ngtm_%s.txt" % label, [o.m, o.ngtm], None))
+        members.append(("matterpower_%s.txt" % label, [o.k, o.power], None))
 
-    archive.close()
-    buff.flush()
-    ret_zip = buff.getvalue()
-    buff.close()
-    response.write(ret_zip)
+    response = HttpResponse(export.zip_archive(members), content_type="application/zip")
+    response["Content-Disposition"] = "attachment; filename=halogen.zip"
     return response
 
 
@@ -0,0 +1,218 @@
+"""
+Evaluate a model at many redshifts at once.
+
+Only the growth factor changes with redshift, so the transfer function, the
+(z=0) mass variance and its derivative are computed once. The growth factor is
+evaluated for all redshifts in a single vectorized call, and the mass function
+quantities are computed as 2D (z x m) arrays. Series are computed in a child process
+(see :mod:`~HMFcalc.sandbox`), like the models themselves.
+"""
+import copy
+import hashlib
+import json
+import logging
+
+import numpy as np
+from django.core.cache import cache
+from hmf import MassFunction
+from hmf.mass_function import fitting_functions as ff
+
+from . import array_store, sandbox
+
+logger = logging.getLogger(__name__)
+
+# Quantities of a series that are 2D arrays, and the grid they're defined on.
+SERIES_QUANTITIES = {
+    "sigma": "m",
+    "lnsigma": "m",
+    "fsigma": "m",
+    "dndm": "m",
+    "dndlnm": "m",
+    "dndlog10m": "m",
+    "ngtm": "m",
+    "rho_gtm": "m",
+    "rho_ltm": "m",
+    "how_big": "m",
+    "power": "k",
+    "delta_k": "k",
+}
+
+
+class RedshiftSeries:
+    """
+    The quantities of a model at many redshifts.
+
+    Each quantity in :data:`SERIES_QUANTITIES` is an attribute of shape
+    ``(len(z), len(m))`` or ``(len(z), len(k))``.
+    """
+
+    def __init__(self, z, m, k, **quantities):
+        self.z = z
+        self.m = m
+        self.k = k
+        self.quantities = quantities
+
+    def __getattr__(self, name):
+        if name.startswith("_") or "quantities" not in self.__dict__:
+            raise AttributeError(name)
+        try:
+            return self.quantities[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def arrays(self):
+        """All arrays of the series, by name (eg. for saving)."""
+        return dict(self.quantities, z=self.z, m=self.m, k=self.k)
+
+
+def growth_factors(obj, z):
+    """The growth factor of ``obj`` at each of the redshifts ``z``."""
+    try:
+        g = np.asarray(obj.growth.growth_factor(z), dtype=float)
+        if g.shape == z.shape:
+            return g
+    except (TypeError, ValueError):
+        pass
+
+    # Not every growth model is vectorized.
+    return np.array([obj.growth.growth_factor(zz) for zz in z])
+
+
+def _can_vectorize(obj):
+    """Whether the fast path reproduces what hmf would compute for ``obj``."""
+    if type(obj) is not MassFunction or isinstance(obj.hmf, ff.Behroozi):
+        return False
+
+    measured = getattr(obj.hmf, "measured_mass_definition", None)
+    return measured is None or obj.disable_mass_conversion or measured == obj.mdef
+
+
+def _cumulative_gtm(lnm, y):
+    """Cumulative integral (from above) of ``y`` over ``ln(m)``, along the last axis."""
+    segments = 0.5 * (y[:, 1:] + y[:, :-1]) * np.diff(lnm)
+    out = np.zeros_like(y)
+    out[:, :-1] = np.cumsum(segments[:, ::-1], axis=1)[:, ::-1]
+    return out
+
+
+def _vectorized(obj, z):
+    n = len(obj.m)
+
+    # Extend the mass range up to 10^18 when integrating to get n(>m), rather than
+    # extrapolating like hmf does.
+    if obj.Mmax < 18:
+        obj.update(Mmax=18)
+    m = obj.m
+
+    g = growth_factors(obj, z)
+    sigma = g[:, None] * obj._sigma_0[None, :]
+    nu = (obj.delta_c / sigma) ** 2
+
+    # The fitting function needs to know the redshift, but is cheap to evaluate.
+    fsigma = np.array(
+        [
+            obj.hmf_model(
+                m=m,
+                nu2=nu[i],
+                z=zz,
+                mass_definition=obj.mdef,
+                cosmo=obj.cosmo,
+                delta_c=obj.delta_c,
+                n_eff=obj.n_eff,
+                **obj.hmf_params
+            ).fsigma
+            for i, zz in enumerate(z)
+        ]
+    )
+
+    dndm = fsigma * obj.mean_density0 * np.abs(obj._dlnsdlnm) / m ** 2
+    dndlnm = np.nan_to_num(m * dndm)
+    ngtm = _cumulative_gtm(np.log(m), dndlnm)
+    rho_gtm = _cumulative_gtm(np.log(m), m * dndlnm)
+
+    with np.errstate(divide="ignore"):
+        quantities = {
+            "sigma": sigma,
+            "lnsigma": np.log(1 / sigma),
+            "fsigma": fsigma,
+            "dndm": dndm,
+            "dndlnm": m * dndm,
+            "dndlog10m": m * dndm * np.log(10),
+            "ngtm": ngtm,
+            "rho_gtm": rho_gtm,
+            "rho_ltm": obj.mean_density0 - rho_gtm,
+            "how_big": (0.366362 / ngtm) ** (1.0 / 3.0),
+        }
+
+    quantities = {k: v[:, :n] for k, v in quantities.items()}
+    quantities["power"] = g[:, None] ** 2 * obj._power0[None, :]
+    quantities["delta_k"] = obj.k ** 3 * quantities["power"] / (2 * np.pi ** 2)
+
+    return RedshiftSeries(z, m[:n], obj.k, **quantities)
+
+
+def _by_update(obj, z):
+    # hmf only re-computes the quantities that depend on z, so this is still far
+    # cheaper than computing a new model at each redshift.
+    out = {q: [] for q in SERIES_QUANTITIES}
+    for zz in z:
+        obj.update(z=zz)
+        for q in SERIES_QUANTITIES:
+            out[q].append(getattr(obj, q))
+
+    return RedshiftSeries(z, obj.m, obj.k, **{q: np.array(v) for q, v in out.items()})
+
+
+def redshift_series(obj, z):
+    """
+    Compute the quantities of a model at each of the redshifts ``z``.
+
+    Parameters
+    ----------
+    obj : :class:`hmf.MassFunction` or :class:`~array_store.StoredModel`
+        The model. It is not modified.
+    z : array_like
+        Redshifts.
+
+    Returns
+    -------
+    :class:`RedshiftSeries`
+
+    Raises
+    ------
+    ~sandbox.ComputeLimitExceeded
+        If the computation takes too long or uses too much memory.
+    """
+    z = np.atleast_1d(np.asarray(z, dtype=float))
+
+    if isinstance(obj, array_store.StoredModel):
+        obj = obj.framework()
+    return sandbox.run(_series, obj, z)
+
+
+def _series(obj, z):
+    obj = copy.deepcopy(obj)
+
+    if _can_vectorize(obj):
+        return _vectorized(obj, z)
+
+    logger.info("Computing redshift series for %s one redshift at a time", obj)
+    return _by_update(obj, z)
+
+
+def cached_redshift_series(obj, z):
+    """Like :func:`redshift_series`, but cached for stored models."""
+    key = getattr(obj, "key", None)
+    if key is None:
+        return redshift_series(obj, z)
+
+    cache_key = (
+        "hmfcalc-zseries:"
+        + hashlib.sha1(json.dumps([key, list(map(float, z))]).encode()).hexdigest()
+    )
+
+    series = cache.get(cache_key)
+    if series is None:
+        series = redshift_series(obj, z)
+        cache.set(cache_key, series)
+    return series
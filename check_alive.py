@@ -5,20 +5,19 @@ Created on Jun 14, 2013
 
 @author: Steven
 """
+import json
 import urllib.request
 from subprocess import call
 
-response = urllib.request.urlopen("http://hmf.icrar.org", timeout=5)
+try:
+    response = urllib.request.urlopen("http://hmf.icrar.org/healthz", timeout=5)
+    health = json.loads(response.read().decode())
+    print("Worker %s is %s" % (health["worker"]["pid"], health["status"]))
+    alive = True
+except Exception as e:
+    print("Health check failed: %s" % e)
+    alive = False
 
-for line in response.readlines():
-    if (
-        "<a href='hmf_finder/form/create/' class='btn btn-primary btn-large'>Begin!</a>"
-        in line
-    ):
-        print("found line")
-        found_line = True
-        break
-
-if not found_line:
+if not alive:
     print("Web-page down, restarting")
     call(["sudo", "service", "httpd", "restart"])
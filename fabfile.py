@@ -50,6 +50,7 @@ def deploy():
         run("git fetch --all")
         run("git reset --hard origin/master")
         run("%shmfenv/bin/python change_prod_settings.py" % (home_dir))
+        run("%shmfenv/bin/python manage.py collectstatic --noinput" % (home_dir))
         run("touch HMF/wsgi.py")
 
     # Update hmf from git repo